@@ -0,0 +1,37 @@
+-- Create bot_state table: shared key/value state for running several bot replicas
+-- Used when STATE_BACKEND=supabase (active voice calls, exactly-once call billing claims)
+CREATE TABLE IF NOT EXISTS bot_state (
+    key VARCHAR(255) PRIMARY KEY,
+    value JSONB,
+    expires_at TIMESTAMP WITH TIME ZONE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Create indexes for faster queries
+CREATE INDEX IF NOT EXISTS idx_bot_state_key_prefix ON bot_state(key varchar_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_bot_state_expires_at ON bot_state(expires_at) WHERE expires_at IS NOT NULL;
+
+-- Add RLS (Row Level Security) policies
+ALTER TABLE bot_state ENABLE ROW LEVEL SECURITY;
+
+-- Policy to allow service role to manage bot state
+CREATE POLICY "Service role can manage bot state" ON bot_state
+    FOR ALL USING (auth.role() = 'service_role');
+
+-- Expired rows are ignored by the bot; this removes them for good
+CREATE OR REPLACE FUNCTION purge_expired_bot_state()
+RETURNS INTEGER
+LANGUAGE sql
+SECURITY DEFINER
+AS $$
+    WITH deleted AS (
+        DELETE FROM bot_state WHERE expires_at < NOW() RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM deleted;
+$$;
+
+-- Add comments for documentation
+COMMENT ON TABLE bot_state IS 'Shared bot state so webhooks can be handled by any replica';
+COMMENT ON COLUMN bot_state.key IS 'Namespaced key, e.g. call:<call_id> or call_end:<call_id>';
+COMMENT ON COLUMN bot_state.value IS 'JSON value; for claims, the replica that won the claim';
+COMMENT ON COLUMN bot_state.expires_at IS 'Row is treated as absent after this time (NULL = never expires)';
@@ -0,0 +1,59 @@
+-- Push gem balance and payment changes to the bot over LISTEN/NOTIFY
+-- The bot listens on the 'payment_events' channel when SUPABASE_DB_URL is set
+
+-- Notify whenever a user's gems or subscription change, whoever made the change
+CREATE OR REPLACE FUNCTION notify_user_balance_change()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('payment_events', json_build_object(
+        'user_id', NEW.telegram_id,
+        'gems', NEW.gems,
+        'subscription_type', NEW.subscription_type,
+        'source', 'users'
+    )::text);
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS users_balance_notify ON users;
+CREATE TRIGGER users_balance_notify
+    AFTER UPDATE OF gems, subscription_type ON users
+    FOR EACH ROW
+    WHEN (OLD.gems IS DISTINCT FROM NEW.gems OR OLD.subscription_type IS DISTINCT FROM NEW.subscription_type)
+    EXECUTE FUNCTION notify_user_balance_change();
+
+-- Notify when a payment completes so the bot picks up the settled balance
+CREATE OR REPLACE FUNCTION notify_payment_completed()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    current_gems INTEGER;
+    current_subscription TEXT;
+BEGIN
+    SELECT gems, subscription_type INTO current_gems, current_subscription
+    FROM users WHERE telegram_id = NEW.user_id;
+
+    PERFORM pg_notify('payment_events', json_build_object(
+        'user_id', NEW.user_id,
+        'gems', current_gems,
+        'subscription_type', current_subscription,
+        'charge_id', NEW.telegram_charge_id,
+        'source', 'processed_payments'
+    )::text);
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS processed_payments_completed_notify ON processed_payments;
+CREATE TRIGGER processed_payments_completed_notify
+    AFTER INSERT OR UPDATE OF status ON processed_payments
+    FOR EACH ROW
+    WHEN (NEW.status = 'completed')
+    EXECUTE FUNCTION notify_payment_completed();
+
+-- Add comments for documentation
+COMMENT ON FUNCTION notify_user_balance_change() IS 'Publishes gem/subscription changes on the payment_events channel';
+COMMENT ON FUNCTION notify_payment_completed() IS 'Publishes the settled balance on the payment_events channel when a payment completes';
@@ -0,0 +1,118 @@
+-- Create premium_jobs table: durable queue for paid deliverables (images, videos, voice notes)
+CREATE TABLE IF NOT EXISTS premium_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    idempotency_key VARCHAR(255) NOT NULL UNIQUE,
+    user_id BIGINT NOT NULL,
+    job_type VARCHAR(50) NOT NULL,
+    gem_cost INTEGER NOT NULL DEFAULT 0,
+    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+    status VARCHAR(50) NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    claimed_by VARCHAR(255),
+    lease_until TIMESTAMP WITH TIME ZONE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+
+    -- Foreign key to users table
+    CONSTRAINT fk_premium_jobs_user_id
+        FOREIGN KEY (user_id)
+        REFERENCES users(telegram_id)
+        ON DELETE CASCADE
+);
+
+-- Lease columns for tables created before replicas shared the queue
+ALTER TABLE premium_jobs
+ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(255),
+ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE;
+
+-- Create indexes for faster queries
+CREATE INDEX IF NOT EXISTS idx_premium_jobs_user_id ON premium_jobs(user_id);
+CREATE INDEX IF NOT EXISTS idx_premium_jobs_open ON premium_jobs(status) WHERE status IN ('queued', 'running');
+
+-- Add RLS (Row Level Security) policies
+ALTER TABLE premium_jobs ENABLE ROW LEVEL SECURITY;
+
+-- Policy to allow service role to manage premium jobs
+CREATE POLICY "Service role can manage premium jobs" ON premium_jobs
+    FOR ALL USING (auth.role() = 'service_role');
+
+-- Create a job and debit its gems in one transaction. Returns no row when the
+-- idempotency key already exists (a repeated click); raises, writing nothing,
+-- when the user cannot cover the cost. The job starts leased to its creator.
+CREATE OR REPLACE FUNCTION enqueue_premium_job(
+    p_idempotency_key VARCHAR,
+    p_user_id BIGINT,
+    p_job_type VARCHAR,
+    p_gem_cost INTEGER,
+    p_payload JSONB,
+    p_claimed_by VARCHAR,
+    p_lease_seconds INTEGER
+)
+RETURNS SETOF premium_jobs
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+DECLARE
+    v_job premium_jobs;
+BEGIN
+    INSERT INTO premium_jobs (idempotency_key, user_id, job_type, gem_cost, payload, status, claimed_by, lease_until)
+    VALUES (p_idempotency_key, p_user_id, p_job_type, p_gem_cost, p_payload, 'queued',
+            p_claimed_by, NOW() + make_interval(secs => p_lease_seconds))
+    ON CONFLICT (idempotency_key) DO NOTHING
+    RETURNING * INTO v_job;
+
+    IF v_job.id IS NULL THEN
+        RETURN;
+    END IF;
+
+    UPDATE users
+    SET pending_gem_refund = gems, gems = gems - p_gem_cost
+    WHERE telegram_id = p_user_id AND gems >= p_gem_cost;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'User % cannot cover % gems', p_user_id, p_gem_cost;
+    END IF;
+
+    RETURN NEXT v_job;
+END;
+$$;
+
+-- Lease every queued job, and every job whose lease has run out, to one replica.
+-- SKIP LOCKED keeps concurrent claimers from ever winning the same row.
+CREATE OR REPLACE FUNCTION claim_premium_jobs(p_claimed_by VARCHAR, p_lease_seconds INTEGER)
+RETURNS SETOF premium_jobs
+LANGUAGE sql
+SECURITY DEFINER
+AS $$
+    UPDATE premium_jobs
+    SET status = 'running', claimed_by = p_claimed_by,
+        lease_until = NOW() + make_interval(secs => p_lease_seconds), updated_at = NOW()
+    WHERE id IN (
+        SELECT id FROM premium_jobs
+        WHERE status IN ('queued', 'running') AND (lease_until IS NULL OR lease_until < NOW())
+        ORDER BY created_at
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *;
+$$;
+
+-- Add gems in a single statement so concurrent credits never overwrite each other
+CREATE OR REPLACE FUNCTION credit_user_gems(p_user_id BIGINT, p_amount INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+SECURITY DEFINER
+AS $$
+    UPDATE users SET gems = gems + p_amount WHERE telegram_id = p_user_id RETURNING gems;
+$$;
+
+-- Add comments for documentation
+COMMENT ON TABLE premium_jobs IS 'Paid deliverables queued by the bot and fulfilled by background workers';
+COMMENT ON COLUMN premium_jobs.idempotency_key IS 'One key per gem debit (offer type, user and offer message), prevents double charging';
+COMMENT ON COLUMN premium_jobs.job_type IS 'Deliverable type: image, video, voice_note';
+COMMENT ON COLUMN premium_jobs.gem_cost IS 'Gems debited for this job, refunded on terminal failure';
+COMMENT ON COLUMN premium_jobs.payload IS 'Inputs captured at purchase time plus progress markers (e.g. Wavespeed task_id)';
+COMMENT ON COLUMN premium_jobs.status IS 'Job status: queued, running, succeeded, failed, refunded, cancelled';
+COMMENT ON COLUMN premium_jobs.attempts IS 'Number of times a worker has picked up this job';
+COMMENT ON COLUMN premium_jobs.claimed_by IS 'Replica (hostname:pid) currently holding the job';
+COMMENT ON COLUMN premium_jobs.lease_until IS 'Another replica may take the job over after this time';
@@ -0,0 +1,75 @@
+-- Re-engagement broadcast: suppression columns, keyset paging and resumable checkpoints
+
+-- Track who was nudged and who blocked the bot
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS last_reengaged_at TIMESTAMP WITH TIME ZONE,
+ADD COLUMN IF NOT EXISTS bot_blocked_at TIMESTAMP WITH TIME ZONE;
+
+-- Keyset index matching the broadcast cursor
+CREATE INDEX IF NOT EXISTS idx_users_last_seen_telegram_id ON users(last_seen, telegram_id);
+
+-- One row per broadcast run; the cursor is checkpointed after every small batch.
+-- Inserting the run_key is how a replica claims a run; checkpoints renew its lease.
+CREATE TABLE IF NOT EXISTS broadcast_runs (
+    run_key VARCHAR(255) PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    status VARCHAR(50) NOT NULL DEFAULT 'running',
+    inactive_before TIMESTAMP WITH TIME ZONE NOT NULL,
+    cursor_last_seen TIMESTAMP WITH TIME ZONE,
+    cursor_telegram_id BIGINT NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    claimed_by VARCHAR(255),
+    lease_until TIMESTAMP WITH TIME ZONE,
+    started_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Lease columns for tables created before runs were claimed per replica
+ALTER TABLE broadcast_runs
+ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(255),
+ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS idx_broadcast_runs_running ON broadcast_runs(kind, started_at) WHERE status = 'running';
+
+-- Add RLS (Row Level Security) policies
+ALTER TABLE broadcast_runs ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Service role can manage broadcast runs" ON broadcast_runs
+    FOR ALL USING (auth.role() = 'service_role');
+
+-- Next page of dormant users after the (last_seen, telegram_id) cursor.
+-- A user is skipped if they blocked the bot since they were last seen, or if
+-- they were already nudged during this dormant period and the cooldown has not passed.
+CREATE OR REPLACE FUNCTION get_reengagement_candidates(
+    p_inactive_before TIMESTAMPTZ,
+    p_cooldown_before TIMESTAMPTZ,
+    p_after_last_seen TIMESTAMPTZ,
+    p_after_telegram_id BIGINT,
+    p_limit INTEGER
+)
+RETURNS TABLE (telegram_id BIGINT, last_seen TIMESTAMPTZ)
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+AS $$
+    SELECT u.telegram_id, u.last_seen
+    FROM users u
+    WHERE u.last_seen < p_inactive_before
+      AND (p_after_last_seen IS NULL OR (u.last_seen, u.telegram_id) > (p_after_last_seen, p_after_telegram_id))
+      AND (u.bot_blocked_at IS NULL OR u.bot_blocked_at < u.last_seen)
+      AND (u.last_reengaged_at IS NULL OR u.last_reengaged_at < u.last_seen OR u.last_reengaged_at < p_cooldown_before)
+    ORDER BY u.last_seen, u.telegram_id
+    LIMIT p_limit;
+$$;
+
+-- Add comments for documentation
+COMMENT ON TABLE broadcast_runs IS 'Checkpointed progress of bot broadcasts such as the daily re-engagement nudge';
+COMMENT ON COLUMN broadcast_runs.inactive_before IS 'Users last seen before this time are in the audience';
+COMMENT ON COLUMN broadcast_runs.cursor_last_seen IS 'last_seen of the last user handled (keyset cursor)';
+COMMENT ON COLUMN broadcast_runs.cursor_telegram_id IS 'telegram_id of the last user handled (keyset cursor)';
+COMMENT ON COLUMN broadcast_runs.claimed_by IS 'Replica (hostname:pid) sending this run';
+COMMENT ON COLUMN broadcast_runs.lease_until IS 'Another replica may resume the run after this time';
+COMMENT ON COLUMN users.last_reengaged_at IS 'When the re-engagement nudge was last sent';
+COMMENT ON COLUMN users.bot_blocked_at IS 'When a send failed because the user blocked the bot';
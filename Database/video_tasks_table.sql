@@ -0,0 +1,66 @@
+-- Create video_tasks table so pending Wavespeed renders survive bot restarts
+CREATE TABLE IF NOT EXISTS video_tasks (
+    id BIGSERIAL PRIMARY KEY,
+    task_id VARCHAR(255) NOT NULL UNIQUE,
+    user_id BIGINT NOT NULL,
+    gem_cost INTEGER NOT NULL DEFAULT 0,
+    status VARCHAR(50) NOT NULL DEFAULT 'pending',
+    video_url TEXT,
+    claimed_by VARCHAR(255),
+    lease_until TIMESTAMP WITH TIME ZONE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+
+    -- Foreign key to users table
+    CONSTRAINT fk_video_tasks_user_id
+        FOREIGN KEY (user_id)
+        REFERENCES users(telegram_id)
+        ON DELETE CASCADE
+);
+
+-- Lease columns for tables created before replicas shared the poller
+ALTER TABLE video_tasks
+ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(255),
+ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE;
+
+-- Create indexes for faster queries
+CREATE INDEX IF NOT EXISTS idx_video_tasks_user_id ON video_tasks(user_id);
+DROP INDEX IF EXISTS idx_video_tasks_pending;
+CREATE INDEX IF NOT EXISTS idx_video_tasks_open ON video_tasks(status) WHERE status IN ('pending', 'delivering');
+
+-- Add RLS (Row Level Security) policies
+ALTER TABLE video_tasks ENABLE ROW LEVEL SECURITY;
+
+-- Policy to allow service role to manage video tasks
+CREATE POLICY "Service role can manage video tasks" ON video_tasks
+    FOR ALL USING (auth.role() = 'service_role');
+
+-- Renew the caller's leases and take over open tasks whose lease has run out.
+-- A 'delivering' task has a finished render that was not confirmed sent yet.
+-- SKIP LOCKED keeps concurrent claimers from ever winning the same row.
+DROP FUNCTION IF EXISTS claim_video_tasks(VARCHAR, INTEGER);
+CREATE FUNCTION claim_video_tasks(p_claimed_by VARCHAR, p_lease_seconds INTEGER)
+RETURNS TABLE (task_id VARCHAR, user_id BIGINT, gem_cost INTEGER, status VARCHAR, video_url TEXT, created_at TIMESTAMPTZ)
+LANGUAGE sql
+SECURITY DEFINER
+AS $$
+    UPDATE video_tasks v
+    SET claimed_by = p_claimed_by, lease_until = NOW() + make_interval(secs => p_lease_seconds)
+    WHERE v.id IN (
+        SELECT id FROM video_tasks
+        WHERE status IN ('pending', 'delivering')
+          AND (claimed_by = p_claimed_by OR lease_until IS NULL OR lease_until < NOW())
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING v.task_id, v.user_id, v.gem_cost, v.status, v.video_url, v.created_at;
+$$;
+
+-- Add comments for documentation
+COMMENT ON TABLE video_tasks IS 'Wavespeed video renders owned by the bot video poller';
+COMMENT ON COLUMN video_tasks.task_id IS 'Wavespeed prediction ID';
+COMMENT ON COLUMN video_tasks.user_id IS 'Telegram user ID who paid for the video';
+COMMENT ON COLUMN video_tasks.gem_cost IS 'Gems charged for this video';
+COMMENT ON COLUMN video_tasks.status IS 'Task status: pending, delivering, completed, failed, timed_out, delivery_failed (refunded)';
+COMMENT ON COLUMN video_tasks.video_url IS 'Output URL once the render has completed';
+COMMENT ON COLUMN video_tasks.claimed_by IS 'Replica (hostname:pid) polling the task; only it may deliver or refund';
+COMMENT ON COLUMN video_tasks.lease_until IS 'Another replica may take the task over after this time';
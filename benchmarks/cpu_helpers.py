@@ -0,0 +1,219 @@
+"""Microbenchmarks for the pure-CPU helpers on the message and media paths.
+
+Each helper runs over a fixture corpus of real-looking user messages and model
+outputs (fixtures/helper_corpus.json). It reports ops/sec (best of --repeat runs)
+and the memory each call allocates, taken as the mean and max tracemalloc peak
+per call. Results are compared against a saved baseline so a change that slows
+a helper down or makes it allocate more shows up next to the number it
+replaced.
+
+Run from the repo root with the bot's .env available:
+    python benchmarks/cpu_helpers.py                 # compare against baselines/cpu_helpers.json
+    python benchmarks/cpu_helpers.py --save          # record a new baseline
+    python benchmarks/cpu_helpers.py --check         # exit 1 if anything regressed past --tolerance
+    python benchmarks/cpu_helpers.py --only voice    # helpers whose name contains "voice"
+
+Baselines are only comparable on the same machine and Python version; both are
+stored in the file and a mismatch is printed as a warning.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import secret_share_bot as ssb
+
+CORPUS_PATH = os.path.join(BENCH_DIR, 'fixtures', 'helper_corpus.json')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baselines', 'cpu_helpers.json')
+
+
+def run_coroutine(coro):
+    """Drive a coroutine that never actually suspends, without an event loop."""
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError('coroutine suspended; it cannot be benchmarked synchronously')
+
+
+def extract_name(message: str, patterns) -> str:
+    """The name extraction loop from _process_message / the voice call flow."""
+    for pattern in patterns:
+        match = re.search(pattern, message, re.IGNORECASE)
+        if match:
+            return match.group(1).capitalize()
+    return None
+
+
+def build_cases(corpus: dict) -> dict:
+    """Helper name -> (callable, list of argument tuples)."""
+    bot = ssb.SecretShareBot(None)
+    image_generator = ssb.ImageGenerator('', bot.kobold_api)
+    video_generator = ssb.VideoGenerator('')
+    messages = [(m,) for m in corpus['user_messages']]
+    outputs = [(o,) for o in corpus['model_outputs']]
+    characters = list(ssb.CHARACTERS.values())
+    prompt_cases = [
+        (characters[i % len(characters)], scenario, outfit, state, corpus['user_messages'][i % len(corpus['user_messages'])])
+        for i, (scenario, outfit, state) in enumerate(
+            (s, o, c) for s in corpus['scenario_prompts'] for o in corpus['outfits'] for c in corpus['clothing_states']
+        )
+    ]
+    messages_list = corpus['user_messages']
+    sessions = []
+    for i, (character_key, character) in enumerate(ssb.CHARACTERS.items()):
+        for scenario_key, scenario in character['scenarios'].items():
+            history = [{'role': 'user' if n % 2 == 0 else 'assistant', 'content': messages_list[(i + n) % len(messages_list)]} for n in range(6)]
+            sessions.append(ssb.UserData(current_character=character_key, current_scenario=scenario_key, conversation_history=history,
+                                         user_name=['Jacob', 'Sam_92', 'Ravi'][i % 3], character_current_outfit=scenario['character_outfit']))
+    chat_cases = [(sessions[i % len(sessions)], m) for i, m in enumerate(messages_list)]
+    return {
+        '_normalize_actions': (bot._normalize_actions, outputs),
+        '_strip_artifacts': (bot._strip_artifacts, outputs),
+        '_ensure_complete_sentence': (bot._ensure_complete_sentence, outputs),
+        '_validate_and_fix_actions': (bot._validate_and_fix_actions, [(o, 'Marcus') for o in corpus['model_outputs']]),
+        '_trim_for_length': (bot._trim_for_length, outputs),
+        'is_custom_photo_request': (ssb.is_custom_photo_request, messages),
+        'is_custom_video_request': (ssb.is_custom_video_request, messages),
+        'is_voice_note_request': (ssb.is_voice_note_request, messages),
+        'is_voice_call_request': (ssb.is_voice_call_request, messages),
+        'clean_voice_call_text': (ssb.clean_voice_call_text, outputs),
+        'clean_voice_note_text': (ssb.clean_voice_note_text, outputs),
+        'ImageGenerator._engineer_prompt': (lambda *args: run_coroutine(image_generator._engineer_prompt(*args)), prompt_cases),
+        'VideoGenerator._sanitize_video_prompt': (video_generator._sanitize_video_prompt, [(p,) for p in corpus['video_prompts']]),
+        'NAME_PATTERNS': (lambda m: extract_name(m, ssb.NAME_PATTERNS), messages),
+        'HISTORY_NAME_PATTERNS': (lambda m: extract_name(m, ssb.HISTORY_NAME_PATTERNS), messages),
+        'PromptTemplates.chat': (lambda session, m: ssb.PROMPTS.chat(
+            ssb.PROMPTS.chat_system(session, session.user_name), session.conversation_history[-5:], m, session, time.perf_counter()
+        ), chat_cases),
+        'PromptTemplates.upsell': (lambda session, m: ssb.PROMPTS.upsell(session, session.user_name, 'photo', m), chat_cases),
+    }
+
+
+def measure_speed(fn, cases: list, min_time: float, repeat: int) -> float:
+    """Best ops/sec over `repeat` runs of at least min_time seconds each."""
+    best = 0.0
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            for args in cases:
+                fn(*args)
+            calls += len(cases)
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, calls / elapsed)
+    return best
+
+
+def measure_allocations(fn, cases: list) -> dict:
+    """Peak bytes allocated while each call runs, after a warm-up pass fills the regex cache."""
+    for args in cases:
+        fn(*args)
+    peaks = []
+    tracemalloc.start()
+    try:
+        for args in cases:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            fn(*args)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+    finally:
+        tracemalloc.stop()
+    return {'alloc_bytes_mean': round(sum(peaks) / len(peaks)), 'alloc_bytes_max': max(peaks)}
+
+
+def environment() -> dict:
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'processor': platform.processor() or platform.machine(),
+    }
+
+
+def compare(name: str, result: dict, baseline: dict, tolerance: float) -> (str, bool):
+    old = baseline.get('results', {}).get(name)
+    if not old:
+        return 'new', False
+    speed = result['ops_per_sec'] / old['ops_per_sec'] - 1
+    alloc = (result['alloc_bytes_mean'] - old['alloc_bytes_mean']) / max(old['alloc_bytes_mean'], 1)
+    regressed = speed < -tolerance or alloc > tolerance
+    note = f"{speed:+7.1%} ops  {alloc:+7.1%} alloc"
+    return (note + '  REGRESSION') if regressed else note, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', help='run helpers whose name contains this substring')
+    parser.add_argument('--min-time', type=float, default=0.3, help='seconds per timing run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown / allocation growth (0.2 = 20%%)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Helpers log at DEBUG/INFO on some inputs; keep the output to the table
+    logging.getLogger('secret_share_bot').setLevel(logging.WARNING)
+    random.seed(args.seed)
+    with open(CORPUS_PATH, encoding='utf-8') as f:
+        corpus = json.load(f)
+    cases = build_cases(corpus)
+    if args.only:
+        cases = {name: case for name, case in cases.items() if args.only.lower() in name.lower()}
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('environment', {}).get('python') != platform.python_version():
+            print(f"warning: baseline was recorded on Python {baseline.get('environment', {}).get('python')}, "
+                  f"this is {platform.python_version()}")
+
+    results, regressions = {}, []
+    print(f"{'helper':40} {'ops/sec':>12} {'µs/op':>9} {'alloc B/call':>13} {'max B':>8}  vs baseline")
+    for name, (fn, arg_list) in cases.items():
+        result = measure_allocations(fn, arg_list)
+        ops = measure_speed(fn, arg_list, args.min_time, args.repeat)
+        result.update({'ops_per_sec': round(ops, 1), 'us_per_op': round(1e6 / ops, 3), 'cases': len(arg_list)})
+        results[name] = result
+        note, regressed = compare(name, result, baseline, args.tolerance) if baseline else ('', False)
+        if regressed:
+            regressions.append(name)
+        print(f"{name:40} {result['ops_per_sec']:>12,.0f} {result['us_per_op']:>9.2f} "
+              f"{result['alloc_bytes_mean']:>13,} {result['alloc_bytes_max']:>8,}  {note}")
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'environment': environment(),
+                'settings': {'min_time': args.min_time, 'repeat': args.repeat, 'seed': args.seed},
+                'results': results,
+            }, f, indent=2)
+            f.write('\n')
+        print(f"baseline saved to {os.path.relpath(args.baseline)}")
+
+    if regressions:
+        print(f"regressed: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
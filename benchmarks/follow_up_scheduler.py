@@ -0,0 +1,81 @@
+"""Follow-up scheduling cost: one JobQueue job per chat vs. the InactivityTracker timing wheel.
+
+Simulates 50k active chats, then replays a stream of incoming messages, each
+of which re-arms its chat's 5-minute follow-up. Reports scheduler CPU time
+per message for both approaches.
+
+Run from the repo root with the bot's .env available:
+    python benchmarks/follow_up_scheduler.py [--users 50000] [--messages 5000]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import Application
+
+from secret_share_bot import InactivityTracker
+
+
+async def noop(context):
+    pass
+
+
+async def bench_job_queue(users: int, messages: list) -> float:
+    """The previous approach: get_jobs_by_name scan + schedule_removal + run_once per message."""
+    application = Application.builder().token("123456:benchmark").build()
+    job_queue = application.job_queue
+    job_queue.set_application(application)
+    await job_queue.start()
+    try:
+        for chat_id in range(users):
+            job_queue.run_once(noop, timedelta(minutes=5), chat_id=chat_id, name=f"follow_up_{chat_id}")
+        start = time.process_time()
+        for chat_id in messages:
+            name = f"follow_up_{chat_id}"
+            for job in job_queue.get_jobs_by_name(name):
+                job.schedule_removal()
+            job_queue.run_once(noop, timedelta(minutes=5), chat_id=chat_id, name=name)
+        return time.process_time() - start
+    finally:
+        await job_queue.stop(wait=False)
+
+
+async def bench_tracker(users: int, messages: list) -> float:
+    async def on_due(chat_ids):
+        pass
+
+    tracker = InactivityTracker(on_due)
+    for chat_id in range(users):
+        tracker.touch(chat_id)
+    start = time.process_time()
+    for chat_id in messages:
+        tracker.touch(chat_id)
+    tracker.pop_due()
+    return time.process_time() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--messages', type=int, default=5000)
+    args = parser.parse_args()
+    logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+    messages = [random.randrange(args.users) for _ in range(args.messages)]
+    tracker_cpu = await bench_tracker(args.users, messages)
+    job_queue_cpu = await bench_job_queue(args.users, messages)
+
+    print(f"{args.users} chats, {args.messages} messages")
+    print(f"  JobQueue per chat : {job_queue_cpu:8.3f}s CPU  ({job_queue_cpu / args.messages * 1e6:10.1f} us/message)")
+    print(f"  InactivityTracker : {tracker_cpu:8.3f}s CPU  ({tracker_cpu / args.messages * 1e6:10.1f} us/message)")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,312 @@
+"""End-to-end load test: SecretShareBot driven by synthetic Telegram traffic against stub providers.
+
+Builds the real Application (handlers, ChatOrderedUpdateProcessor, admission
+control) with a fake Bot API transport and the in-process stubs from
+stub_providers.py, then replays user journeys:
+
+    new       /start -> age verification -> character -> scenario -> chat
+    returning /start (already verified) -> character -> scenario -> chat
+    buyer     returning journey whose chat asks for a photo or voice note and accepts the offer
+
+Users arrive at --arrival-rate per second until --users have started; each user waits
+--think-time (exponential mean) between steps. Reports throughput, latency percentiles
+per handler and per update kind, event-loop lag and outbound call counts. Runs need no
+network and are repeatable with --seed.
+
+Run from the repo root with the bot's .env available:
+    python benchmarks/load_harness.py --users 500 --arrival-rate 25 --mix new=0.3,returning=0.6,buyer=0.1
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+
+import secret_share_bot as ssb
+from stub_providers import FakeTelegramRequest, Latency, StubSupabase, install_stub_providers, make_stub_providers
+
+CHAT_MESSAGES = [
+    "hey you, how was your day?",
+    "I missed you so much today",
+    "what are you wearing right now?",
+    "tell me something nobody else knows about you",
+    "my name is Daniel by the way",
+    "I just got home from work, I'm exhausted",
+    "you look amazing tonight",
+    "what would you do if I was there with you?",
+    "haha you're trouble, I like it",
+    "come closer and tell me a secret",
+]
+PREMIUM_REQUESTS = {
+    'image': ("send me a pic of you", 10),
+    'voice_note': ("send me a voice note, I want to hear your voice", ssb.VOICE_NOTE_COST),
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 1),
+        'p90_ms': round(percentile(values, 90) * 1000, 1),
+        'p99_ms': round(percentile(values, 99) * 1000, 1),
+        'max_ms': round(max(values) * 1000, 1) if values else 0.0,
+    }
+
+
+class LoadHarness:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = FakeTelegramRequest(Latency(args.telegram_latency))
+        self.db = StubSupabase(Latency(args.db_latency))
+        install_stub_providers(self.db, make_stub_providers(
+            kobold_latency=Latency(args.kobold_latency),
+            kobold_tokens_per_second=args.kobold_tokens_per_second,
+            image_latency=Latency(args.image_latency),
+            tts_latency=Latency(args.tts_latency),
+            video_latency=Latency(args.video_latency),
+        ))
+        self.application, self.bot = ssb.build_application('123456:LOADTEST', request=self.telegram)
+        self.handler_latency = defaultdict(list)
+        self.update_latency = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.loop_lag = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._instrument_handlers()
+
+    def _instrument_handlers(self):
+        for handlers in self.application.handlers.values():
+            for handler in handlers:
+                handler.callback = self._timed(handler.callback)
+        jobs = self.bot.premium_jobs
+        jobs.handlers = {job_type: self._timed(run, f"premium_job:{job_type}") for job_type, run in jobs.handlers.items()}
+
+    def _timed(self, callback, name=None):
+        name = name or getattr(callback, '__name__', repr(callback))
+
+        @functools.wraps(callback)
+        async def wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return await callback(*args)
+            except Exception:
+                self.errors[name] += 1
+                raise
+            finally:
+                self.handler_latency[name].append(time.perf_counter() - start)
+        return wrapper
+
+    # --- Synthetic updates ---
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Load{user_id}", 'username': f"load{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def _callback(self, user_id: int, data: str) -> dict:
+        return {'update_id': next(self._update_ids), 'callback_query': {
+            'id': str(next(self._message_ids)),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': FakeTelegramRequest.BOT_USER,
+                'text': '...',
+            },
+        }}
+
+    async def send(self, kind: str, payload: dict):
+        update = Update.de_json(payload, self.application.bot)
+        start = time.perf_counter()
+        processor = self.application.update_processor
+        try:
+            await processor.process_update(update, self.application.process_update(update))
+        except Exception:
+            self.errors[kind] += 1
+        self.update_latency[kind].append(time.perf_counter() - start)
+
+    async def think(self):
+        await asyncio.sleep(random.expovariate(1 / self.args.think_time) if self.args.think_time > 0 else 0)
+
+    # --- Journeys ---
+
+    async def onboard(self, user_id: int, verify: bool):
+        await self.send('start', self._message(user_id, '/start'))
+        await self.think()
+        if verify:
+            await self.send('age_verify', self._callback(user_id, 'verify_age_yes'))
+            await self.think()
+        char_key = random.choice(list(ssb.CHARACTERS))
+        scenario_id = random.choice(list(ssb.CHARACTERS[char_key]['scenarios']))
+        await self.send('character', self._callback(user_id, f"char|{char_key}"))
+        await self.think()
+        await self.send('scenario', self._callback(user_id, f"scenario|{char_key}|{scenario_id}"))
+        await self.think()
+
+    async def chat(self, user_id: int, messages: int):
+        for _ in range(messages):
+            await self.send('chat', self._message(user_id, random.choice(CHAT_MESSAGES)))
+            await self.think()
+
+    async def buy(self, user_id: int):
+        offer_type = random.choice(list(PREMIUM_REQUESTS))
+        text, gem_cost = PREMIUM_REQUESTS[offer_type]
+        await self.send('premium_request', self._message(user_id, text))
+        await self.think()
+        session = self.bot.active_users.get(user_id)
+        if session and session.premium_offer_state.get('status') == 'pending':
+            await self.send('premium_click', self._callback(user_id, f"premium_yes|{offer_type}|{gem_cost}"))
+            await self.think()
+
+    async def run_user(self, user_id: int, population: str):
+        if population == 'new':
+            await self.onboard(user_id, verify=True)
+            await self.chat(user_id, self.args.messages_per_user)
+        elif population == 'returning':
+            await self.onboard(user_id, verify=False)
+            await self.chat(user_id, self.args.messages_per_user)
+        else:
+            await self.onboard(user_id, verify=False)
+            await self.chat(user_id, max(1, self.args.messages_per_user // 2))
+            await self.buy(user_id)
+            await self.chat(user_id, max(1, self.args.messages_per_user // 2))
+
+    # --- Run ---
+
+    async def monitor_loop_lag(self, interval: float = 0.05):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.append(max(0.0, loop.time() - expected))
+
+    async def run(self) -> dict:
+        mix = ssb._parse_log_map(self.args.mix, float)
+        populations, weights = zip(*mix.items())
+        assignments = [(1_000 + i, random.choices(populations, weights)[0]) for i in range(self.args.users)]
+        for user_id, population in assignments:
+            if population != 'new':
+                self.db.seed_user(user_id, age_verified=True, gems=500 if population == 'buyer' else ssb.WELCOME_GEMS_BONUS)
+
+        await self.application.initialize()
+        await self.application.start()
+        await self.bot.follow_ups.start()
+        await self.bot.premium_jobs.start()
+        await self.bot.typing.start(self.application.bot)
+        monitor = asyncio.create_task(self.monitor_loop_lag())
+        start = time.perf_counter()
+        try:
+            users = []
+            for user_id, population in assignments:
+                users.append(asyncio.create_task(self.run_user(user_id, population)))
+                if self.args.arrival_rate > 0:
+                    await asyncio.sleep(random.expovariate(self.args.arrival_rate))
+            await asyncio.gather(*users)
+            # Let accepted premium orders finish so their delivery time is measured
+            await asyncio.gather(*(queue.join() for queue in self.bot.premium_jobs._queues.values()))
+        finally:
+            elapsed = time.perf_counter() - start
+            monitor.cancel()
+            await self.bot.typing.stop()
+            await self.bot.premium_jobs.stop()
+            await self.bot.follow_ups.stop()
+            await self.application.stop()
+            await self.application.shutdown()
+
+        updates = sum(len(v) for v in self.update_latency.values())
+        return {
+            'users': self.args.users,
+            'updates': updates,
+            'elapsed_s': round(elapsed, 2),
+            'throughput_updates_per_s': round(updates / elapsed, 1) if elapsed else 0.0,
+            'updates_by_kind': {kind: summarize(v) for kind, v in sorted(self.update_latency.items())},
+            'handlers': {name: summarize(v) for name, v in sorted(self.handler_latency.items())},
+            'event_loop_lag': summarize(self.loop_lag),
+            'errors': dict(self.errors),
+            'admission': dict(self.bot.admission.counts),
+            'telegram_calls': dict(self.telegram.calls.most_common()),
+            'supabase_calls': dict(self.db.calls.most_common()),
+        }
+
+
+def print_report(report: dict):
+    print(f"users {report['users']}, updates {report['updates']} in {report['elapsed_s']}s "
+          f"-> {report['throughput_updates_per_s']} updates/s")
+    row = "{:<32} {:>7} {:>9} {:>9} {:>9} {:>9}"
+    for title, key in (('update kind', 'updates_by_kind'), ('handler', 'handlers')):
+        print()
+        print(row.format(title, 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for name, s in report[key].items():
+            print(row.format(name, s['count'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms']))
+    lag = report['event_loop_lag']
+    print(f"\nevent loop lag: p50 {lag['p50_ms']} ms, p99 {lag['p99_ms']} ms, max {lag['max_ms']} ms")
+    print(f"admission: {report['admission']}")
+    if report['errors']:
+        print(f"errors: {report['errors']}")
+    print(f"telegram calls: {report['telegram_calls']}")
+    print(f"supabase calls: {sum(report['supabase_calls'].values())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--arrival-rate', type=float, default=20.0, help='new users per second (0 = all at once)')
+    parser.add_argument('--mix', default='new=0.3,returning=0.6,buyer=0.1', help='population weights')
+    parser.add_argument('--messages-per-user', type=int, default=6)
+    parser.add_argument('--think-time', type=float, default=1.0, help='mean seconds between a user\'s steps')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='median Bot API round trip (s)')
+    parser.add_argument('--db-latency', type=float, default=0.03, help='median Supabase call (s)')
+    parser.add_argument('--kobold-latency', type=float, default=0.5, help='median Kobold time to first token (s)')
+    parser.add_argument('--kobold-tokens-per-second', type=float, default=60.0)
+    parser.add_argument('--image-latency', type=float, default=6.0)
+    parser.add_argument('--tts-latency', type=float, default=1.5)
+    parser.add_argument('--video-latency', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING', help='bot log level during the run')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(args.log_level)
+    logging.getLogger(ssb.__name__).setLevel(args.log_level)
+    report = asyncio.run(LoadHarness(args).run())
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
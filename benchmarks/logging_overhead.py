@@ -0,0 +1,142 @@
+"""Per-message logging cost: eager f-strings on a synchronous handler vs. the queued, lazy setup.
+
+Replays the log calls one ordinary chat message used to make (user text, session
+state, three subscription checks, context sizes, raw Kobold output, session save
+and the httpx request lines for the Telegram/Supabase calls) against the current
+calls, and reports the time spent on the event loop thread per message. Records
+are written to a temporary file so disk I/O is part of the "before" number.
+
+Run from the repo root with the bot's .env available:
+    python benchmarks/logging_overhead.py [--messages 20000]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import secret_share_bot
+from secret_share_bot import configure_logging
+
+logger = logging.getLogger('secret_share_bot')
+httpx_logger = logging.getLogger('httpx')
+
+USER_MESSAGE = "hey, I missed you today. what have you been up to? tell me everything"
+KOBOLD_OUTPUT = "*I tilt my head and smile, tucking a strand of hair behind my ear.* " * 4
+HTTPX_CALLS = [
+    ('POST', 'https://api.telegram.org/bot123:abc/sendChatAction'),
+    ('GET', 'https://project.supabase.co/rest/v1/users?select=*&telegram_id=eq.1'),
+    ('GET', 'https://project.supabase.co/rest/v1/users?select=subscription_type&telegram_id=eq.1'),
+    ('POST', 'https://api.telegram.org/bot123:abc/sendMessage'),
+    ('POST', 'https://project.supabase.co/rest/v1/rpc/increment_message_count'),
+    ('POST', 'https://project.supabase.co/rest/v1/user_sessions'),
+]
+
+
+def log_message_before(user_id: int):
+    """The log calls of one message before the logging change."""
+    user_message = USER_MESSAGE
+    now = datetime.now(timezone.utc)
+    logger.info(f"[DEBUG] User message: '{user_message}' (user_id={user_id})")
+    httpx_logger.info(f'HTTP Request: {HTTPX_CALLS[0][0]} {HTTPX_CALLS[0][1]} "HTTP/1.1 200 OK"')
+    httpx_logger.info(f'HTTP Request: {HTTPX_CALLS[1][0]} {HTTPX_CALLS[1][1]} "HTTP/1.1 200 OK"')
+    logger.info(f"[SESSION STATE] user_id={user_id}, character=Isabella, scenario=1")
+    logger.info(f"[SUBSCRIPTION CHECK] Checking subscription for user {user_id} at {now}")
+    httpx_logger.info(f'HTTP Request: {HTTPX_CALLS[2][0]} {HTTPX_CALLS[2][1]} "HTTP/1.1 200 OK"')
+    logger.info(f"[SUBSCRIPTION CHECK] User {user_id} has subscription: tier='premium', expires_at={now}")
+    logger.info(f"[SUBSCRIPTION CHECK] ✅ User {user_id} has ACTIVE premium subscription (expires {now})")
+    logger.info(f"[SUBSCRIPTION CHECK] User {user_id}: is_subscribed='premium', is_admin=False")
+    logger.info(f"[CONTEXT] Initial size: {412} tokens ({1236} chars)")
+    logger.info(f"[CONTEXT SHIFT] ✅ Using {5}-turn memory, {412} tokens ({1236} chars)")
+    logger.info(f"[KOBOLD FAST] Starting generation, prompt: {KOBOLD_OUTPUT[:50]}...")
+    logger.info(f"[KOBOLD] ✅ Generation completed in {2.31:.2f}s: {KOBOLD_OUTPUT[:100]}...")
+    logger.info(f"[ENSURE SENTENCE] Raw: {KOBOLD_OUTPUT}")
+    for method, url in HTTPX_CALLS[3:]:
+        httpx_logger.info(f'HTTP Request: {method} {url} "HTTP/1.1 200 OK"')
+    logger.info(f"[SESSION SAVE] Saved session for user {user_id}")
+
+
+def log_message_after(user_id: int):
+    """The same message with the current calls."""
+    user_message = USER_MESSAGE
+    now = datetime.now(timezone.utc)
+    logger.debug("[DEBUG] User message: %r (user_id=%s)", user_message, user_id)
+    httpx_logger.info('HTTP Request: %s %s "%s %d %s"', *HTTPX_CALLS[0], 'HTTP/1.1', 200, 'OK')
+    httpx_logger.info('HTTP Request: %s %s "%s %d %s"', *HTTPX_CALLS[1], 'HTTP/1.1', 200, 'OK')
+    logger.debug("[SESSION STATE] user_id=%s, character=%s, scenario=%s", user_id, 'Isabella', 1)
+    logger.debug("[SUBSCRIPTION CHECK] Checking subscription for user %s at %s", user_id, now)
+    httpx_logger.info('HTTP Request: %s %s "%s %d %s"', *HTTPX_CALLS[2], 'HTTP/1.1', 200, 'OK')
+    logger.debug("[SUBSCRIPTION CHECK] User %s has subscription: tier=%r, expires_at=%s", user_id, 'premium', now)
+    logger.debug("[SUBSCRIPTION CHECK] ✅ User %s has ACTIVE %s subscription (expires %s)", user_id, 'premium', now)
+    logger.debug("[SUBSCRIPTION CHECK] User %s: is_subscribed=%r, is_admin=%s", user_id, 'premium', False)
+    logger.debug("[CONTEXT] Initial size: %s tokens (%s chars)", 412, 1236)
+    logger.info("[CONTEXT SHIFT] ✅ Using %s-turn memory, %s tokens (%s chars)", 5, 412, 1236)
+    logger.debug("[KOBOLD FAST] Starting generation, prompt: %.50s...", KOBOLD_OUTPUT)
+    logger.info("[KOBOLD] ✅ Generation completed in %.2fs", 2.31)
+    logger.debug("[KOBOLD] Output: %.100s...", KOBOLD_OUTPUT)
+    logger.debug("[ENSURE SENTENCE] Raw: %s", KOBOLD_OUTPUT)
+    for method, url in HTTPX_CALLS[3:]:
+        httpx_logger.info('HTTP Request: %s %s "%s %d %s"', method, url, 'HTTP/1.1', 200, 'OK')
+    logger.debug("[SESSION SAVE] Saved session for user %s", user_id)
+
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    secret_share_bot.log_listener.stop()
+    for name in ('secret_share_bot', 'httpx'):
+        logging.getLogger(name).setLevel(logging.NOTSET)
+
+
+def bench_before(messages: int, path: str) -> float:
+    reset_root()
+    logging.basicConfig(filename=path, format=secret_share_bot.LOG_FORMAT, level=logging.INFO)
+    start = time.perf_counter()
+    for i in range(messages):
+        log_message_before(i)
+    elapsed = time.perf_counter() - start
+    reset_root()
+    return elapsed
+
+
+def bench_after(messages: int, path: str) -> tuple:
+    reset_root()
+    with open(path, 'w', encoding='utf-8') as stream:
+        listener = configure_logging(stream)
+        start = time.perf_counter()
+        for i in range(messages):
+            log_message_after(i)
+        elapsed = time.perf_counter() - start
+        listener.stop()
+        drained = time.perf_counter() - start
+    return elapsed, drained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before_path = os.path.join(tmp, 'before.log')
+        after_path = os.path.join(tmp, 'after.log')
+        before = bench_before(args.messages, before_path)
+        after, drained = bench_after(args.messages, after_path)
+        before_lines = sum(1 for _ in open(before_path, encoding='utf-8'))
+        after_lines = sum(1 for _ in open(after_path, encoding='utf-8'))
+
+    print(f"messages: {args.messages}")
+    print(f"before: {before / args.messages * 1e6:8.1f} µs/message on the loop thread, {before_lines / args.messages:.0f} lines/message")
+    print(f"after:  {after / args.messages * 1e6:8.1f} µs/message on the loop thread, {after_lines / args.messages:.0f} lines/message "
+          f"(queue drained after {drained:.2f}s)")
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
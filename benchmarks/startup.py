@@ -0,0 +1,155 @@
+"""Startup cost: process start -> module imported -> bot ready -> first /start answered.
+
+Starts the provider emulators (python -m emulators) and launches the bot in fresh
+child processes pointed at them, so import-time network calls and the post_init
+work pay realistic latencies. Each child records time since the parent spawned it:
+
+    import       `import secret_share_bot` finished
+    ready        Application initialized, post_init done and started (polling would begin here)
+    first_reply  a /start from a new user has been answered with sendMessage
+
+Telegram is the in-process fake from stub_providers.py. Also prints the slowest
+imports from `python -X importtime`.
+
+Run from the repo root:
+    python benchmarks/startup.py [--runs 5] [--base-port 9300]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+# Placeholders for the settings the bot refuses to start without; emulator URLs override the rest
+REQUIRED_ENV = {
+    'TELEGRAM_BOT_TOKEN': '123456:startup-benchmark',
+    'ADMIN_CHAT_ID': '1',
+    'TELEGRAM_MODE': 'polling',
+}
+
+
+async def child():
+    t0 = float(os.environ['STARTUP_T0'])
+    import secret_share_bot as ssb
+    imported = time.time()
+
+    from telegram import Update
+    from stub_providers import FakeTelegramRequest, Latency
+
+    replied = asyncio.Event()
+
+    class ReplyWatcher(FakeTelegramRequest):
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            result = await super().do_request(url, method, request_data, **kwargs)
+            if url.endswith('/sendMessage'):
+                replied.set()
+            return result
+
+    application, bot = ssb.build_application(token=REQUIRED_ENV['TELEGRAM_BOT_TOKEN'], request=ReplyWatcher(Latency(0.02)))
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    ready = time.time()
+
+    update = Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1, 'date': int(time.time()), 'text': '/start',
+        'chat': {'id': 777, 'type': 'private'},
+        'from': {'id': 777, 'is_bot': False, 'first_name': 'Startup', 'username': 'startup'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    }}, application.bot)
+    await application.update_processor.process_update(update, application.process_update(update))
+    await asyncio.wait_for(replied.wait(), timeout=30)
+    first_reply = time.time()
+
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    print(json.dumps({'import': imported - t0, 'ready': ready - t0, 'first_reply': first_reply - t0}))
+
+
+def wait_for_emulators(ports, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    for port in ports:
+        while True:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/_emulator/stats", timeout=1).read()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise RuntimeError(f"emulator on port {port} did not come up")
+                time.sleep(0.1)
+
+
+def top_imports(env: dict, count: int = 10) -> list:
+    """(cumulative µs, module) for the slowest modules imported directly by secret_share_bot."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import secret_share_bot'],
+                            cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        # -X importtime indents each nesting level by two spaces
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            rows.append((int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--base-port', type=int, default=9300)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, REPO_ROOT)
+        sys.path.insert(0, BENCH_DIR)
+        asyncio.run(child())
+        return
+
+    env_lines = subprocess.run([sys.executable, '-m', 'emulators', '--print-env', '--base-port', str(args.base_port)],
+                               cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout
+    env = {**os.environ, **REQUIRED_ENV, 'WEB_SERVER_PORT': str(args.base_port + 50), 'LOG_LEVEL': 'WARNING'}
+    for line in env_lines.splitlines():
+        name, _, value = line.removeprefix('export ').partition('=')
+        env[name] = value
+
+    emulators = subprocess.Popen([sys.executable, '-m', 'emulators', '--base-port', str(args.base_port)],
+                                 cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_emulators(range(args.base_port, args.base_port + 5))
+        samples = []
+        for _ in range(args.runs):
+            run_env = {**env, 'STARTUP_T0': repr(time.time())}
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'],
+                                    cwd=REPO_ROOT, env=run_env, capture_output=True, text=True)
+            lines = [l for l in result.stdout.splitlines() if l.startswith('{')]
+            if result.returncode != 0 or not lines:
+                print(result.stderr[-2000:], file=sys.stderr)
+                raise SystemExit(f"child run failed with exit code {result.returncode}")
+            samples.append(json.loads(lines[-1]))
+        imports = top_imports(env)
+    finally:
+        emulators.terminate()
+        emulators.wait()
+
+    print(f"runs: {args.runs}")
+    for key in ('import', 'ready', 'first_reply'):
+        values = [s[key] for s in samples]
+        print(f"{key:12} median {statistics.median(values):6.2f}s  min {min(values):6.2f}s  max {max(values):6.2f}s")
+    print("slowest top-level imports (cumulative):")
+    for cumulative_us, name in imports:
+        print(f"  {name:30} {cumulative_us / 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
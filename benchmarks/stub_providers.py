@@ -0,0 +1,376 @@
+"""In-process stand-ins for Telegram, Supabase, KoboldCPP, Replicate, Wavespeed and ElevenLabs.
+
+Used by load_harness.py so a run needs no network and no paid API. Each stub keeps the
+real class's interface and bookkeeping (Kobold's slot semaphore, the premium job
+queue, etc.) and only replaces the remote call with a sampled delay. Supabase calls
+block the calling thread for their delay, exactly like the real synchronous client,
+so event-loop blocking shows up in the harness results.
+"""
+import asyncio
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Optional
+
+from telegram.request import BaseRequest
+
+import secret_share_bot as ssb
+
+
+class Latency:
+    """Log-normal delay with the given median; p99 is about 2.25x the median at the default spread."""
+
+    def __init__(self, median: float, sigma: float = 0.35):
+        self.median = median
+        self.sigma = sigma
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(random.gauss(0, self.sigma))
+
+
+STUB_REPLIES = [
+    "*I bite my lip and lean a little closer.* I was hoping you'd say that. Tell me more?",
+    "*I laugh softly, brushing my hair over my shoulder.* You always know how to make me smile.",
+    "*I tilt my head, studying you for a moment.* Mmm, and what would you do if I said yes?",
+    "*I trace a slow circle on the table with my finger.* Stay a little longer with me tonight.",
+]
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers Bot API calls locally and counts them by method."""
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'load_test_bot'}
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params: dict) -> dict:
+        chat_id = params.get('chat_id', 0)
+        message = {
+            'message_id': params.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self.BOT_USER,
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'caption' in params:
+            message['caption'] = params['caption']
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        await asyncio.sleep(self.latency.sample())
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = self.BOT_USER
+        elif endpoint.startswith(('send', 'edit', 'copy', 'forward')) and endpoint != 'sendChatAction':
+            result = self._message(params)
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class StubQuery:
+    """The subset of the postgrest query builder used by secret_share_bot."""
+
+    def __init__(self, client: 'StubSupabase', table: str):
+        self.client = client
+        self.table = table
+        self.action = 'select'
+        self.values = None
+        self.filters = []
+        self.order_by = None
+        self.limit_count = None
+        self.single_row = False
+        self.on_conflict = None
+        self.ignore_duplicates = False
+
+    def select(self, *columns, **kwargs):
+        self.action = 'select'
+        return self
+
+    def insert(self, values, **kwargs):
+        self.action, self.values = 'insert', values
+        return self
+
+    def update(self, values, **kwargs):
+        self.action, self.values = 'update', values
+        return self
+
+    def upsert(self, values, on_conflict=None, ignore_duplicates=False, **kwargs):
+        self.action, self.values = 'upsert', values
+        self.on_conflict, self.ignore_duplicates = on_conflict, ignore_duplicates
+        return self
+
+    def delete(self, **kwargs):
+        self.action = 'delete'
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: str(row.get(column)) == str(value))
+        return self
+
+    def in_(self, column, values):
+        wanted = {str(v) for v in values}
+        self.filters.append(lambda row: str(row.get(column)) in wanted)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and str(row.get(column)) < str(value))
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and str(row.get(column)) >= str(value))
+        return self
+
+    def like(self, column, pattern):
+        prefix = pattern.rstrip('%')
+        self.filters.append(lambda row: str(row.get(column, '')).startswith(prefix))
+        return self
+
+    def or_(self, *args, **kwargs):
+        return self  # only used for TTL checks on bot_state, which the harness keeps in memory
+
+    def order(self, column, desc=False, **kwargs):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, count, **kwargs):
+        self.limit_count = count
+        return self
+
+    def single(self):
+        self.single_row = True
+        return self
+
+    def execute(self):
+        return self.client._execute(self)
+
+
+class StubSupabase:
+    """In-memory tables behind a blocking delay per call, standing in for the sync Supabase client."""
+
+    KEYS = {'users': 'telegram_id', 'premium_jobs': 'id', 'video_tasks': 'task_id', 'bot_state': 'key'}
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.tables = defaultdict(list)
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def table(self, name: str) -> StubQuery:
+        return StubQuery(self, name)
+
+    def rpc(self, name: str, params: Optional[dict] = None) -> StubQuery:
+        client = self
+
+        class _Rpc:
+            def execute(self):
+                return client._rpc(name, params or {})
+        return _Rpc()
+
+    def _rows(self, query: StubQuery):
+        return [row for row in self.tables[query.table] if all(f(row) for f in query.filters)]
+
+    def _execute(self, query: StubQuery) -> StubResponse:
+        self.calls[f"{query.action}:{query.table}"] += 1
+        time.sleep(self.latency.sample())
+        with self._lock:
+            if query.action == 'select':
+                rows = self._rows(query)
+                if query.order_by:
+                    column, desc = query.order_by
+                    rows.sort(key=lambda r: str(r.get(column)), reverse=desc)
+                if query.limit_count is not None:
+                    rows = rows[:query.limit_count]
+                rows = [dict(r) for r in rows]
+                if query.single_row:
+                    if len(rows) != 1:
+                        raise Exception(f"JSON object requested, multiple (or no) rows returned ({len(rows)})")
+                    return StubResponse(rows[0])
+                return StubResponse(rows)
+            if query.action in ('insert', 'upsert'):
+                values = query.values if isinstance(query.values, list) else [query.values]
+                key = query.on_conflict or self.KEYS.get(query.table)
+                written = []
+                for value in values:
+                    existing = next((r for r in self.tables[query.table] if key and key in value and r.get(key) == value[key]), None)
+                    if existing is not None:
+                        if query.action == 'insert':
+                            raise Exception(f"duplicate key value violates unique constraint on {query.table}.{key}")
+                        if query.ignore_duplicates:
+                            continue
+                        existing.update(value)
+                        written.append(dict(existing))
+                    else:
+                        row = {'id': next(self._ids), 'created_at': ssb.datetime.now(ssb.timezone.utc).isoformat(), **value}
+                        self.tables[query.table].append(row)
+                        written.append(dict(row))
+                return StubResponse(written)
+            if query.action == 'update':
+                rows = self._rows(query)
+                for row in rows:
+                    row.update(query.values)
+                return StubResponse([dict(r) for r in rows])
+            if query.action == 'delete':
+                rows = self._rows(query)
+                self.tables[query.table] = [r for r in self.tables[query.table] if r not in rows]
+                return StubResponse([dict(r) for r in rows])
+        raise ValueError(f"Unsupported action {query.action}")
+
+    def _rpc(self, name: str, params: dict) -> StubResponse:
+        self.calls[f"rpc:{name}"] += 1
+        time.sleep(self.latency.sample())
+        with self._lock:
+            if name == 'increment_user_messages':
+                for row in self.tables['users']:
+                    if row.get('telegram_id') == params.get('p_user_id'):
+                        row['messages_today'] = row.get('messages_today', 0) + 1
+                return StubResponse(None)
+            if name == 'enqueue_premium_job':
+                if any(r.get('idempotency_key') == params['p_idempotency_key'] for r in self.tables['premium_jobs']):
+                    return StubResponse([])
+                user = next((r for r in self.tables['users'] if r.get('telegram_id') == params['p_user_id']), None)
+                if user is None or user.get('gems', 0) < params['p_gem_cost']:
+                    raise Exception(f"User {params['p_user_id']} cannot cover {params['p_gem_cost']} gems")
+                user['pending_gem_refund'], user['gems'] = user['gems'], user['gems'] - params['p_gem_cost']
+                row = {'id': next(self._ids), 'created_at': ssb.datetime.now(ssb.timezone.utc).isoformat(),
+                       'idempotency_key': params['p_idempotency_key'], 'user_id': params['p_user_id'],
+                       'job_type': params['p_job_type'], 'gem_cost': params['p_gem_cost'], 'payload': params['p_payload'],
+                       'status': 'queued', 'attempts': 0, 'claimed_by': params['p_claimed_by']}
+                self.tables['premium_jobs'].append(row)
+                return StubResponse([dict(row)])
+            if name == 'credit_user_gems':
+                for row in self.tables['users']:
+                    if row.get('telegram_id') == params.get('p_user_id'):
+                        row['gems'] = row.get('gems', 0) + params['p_amount']
+                        return StubResponse(row['gems'])
+                return StubResponse(None)
+        return StubResponse([])
+
+    def seed_user(self, user_id: int, **fields):
+        now = ssb.datetime.now(ssb.timezone.utc).isoformat()
+        self.tables['users'].append({
+            'id': next(self._ids), 'telegram_id': user_id, 'username': f"load{user_id}", 'gems': ssb.WELCOME_GEMS_BONUS,
+            'user_name': None, 'messages_today': 0, 'last_message_date': now, 'age_verified': False, 'last_seen': now,
+            **fields,
+        })
+
+
+def make_stub_providers(kobold_latency: Latency, kobold_tokens_per_second: float, image_latency: Latency,
+                        tts_latency: Latency, video_latency: Latency):
+    """Build stub subclasses of the provider classes, bound to the given delays."""
+
+    class StubKobold(ssb.KoboldAPI):
+        async def start_session(self):
+            pass
+
+        async def close_session(self):
+            pass
+
+        async def check_availability(self) -> bool:
+            return True
+
+        async def _generate(self, prompt, max_tokens, start_time):
+            await asyncio.sleep(kobold_latency.sample() + max_tokens / kobold_tokens_per_second)
+            return random.choice(STUB_REPLIES)
+
+        async def generate_stream(self, prompt, max_tokens=100):
+            async with self._semaphore:
+                await asyncio.sleep(kobold_latency.sample())
+                for word in random.choice(STUB_REPLIES).replace('*', '').split(' '):
+                    await asyncio.sleep(1 / kobold_tokens_per_second)
+                    yield word + ' '
+
+    class StubImageGenerator(ssb.ImageGenerator):
+        def __init__(self, api_token, kobold_api):
+            super().__init__('', kobold_api)
+
+        async def generate_final_image(self, user_session, user_message=None):
+            await asyncio.sleep(image_latency.sample())
+            return f"https://stub.local/images/{random.getrandbits(48):x}.png"
+
+    class StubVideoGenerator(ssb.VideoGenerator):
+        def __init__(self, api_token):
+            super().__init__('stub')
+            self._ready_at = {}
+
+        async def start_session(self):
+            pass
+
+        async def close_session(self):
+            pass
+
+        async def submit_video_task(self, image_url, prompt, lora_url=None):
+            task_id = f"stub-{random.getrandbits(48):x}"
+            self._ready_at[task_id] = time.monotonic() + video_latency.sample()
+            return task_id
+
+        async def get_video_status(self, task_id):
+            if time.monotonic() >= self._ready_at.get(task_id, 0):
+                return 'completed', f"https://stub.local/videos/{task_id}.mp4"
+            return 'processing', None
+
+    class StubElevenLabsManager(ssb.ElevenLabsManager):
+        def __init__(self, api_key):
+            super().__init__('')
+
+        async def start_session(self):
+            pass
+
+        async def close_session(self):
+            pass
+
+        async def create_voice_note_from_sentences(self, sentences, voice_id):
+            async for _ in sentences:
+                pass
+            await asyncio.sleep(tts_latency.sample())
+            return b'ID3' + bytes(4096)
+
+    class StubVoiceEncoder(ssb.VoiceEncoder):
+        async def encode(self, mp3_bytes):
+            return ssb.EncodedVoiceNote(mp3_bytes, 'ogg', 4)
+
+    return {
+        'KoboldAPI': StubKobold,
+        'ImageGenerator': StubImageGenerator,
+        'VideoGenerator': StubVideoGenerator,
+        'ElevenLabsManager': StubElevenLabsManager,
+        'VoiceEncoder': StubVoiceEncoder,
+    }
+
+
+def install_stub_providers(supabase_stub: StubSupabase, providers: dict):
+    """Point secret_share_bot at the stubs; call before build_application()."""
+    ssb.supabase = supabase_stub
+    for name, cls in providers.items():
+        setattr(ssb, name, cls)
+    # Free-image blurring downloads through Replicate; the harness sends the original instead
+    ssb.blur_image_with_replicate = lambda image_url, blur_scale=1000: None
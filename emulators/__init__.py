@@ -0,0 +1,35 @@
+"""Local stand-ins for the bot's paid providers, for offline performance work.
+
+Run them all with `python -m emulators` and export the printed variables before
+starting the bot; no code changes are needed:
+
+    KOBOLD_URL            KoboldCPP generate, model and SSE stream   (emulators.kobold)
+    SUPABASE_URL          PostgREST tables and RPCs in memory        (emulators.postgrest)
+    REPLICATE_BASE_URL    Replicate predictions and output files     (emulators.replicate)
+    WAVESPEED_BASE_URL    Wavespeed video submit and result polling  (emulators.wavespeed)
+    ELEVENLABS_BASE_URL   ElevenLabs TTS and convai phone calls      (emulators.elevenlabs)
+
+Latency, token rate, error rate and 429 behaviour are set per service with the
+EMULATOR_<SERVICE>_* variables described in emulators.faults. Every emulator
+reports its request, error and throttle counts at GET /_emulator/stats.
+"""
+from .faults import FaultProfile
+
+SERVICES = ('kobold', 'supabase', 'replicate', 'wavespeed', 'elevenlabs')
+
+
+def create_app(service: str, profile: FaultProfile = None):
+    """Build the aiohttp application for one service."""
+    if service == 'kobold':
+        from .kobold import create_app
+    elif service == 'supabase':
+        from .postgrest import create_app
+    elif service == 'replicate':
+        from .replicate import create_app
+    elif service == 'wavespeed':
+        from .wavespeed import create_app
+    elif service == 'elevenlabs':
+        from .elevenlabs import create_app
+    else:
+        raise ValueError(f"Unknown service {service!r}, expected one of {', '.join(SERVICES)}")
+    return create_app(profile or FaultProfile.from_env(service))
@@ -0,0 +1,84 @@
+"""Start the provider emulators on consecutive ports and print the bot's env settings.
+
+    python -m emulators [--only kobold,supabase] [--host 127.0.0.1] [--base-port 9100]
+
+Prints shell `export` lines; `eval "$(python -m emulators --print-env)"` sets
+them without starting anything.
+"""
+import argparse
+import asyncio
+import logging
+
+from aiohttp import web
+
+from . import SERVICES, create_app
+
+# A JWT-shaped placeholder; the supabase client rejects keys that don't look like one
+EMULATOR_SUPABASE_KEY = 'ZW11bGF0b3I.ZW11bGF0b3I.ZW11bGF0b3I'
+
+
+def service_env(service: str, base_url: str) -> dict:
+    if service == 'kobold':
+        return {'KOBOLD_URL': f"{base_url}/api/v1/generate"}
+    if service == 'supabase':
+        return {'SUPABASE_URL': base_url, 'SUPABASE_SERVICE_ROLE_KEY': EMULATOR_SUPABASE_KEY}
+    if service == 'replicate':
+        return {'REPLICATE_BASE_URL': base_url, 'REPLICATE_API_TOKEN': 'r8_emulator'}
+    if service == 'wavespeed':
+        return {'WAVESPEED_BASE_URL': f"{base_url}/api/v3", 'WAVESPEED_API_TOKEN': 'emulator'}
+    if service == 'elevenlabs':
+        return {'ELEVENLABS_BASE_URL': base_url, 'ELEVENLABS_API_KEY': 'emulator'}
+    return {}
+
+
+def plan(services, host: str, base_port: int) -> list:
+    """(service, port, env) for each selected service, on ports in SERVICES order."""
+    return [
+        (service, base_port + SERVICES.index(service), service_env(service, f"http://{host}:{base_port + SERVICES.index(service)}"))
+        for service in services
+    ]
+
+
+async def serve(services, host: str, base_port: int):
+    runners = []
+    try:
+        for service, port, _ in plan(services, host, base_port):
+            runner = web.AppRunner(create_app(service), access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, host, port).start()
+            runners.append(runner)
+            logging.info("%s emulator listening on http://%s:%d", service, host, port)
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', default=','.join(SERVICES), help=f"comma-separated subset of {','.join(SERVICES)}")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--base-port', type=int, default=9100)
+    parser.add_argument('--print-env', action='store_true', help='print the export lines and exit')
+    args = parser.parse_args()
+
+    services = [s.strip() for s in args.only.split(',') if s.strip()]
+    unknown = set(services) - set(SERVICES)
+    if unknown:
+        parser.error(f"unknown service(s): {', '.join(sorted(unknown))}")
+
+    for _, _, env in plan(services, args.host, args.base_port):
+        for name, value in env.items():
+            print(f"export {name}={value}")
+    if args.print_env:
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(serve(services, args.host, args.base_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
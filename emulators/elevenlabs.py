@@ -0,0 +1,128 @@
+"""ElevenLabs: voices, text-to-speech (plain and streamed) and the convai phone call endpoints.
+
+Speech is silent MP3 (valid MPEG-1 Layer III frames, so ffmpeg can transcode
+it) lasting about as long as the text would take to say. The stream is paced
+by the token rate, read as characters synthesised per second. Calls stay
+"in-progress" for job_seconds and then report "done".
+"""
+import asyncio
+import math
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+from .faults import FaultProfile, json_error, make_app, read_json
+
+# One silent 128 kbps / 44.1 kHz mono frame: 417 bytes, 1152 samples
+MP3_FRAME = bytes.fromhex('fffb90c4') + bytes(413)
+MP3_FRAME_SECONDS = 1152 / 44100
+SPOKEN_CHARS_PER_SECOND = 15
+
+VOICES = [
+    {'voice_id': 'emulator-voice-1', 'name': 'Emulator One', 'category': 'premade', 'labels': {}},
+    {'voice_id': 'emulator-voice-2', 'name': 'Emulator Two', 'category': 'premade', 'labels': {}},
+]
+PHONE_NUMBERS = [
+    {'phone_number': '+15550100000', 'provider': 'twilio', 'label': 'Emulator', 'phone_number_id': 'phnum_emulator', 'id': 'phnum_emulator'},
+]
+
+
+def _speech_frames(text: str) -> int:
+    return max(1, math.ceil(len(text) / SPOKEN_CHARS_PER_SECOND / MP3_FRAME_SECONDS))
+
+
+async def handle_voices(request: web.Request) -> web.Response:
+    return web.json_response({'voices': VOICES})
+
+
+async def handle_tts(request: web.Request) -> web.Response:
+    profile: FaultProfile = request.app['profile']
+    body = await read_json(request) or {}
+    text = body.get('text') or ''
+    if not text.strip():
+        return json_error(422, 'text must not be empty')
+    await asyncio.sleep(profile.token_delay(len(text)))
+    return web.Response(body=MP3_FRAME * _speech_frames(text), content_type='audio/mpeg')
+
+
+async def handle_tts_stream(request: web.Request) -> web.StreamResponse:
+    profile: FaultProfile = request.app['profile']
+    body = await read_json(request) or {}
+    text = body.get('text') or ''
+    if not text.strip():
+        return json_error(422, 'text must not be empty')
+    response = web.StreamResponse(headers={'Content-Type': 'audio/mpeg'})
+    await response.prepare(request)
+    frames = _speech_frames(text)
+    chunks = max(1, min(frames, len(text) // 20))
+    per_chunk = math.ceil(frames / chunks)
+    for start in range(0, frames, per_chunk):
+        count = min(per_chunk, frames - start)
+        await asyncio.sleep(profile.token_delay(len(text)) / chunks)
+        await response.write(MP3_FRAME * count)
+    await response.write_eof()
+    return response
+
+
+async def handle_phone_numbers(request: web.Request) -> web.Response:
+    return web.json_response(PHONE_NUMBERS)
+
+
+async def handle_outbound_call(request: web.Request) -> web.Response:
+    profile: FaultProfile = request.app['profile']
+    body = await read_json(request) or {}
+    if not body.get('agent_id') or not body.get('to_number'):
+        return json_error(422, 'agent_id and to_number are required')
+    conversation_id = f"conv_{uuid.uuid4().hex[:24]}"
+    call_sid = f"CA{uuid.uuid4().hex}"
+    call = {
+        'conversation_id': conversation_id,
+        'agent_id': body['agent_id'],
+        'to_number': body['to_number'],
+        'started': time.time(),
+        'duration': profile.job_seconds * random.uniform(0.5, 1.5),
+        'terminated': False,
+    }
+    request.app['calls'][conversation_id] = request.app['calls'][call_sid] = call
+    return web.json_response({'success': True, 'message': 'Call initiated', 'conversation_id': conversation_id, 'callSid': call_sid})
+
+
+def _call_status(call: dict) -> dict:
+    elapsed = time.time() - call['started']
+    done = call['terminated'] or elapsed >= call['duration']
+    return {
+        'conversation_id': call['conversation_id'],
+        'agent_id': call['agent_id'],
+        'status': 'done' if done else 'in-progress',
+        'metadata': {'start_time_unix_secs': int(call['started']), 'call_duration_secs': int(min(elapsed, call['duration']))},
+    }
+
+
+async def handle_call_status(request: web.Request) -> web.Response:
+    call = request.app['calls'].get(request.match_info['id'])
+    if call is None:
+        return json_error(404, 'conversation not found')
+    return web.json_response(_call_status(call))
+
+
+async def handle_terminate(request: web.Request) -> web.Response:
+    call = request.app['calls'].get(request.match_info['id'])
+    if call is None:
+        return json_error(404, 'conversation not found')
+    call['terminated'] = True
+    return web.json_response(_call_status(call))
+
+
+def create_app(profile: FaultProfile = None) -> web.Application:
+    app = make_app(profile or FaultProfile.from_env('elevenlabs'))
+    app['calls'] = {}  # conversation_id and callSid -> call
+    app.router.add_get('/v1/voices', handle_voices)
+    app.router.add_post('/v1/text-to-speech/{voice_id}', handle_tts)
+    app.router.add_post('/v1/text-to-speech/{voice_id}/stream', handle_tts_stream)
+    app.router.add_get('/v1/convai/phone-numbers', handle_phone_numbers)
+    app.router.add_post('/v1/convai/twilio/outbound-call', handle_outbound_call)
+    app.router.add_get('/v1/convai/calls/{id}', handle_call_status)
+    app.router.add_post('/v1/convai/calls/{id}/terminate', handle_terminate)
+    return app
@@ -0,0 +1,139 @@
+"""Latency, throughput and failure settings shared by every emulator.
+
+Each service reads its own block of env vars, e.g. for Kobold:
+
+    EMULATOR_KOBOLD_LATENCY=0.4           median seconds before a response starts
+    EMULATOR_KOBOLD_LATENCY_DIST=lognormal  lognormal, exponential or fixed
+    EMULATOR_KOBOLD_LATENCY_SIGMA=0.35    spread of the lognormal distribution
+    EMULATOR_KOBOLD_ERROR_RATE=0.01       fraction of requests answered with a 500
+    EMULATOR_KOBOLD_THROTTLE_RATE=0.02    fraction of requests answered with a 429
+    EMULATOR_KOBOLD_CONCURRENCY=4         requests in flight beyond this get a 429 (0 = unlimited)
+    EMULATOR_KOBOLD_RETRY_AFTER=2         Retry-After seconds sent with every 429
+    EMULATOR_KOBOLD_TOKENS_PER_SECOND=25  generation / streaming speed (Kobold tokens, ElevenLabs characters)
+    EMULATOR_KOBOLD_JOB_SECONDS=0         render time of async jobs (Replicate predictions, Wavespeed videos)
+"""
+import asyncio
+import json
+import math
+import os
+import random
+from collections import Counter
+from dataclasses import dataclass
+
+from aiohttp import web
+
+# Defaults roughly match what production sees from each provider
+SERVICE_DEFAULTS = {
+    'kobold': {'latency': 0.4, 'tokens_per_second': 25.0},
+    'supabase': {'latency': 0.03},
+    'replicate': {'latency': 0.15, 'job_seconds': 6.0},
+    'wavespeed': {'latency': 0.2, 'job_seconds': 45.0},
+    'elevenlabs': {'latency': 0.25, 'tokens_per_second': 300.0, 'job_seconds': 120.0},
+}
+
+# Paths that are never delayed or failed: emulator bookkeeping and generated files
+EXEMPT_PREFIXES = ('/_emulator/', '/files/')
+
+
+@dataclass
+class FaultProfile:
+    service: str
+    latency: float = 0.0
+    latency_dist: str = 'lognormal'
+    latency_sigma: float = 0.35
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    concurrency: int = 0
+    retry_after: float = 1.0
+    tokens_per_second: float = 50.0
+    job_seconds: float = 0.0
+
+    @classmethod
+    def from_env(cls, service: str) -> 'FaultProfile':
+        """Defaults for the service, overridden by its EMULATOR_<SERVICE>_* variables."""
+        values = dict(SERVICE_DEFAULTS.get(service, {}))
+        prefix = f"EMULATOR_{service.upper()}_"
+        for name, field in cls.__dataclass_fields__.items():
+            if name == 'service':
+                continue
+            raw = os.getenv(prefix + name.upper())
+            if raw is not None and raw.strip():
+                values[name] = field.type(raw.strip())
+        return cls(service=service, **values)
+
+    def sample_latency(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        if self.latency_dist == 'fixed':
+            return self.latency
+        if self.latency_dist == 'exponential':
+            return random.expovariate(math.log(2) / self.latency)  # median == latency
+        return self.latency * math.exp(random.gauss(0, self.latency_sigma))
+
+    def token_delay(self, tokens: int = 1) -> float:
+        return tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+
+def json_error(status: int, message: str, **extra) -> web.Response:
+    return web.json_response({'error': message, 'message': message, **extra}, status=status)
+
+
+def fault_middleware(profile: FaultProfile):
+    """Delay every request, then fail or throttle a share of them before the handler runs."""
+    in_flight = 0
+
+    @web.middleware
+    async def middleware(request: web.Request, handler):
+        nonlocal in_flight
+        stats: Counter = request.app['stats']
+        if request.path.startswith(EXEMPT_PREFIXES):
+            return await handler(request)
+        stats['requests'] += 1
+        if profile.concurrency and in_flight >= profile.concurrency:
+            stats['throttled'] += 1
+            return throttled(profile)
+        in_flight += 1
+        try:
+            await asyncio.sleep(profile.sample_latency())
+            roll = random.random()
+            if roll < profile.throttle_rate:
+                stats['throttled'] += 1
+                return throttled(profile)
+            if roll < profile.throttle_rate + profile.error_rate:
+                stats['errors'] += 1
+                return json_error(500, f"{profile.service} emulator: injected failure")
+            return await handler(request)
+        finally:
+            in_flight -= 1
+
+    return middleware
+
+
+def throttled(profile: FaultProfile) -> web.Response:
+    response = json_error(429, f"{profile.service} emulator: rate limit exceeded")
+    response.headers['Retry-After'] = f"{profile.retry_after:g}"
+    return response
+
+
+async def handle_stats(request: web.Request) -> web.Response:
+    profile: FaultProfile = request.app['profile']
+    return web.json_response({'service': profile.service, 'profile': profile.__dict__, 'stats': dict(request.app['stats'])})
+
+
+def make_app(profile: FaultProfile) -> web.Application:
+    """A bare application with the fault middleware and a /_emulator/stats endpoint."""
+    app = web.Application(middlewares=[fault_middleware(profile)], client_max_size=16 * 1024 * 1024)
+    app['profile'] = profile
+    app['stats'] = Counter()
+    app.router.add_get('/_emulator/stats', handle_stats)
+    return app
+
+
+async def read_json(request: web.Request):
+    body = await request.read()
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text='invalid JSON body')
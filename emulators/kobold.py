@@ -0,0 +1,61 @@
+"""KoboldCPP: /api/v1/generate, /api/v1/model and the SSE stream at /api/extra/generate/stream.
+
+Replies are picked from a small set of in-character lines and cut to max_length
+tokens. Generation takes one token delay per word, so the token rate controls
+how long a slot stays busy just like a real GPU.
+"""
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+from .faults import FaultProfile, make_app, read_json
+
+MODEL_NAME = 'koboldcpp/emulator-13b'
+
+REPLIES = [
+    "*I bite my lip and lean a little closer.* I was hoping you'd say that. Tell me more?",
+    "*I laugh softly, brushing my hair over my shoulder.* You always know how to make me smile.",
+    "*I tilt my head, studying you for a moment.* Mmm, and what would you do if I said yes?",
+    "*I trace a slow circle on the table with my finger.* Stay a little longer with me tonight.",
+    "*I pull my knees up onto the couch and grin at you.* Okay, your turn. What was the best part of your day?",
+]
+
+
+def _reply_tokens(payload: dict) -> list:
+    words = random.choice(REPLIES).split(' ')
+    max_length = int(payload.get('max_length') or 100)
+    return [word + ' ' for word in words[:max_length]]
+
+
+async def handle_model(request: web.Request) -> web.Response:
+    return web.json_response({'result': MODEL_NAME})
+
+
+async def handle_generate(request: web.Request) -> web.Response:
+    profile: FaultProfile = request.app['profile']
+    payload = await read_json(request) or {}
+    tokens = _reply_tokens(payload)
+    await asyncio.sleep(profile.token_delay(len(tokens)))
+    return web.json_response({'results': [{'text': ''.join(tokens).strip()}]})
+
+
+async def handle_stream(request: web.Request) -> web.StreamResponse:
+    profile: FaultProfile = request.app['profile']
+    payload = await read_json(request) or {}
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+    for token in _reply_tokens(payload):
+        await asyncio.sleep(profile.token_delay())
+        await response.write(f"event: message\ndata: {json.dumps({'token': token})}\n\n".encode())
+    await response.write_eof()
+    return response
+
+
+def create_app(profile: FaultProfile = None) -> web.Application:
+    app = make_app(profile or FaultProfile.from_env('kobold'))
+    app.router.add_get('/api/v1/model', handle_model)
+    app.router.add_post('/api/v1/generate', handle_generate)
+    app.router.add_post('/api/extra/generate/stream', handle_stream)
+    return app
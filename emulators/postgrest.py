@@ -0,0 +1,414 @@
+"""Supabase PostgREST: /rest/v1/<table> and /rest/v1/rpc/<function>, held in memory.
+
+Supports what the supabase client sends for the bot's queries: select with column
+lists, eq/neq/gt/gte/lt/lte/like/ilike/is/in filters and their not. forms, or=(...),
+order, limit and offset, single() (406 unless exactly one row), inserts that fail
+with 23505 on a duplicate unique key, and upserts with on_conflict and
+resolution=merge-duplicates/ignore-duplicates. Tables are created on first use;
+the unique key of each table the bot writes matches Database/*.sql.
+"""
+import itertools
+import json
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+from .faults import FaultProfile, make_app, read_json
+
+UNIQUE_KEYS = {
+    'users': 'telegram_id',
+    'bot_state': 'key',
+    'video_tasks': 'task_id',
+    'premium_jobs': 'idempotency_key',
+    'processed_payments': 'telegram_charge_id',
+    'star_earnings': 'telegram_charge_id',
+    'voice_calls': 'call_id',
+    'broadcast_runs': 'run_key',
+    'subscriptions': 'user_id',
+}
+
+COLUMN_DEFAULTS = {
+    'users': {'gems': 0, 'messages_today': 0, 'total_messages': 0, 'age_verified': False, 'user_name': None,
+              'session_data': None, 'pending_gem_refund': None, 'subscription_type': None,
+              'last_reengaged_at': None, 'bot_blocked_at': None},
+    'premium_jobs': {'gem_cost': 0, 'payload': {}, 'status': 'queued', 'attempts': 0, 'last_error': None,
+                     'claimed_by': None, 'lease_until': None},
+    'video_tasks': {'gem_cost': 0, 'status': 'pending', 'claimed_by': None, 'lease_until': None},
+    'bot_state': {'expires_at': None},
+}
+
+RESERVED_PARAMS = {'select', 'order', 'limit', 'offset', 'on_conflict', 'columns'}
+TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}')
+
+
+class RpcError(Exception):
+    """RAISE EXCEPTION inside a function; PostgREST answers 400 with code P0001."""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _comparable(value):
+    if isinstance(value, str) and TIMESTAMP.match(value):
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        except ValueError:
+            return value
+    return value
+
+
+def _cast(operand: str, like):
+    """Read a filter operand as the type of the stored value it is compared with."""
+    if isinstance(like, bool):
+        return operand.lower() == 'true'
+    if isinstance(like, (int, float)):
+        try:
+            return type(like)(operand) if isinstance(like, int) and operand.lstrip('-').isdigit() else float(operand)
+        except ValueError:
+            return operand
+    return _comparable(operand.strip('"'))
+
+
+def _split_top_level(text: str) -> List[str]:
+    """Split on commas that are not inside parentheses or double quotes."""
+    parts, depth, quoted, current = [], 0, False, ''
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == '(':
+            depth += 1
+        elif not quoted and char == ')':
+            depth -= 1
+        if char == ',' and depth == 0 and not quoted:
+            parts.append(current)
+            current = ''
+        else:
+            current += char
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _like(pattern: str, case_sensitive: bool) -> Callable[[str], bool]:
+    regex = '^' + ''.join('.*' if c in '%*' else '.' if c == '_' else re.escape(c) for c in pattern) + '$'
+    compiled = re.compile(regex, 0 if case_sensitive else re.IGNORECASE)
+    return lambda value: value is not None and compiled.match(str(value)) is not None
+
+
+def parse_condition(column: str, expression: str) -> Callable[[dict], bool]:
+    """Build a row predicate from a PostgREST filter such as "gte.5" or "not.in.(a,b)"."""
+    negate = expression.startswith('not.')
+    if negate:
+        expression = expression[4:]
+    op, _, operand = expression.partition('.')
+
+    if op == 'is':
+        wanted = {'null': None, 'true': True, 'false': False}.get(operand.lower(), operand)
+        test = lambda row: row.get(column) is wanted
+    elif op == 'in':
+        values = [v.strip().strip('"') for v in _split_top_level(operand.strip('()'))]
+        test = lambda row: row.get(column) is not None and any(row.get(column) == _cast(v, row.get(column)) for v in values)
+    elif op in ('like', 'ilike'):
+        matcher = _like(operand, op == 'like')
+        test = lambda row: matcher(row.get(column))
+    elif op in ('eq', 'neq', 'gt', 'gte', 'lt', 'lte'):
+        compare = {
+            'eq': lambda a, b: a == b, 'neq': lambda a, b: a != b,
+            'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b,
+            'lt': lambda a, b: a < b, 'lte': lambda a, b: a <= b,
+        }[op]
+
+        def test(row):
+            value = row.get(column)
+            if value is None:
+                return False
+            try:
+                return compare(_comparable(value), _cast(operand, value))
+            except TypeError:
+                return compare(str(value), operand)
+    else:
+        raise web.HTTPBadRequest(text=json.dumps({'code': 'PGRST100', 'message': f"unsupported operator {op}"}),
+                                 content_type='application/json')
+    return (lambda row: not test(row)) if negate else test
+
+
+def parse_filters(request: web.Request) -> List[Callable[[dict], bool]]:
+    filters = []
+    for key, value in request.query.items():
+        if key in RESERVED_PARAMS:
+            continue
+        if key in ('or', 'and'):
+            conditions = []
+            for part in _split_top_level(value.strip()[1:-1]):
+                column, _, expression = part.partition('.')
+                conditions.append(parse_condition(column, expression))
+            combine = any if key == 'or' else all
+            filters.append(lambda row, conditions=conditions, combine=combine: combine(c(row) for c in conditions))
+        else:
+            filters.append(parse_condition(key, value))
+    return filters
+
+
+def _prefer(request: web.Request) -> Dict[str, str]:
+    prefs = {}
+    for item in request.headers.get('Prefer', '').split(','):
+        key, _, value = item.strip().partition('=')
+        if key:
+            prefs[key] = value
+    return prefs
+
+
+def _project(rows: List[dict], select: str) -> List[dict]:
+    columns = [c.strip() for c in select.split(',') if c.strip()]
+    if not columns or '*' in columns:
+        return [dict(row) for row in rows]
+    return [{c: row.get(c) for c in columns} for row in rows]
+
+
+def _order(rows: List[dict], order: str) -> List[dict]:
+    # Apply keys right to left so the first one wins; nulls sort last ascending, first descending (PostgreSQL default)
+    for spec in reversed(order.split(',')):
+        column, *modifiers = spec.strip().split('.')
+        desc = 'desc' in modifiers
+        nulls_first = 'nullsfirst' in modifiers or (desc and 'nullslast' not in modifiers)
+        present = [r for r in rows if r.get(column) is not None]
+        missing = [r for r in rows if r.get(column) is None]
+        present.sort(key=lambda r: _comparable(r.get(column)), reverse=desc)
+        rows = missing + present if nulls_first else present + missing
+    return rows
+
+
+class PostgrestStore:
+    """In-memory tables plus the RPCs the bot calls."""
+
+    def __init__(self):
+        self.tables: Dict[str, List[dict]] = defaultdict(list)
+        self._ids = itertools.count(1)
+        self.rpcs: Dict[str, Callable[[dict], object]] = {
+            'increment_user_messages': self.increment_user_messages,
+            'purge_expired_bot_state': self.purge_expired_bot_state,
+            'get_reengagement_candidates': self.get_reengagement_candidates,
+            'get_total_earnings': self.get_total_earnings,
+            'get_earnings_period': self.get_earnings_period,
+            'enqueue_premium_job': self.enqueue_premium_job,
+            'claim_premium_jobs': self.claim_premium_jobs,
+            'credit_user_gems': self.credit_user_gems,
+            'claim_video_tasks': self.claim_video_tasks,
+        }
+
+    def new_row(self, table: str, values: dict) -> dict:
+        now = _now()
+        row = {'id': next(self._ids), 'created_at': now, 'updated_at': now, **COLUMN_DEFAULTS.get(table, {}), **values}
+        self.tables[table].append(row)
+        return row
+
+    def find(self, table: str, key: Optional[str], value) -> Optional[dict]:
+        if not key or value is None:
+            return None
+        return next((row for row in self.tables[table] if row.get(key) == value), None)
+
+    def increment_user_messages(self, params: dict):
+        now = _now()
+        for row in self.tables['users']:
+            if row.get('telegram_id') == params.get('p_user_id'):
+                row['messages_today'] = (row.get('messages_today') or 0) + 1
+                row['total_messages'] = (row.get('total_messages') or 0) + 1
+                row['last_message_date'] = row['last_seen'] = now
+        return None
+
+    def purge_expired_bot_state(self, params: dict) -> int:
+        now = datetime.now(timezone.utc)
+        rows = self.tables['bot_state']
+        kept = [r for r in rows if not r.get('expires_at') or _comparable(r['expires_at']) >= now]
+        self.tables['bot_state'] = kept
+        return len(rows) - len(kept)
+
+    def get_reengagement_candidates(self, params: dict) -> List[dict]:
+        inactive_before = _comparable(params['p_inactive_before'])
+        cooldown_before = _comparable(params['p_cooldown_before'])
+        cursor = _comparable(params.get('p_after_last_seen'))
+        candidates = []
+        for row in self.tables['users']:
+            last_seen = _comparable(row.get('last_seen'))
+            if last_seen is None or last_seen >= inactive_before:
+                continue
+            if cursor is not None and (last_seen, row['telegram_id']) <= (cursor, params.get('p_after_telegram_id') or 0):
+                continue
+            blocked = _comparable(row.get('bot_blocked_at'))
+            if blocked is not None and blocked >= last_seen:
+                continue
+            nudged = _comparable(row.get('last_reengaged_at'))
+            if nudged is not None and nudged >= last_seen and nudged >= cooldown_before:
+                continue
+            candidates.append({'telegram_id': row['telegram_id'], 'last_seen': row['last_seen']})
+        candidates.sort(key=lambda r: (_comparable(r['last_seen']), r['telegram_id']))
+        return candidates[:params.get('p_limit') or len(candidates)]
+
+    def _lease_until(self, params: dict) -> str:
+        return (datetime.now(timezone.utc) + timedelta(seconds=params.get('p_lease_seconds') or 0)).isoformat()
+
+    def enqueue_premium_job(self, params: dict) -> List[dict]:
+        if self.find('premium_jobs', 'idempotency_key', params['p_idempotency_key']) is not None:
+            return []
+        user = self.find('users', 'telegram_id', params['p_user_id'])
+        if user is None or (user.get('gems') or 0) < params['p_gem_cost']:
+            raise RpcError(f"User {params['p_user_id']} cannot cover {params['p_gem_cost']} gems")
+        user['pending_gem_refund'] = user['gems']
+        user['gems'] -= params['p_gem_cost']
+        return [self.new_row('premium_jobs', {
+            'idempotency_key': params['p_idempotency_key'], 'user_id': params['p_user_id'],
+            'job_type': params['p_job_type'], 'gem_cost': params['p_gem_cost'], 'payload': params.get('p_payload') or {},
+            'claimed_by': params['p_claimed_by'], 'lease_until': self._lease_until(params),
+        })]
+
+    def claim_premium_jobs(self, params: dict) -> List[dict]:
+        now = datetime.now(timezone.utc)
+        claimed = []
+        for row in sorted(self.tables['premium_jobs'], key=lambda r: _comparable(r['created_at'])):
+            lease = _comparable(row.get('lease_until'))
+            if row.get('status') in ('queued', 'running') and (lease is None or lease < now):
+                row.update(status='running', claimed_by=params['p_claimed_by'], lease_until=self._lease_until(params),
+                           updated_at=_now())
+                claimed.append(row)
+        return claimed
+
+    def claim_video_tasks(self, params: dict) -> List[dict]:
+        now = datetime.now(timezone.utc)
+        claimed = []
+        for row in self.tables['video_tasks']:
+            lease = _comparable(row.get('lease_until'))
+            if row.get('status') in ('pending', 'delivering') and (row.get('claimed_by') == params['p_claimed_by'] or lease is None or lease < now):
+                row.update(claimed_by=params['p_claimed_by'], lease_until=self._lease_until(params))
+                claimed.append({k: row.get(k) for k in ('task_id', 'user_id', 'gem_cost', 'status', 'video_url', 'created_at')})
+        return claimed
+
+    def credit_user_gems(self, params: dict) -> Optional[int]:
+        user = self.find('users', 'telegram_id', params['p_user_id'])
+        if user is None:
+            return None
+        user['gems'] = (user.get('gems') or 0) + params['p_amount']
+        return user['gems']
+
+    def _earnings(self, since: Optional[datetime] = None) -> dict:
+        rows = [r for r in self.tables['star_earnings'] if since is None or _comparable(r.get('created_at')) >= since]
+        stars = [r.get('stars_amount') or 0 for r in rows]
+        return {
+            'total_stars': sum(stars),
+            'total_transactions': len(rows),
+            'customers': len({r.get('user_id') for r in rows}),
+            'gems_revenue': sum(r.get('stars_amount') or 0 for r in rows if r.get('payment_type') == 'gems'),
+            'subscription_revenue': sum(r.get('stars_amount') or 0 for r in rows if r.get('payment_type') == 'subscription'),
+            'avg': sum(stars) / len(stars) if stars else 0,
+        }
+
+    def get_total_earnings(self, params: dict) -> List[dict]:
+        e = self._earnings()
+        return [{'total_stars': e['total_stars'], 'total_transactions': e['total_transactions'], 'total_customers': e['customers'],
+                 'gems_revenue': e['gems_revenue'], 'subscription_revenue': e['subscription_revenue']}]
+
+    def get_earnings_period(self, params: dict) -> List[dict]:
+        e = self._earnings(datetime.now(timezone.utc) - timedelta(days=params.get('period_days', 30)))
+        return [{'total_stars': e['total_stars'], 'total_transactions': e['total_transactions'],
+                 'unique_customers': e['customers'], 'avg_transaction_value': e['avg']}]
+
+
+def _conflict(table: str, key: str, value) -> web.Response:
+    return web.json_response({
+        'code': '23505',
+        'details': f"Key ({key})=({value}) already exists.",
+        'hint': None,
+        'message': f'duplicate key value violates unique constraint "{table}_{key}_key"',
+    }, status=409)
+
+
+def _respond(request: web.Request, rows: List[dict], status: int = 200) -> web.Response:
+    if request.method != 'GET' and _prefer(request).get('return') != 'representation':
+        return web.Response(status=204 if status == 200 else status)
+    rows = _project(rows, request.query.get('select', '*'))
+    if 'vnd.pgrst.object' in request.headers.get('Accept', ''):
+        if len(rows) != 1:
+            return web.json_response({
+                'code': 'PGRST116',
+                'details': f"The result contains {len(rows)} rows",
+                'hint': None,
+                'message': 'JSON object requested, multiple (or no) rows returned',
+            }, status=406)
+        return web.json_response(rows[0], status=status)
+    return web.json_response(rows, status=status)
+
+
+async def handle_table(request: web.Request) -> web.Response:
+    store: PostgrestStore = request.app['store']
+    table = request.match_info['table']
+    rows = store.tables[table]
+
+    if request.method == 'GET':
+        matched = [r for r in rows if all(f(r) for f in parse_filters(request))]
+        if 'order' in request.query:
+            matched = _order(matched, request.query['order'])
+        offset = int(request.query.get('offset', 0))
+        limit = request.query.get('limit')
+        matched = matched[offset:offset + int(limit) if limit is not None else None]
+        return _respond(request, matched)
+
+    if request.method == 'POST':
+        body = await read_json(request)
+        values = body if isinstance(body, list) else [body or {}]
+        prefer = _prefer(request)
+        resolution = prefer.get('resolution')
+        key = request.query.get('on_conflict') or UNIQUE_KEYS.get(table)
+        written = []
+        for value in values:
+            existing = store.find(table, key, value.get(key) if key else None)
+            if existing is not None:
+                if resolution == 'ignore-duplicates':
+                    continue
+                if resolution != 'merge-duplicates':
+                    return _conflict(table, key, value.get(key))
+                existing.update(value)
+                existing['updated_at'] = value.get('updated_at', _now())
+                written.append(existing)
+            else:
+                written.append(store.new_row(table, value))
+        return _respond(request, written, status=201)
+
+    matched = [r for r in rows if all(f(r) for f in parse_filters(request))]
+    if request.method == 'PATCH':
+        values = await read_json(request) or {}
+        for row in matched:
+            row.update(values)
+        return _respond(request, matched)
+    if request.method == 'DELETE':
+        ids = {id(r) for r in matched}
+        store.tables[table] = [r for r in rows if id(r) not in ids]
+        return _respond(request, matched)
+    raise web.HTTPMethodNotAllowed(request.method, ['GET', 'POST', 'PATCH', 'DELETE'])
+
+
+async def handle_rpc(request: web.Request) -> web.Response:
+    store: PostgrestStore = request.app['store']
+    name = request.match_info['function']
+    function = store.rpcs.get(name)
+    if function is None:
+        return web.json_response({'code': 'PGRST202', 'hint': None, 'details': None,
+                                  'message': f"Could not find the function public.{name} in the schema cache"}, status=404)
+    try:
+        result = function(await read_json(request) or {})
+    except RpcError as e:
+        return web.json_response({'code': 'P0001', 'hint': None, 'details': None, 'message': str(e)}, status=400)
+    if result is None:
+        return web.Response(status=204)
+    return web.json_response(result)
+
+
+def create_app(profile: FaultProfile = None, store: PostgrestStore = None) -> web.Application:
+    app = make_app(profile or FaultProfile.from_env('supabase'))
+    app['store'] = store or PostgrestStore()
+    app.router.add_post('/rest/v1/rpc/{function}', handle_rpc)
+    app.router.add_route('*', '/rest/v1/{table}', handle_table)
+    return app
@@ -0,0 +1,157 @@
+"""Replicate: predictions by version or by model, version lookups and generated files.
+
+A prediction takes job_seconds to finish. Requests sent with "Prefer: wait" are
+held until it finishes (up to the requested wait), otherwise the client polls
+GET /v1/predictions/<id>. Outputs follow the shape of the models the bot runs:
+the NSFW classifier returns a label, face blurring returns one URL and the
+character LoRAs return a list of URLs. Output URLs point back at this emulator.
+"""
+import asyncio
+import base64
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+from .faults import FaultProfile, json_error, make_app, read_json
+
+# 1x1 transparent PNG, enough for anything that downloads an output
+PNG_BYTES = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=='
+)
+MAX_WAIT_SECONDS = 60
+
+# The bot runs these by version id, so the model name is not in the request
+KNOWN_VERSIONS = {
+    '97116600cabd3037e5f22ca08ffcc33b92cfacebf7ccd3609e9c1d29e43d3a8d': 'falcons-ai/nsfw_image_detection',
+    'bdcc18be6a02a8f2efce1a3f7489f74a1d6729caea9b53061358fe75c93799d2': 'kharioki/blur-faces',
+}
+OUTPUT_SCHEMA = {'components': {'schemas': {'Output': {'type': 'array', 'items': {'type': 'string', 'format': 'uri'}}}}}
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+class Prediction:
+    def __init__(self, base_url: str, model: str, version: str, input: dict, job_seconds: float, failed: bool):
+        self.id = uuid.uuid4().hex[:26]
+        self.base_url = base_url
+        self.model = model
+        self.version = version
+        self.input = input
+        self.created = time.time()
+        self.ready_at = self.created + job_seconds
+        self.failed = failed
+
+    @property
+    def done(self) -> bool:
+        return time.time() >= self.ready_at
+
+    def output(self):
+        url = f"{self.base_url}/files/{self.id}.png"
+        if 'nsfw' in self.model:
+            return 'normal'
+        if 'blur' in self.model:
+            return url
+        return [url]
+
+    def to_json(self) -> dict:
+        # The client treats anything but "starting" after a Prefer: wait request as finished
+        status = ('failed' if self.failed else 'succeeded') if self.done else 'starting'
+        return {
+            'id': self.id,
+            'model': self.model,
+            'version': self.version,
+            'input': self.input,
+            'status': status,
+            'output': self.output() if status == 'succeeded' else None,
+            'error': 'emulator: injected prediction failure' if status == 'failed' else None,
+            'logs': '',
+            'metrics': {'predict_time': self.ready_at - self.created} if self.done else {},
+            'created_at': _iso(self.created),
+            'started_at': _iso(self.created),
+            'completed_at': _iso(self.ready_at) if self.done else None,
+            'urls': {
+                'get': f"{self.base_url}/v1/predictions/{self.id}",
+                'cancel': f"{self.base_url}/v1/predictions/{self.id}/cancel",
+            },
+        }
+
+
+def _wait_seconds(request: web.Request) -> float:
+    prefer = request.headers.get('Prefer', '')
+    if not prefer.startswith('wait'):
+        return 0.0
+    _, _, seconds = prefer.partition('=')
+    return min(float(seconds), MAX_WAIT_SECONDS) if seconds else MAX_WAIT_SECONDS
+
+
+async def _create(request: web.Request, model: str, version: str, body: dict) -> web.Response:
+    profile: FaultProfile = request.app['profile']
+    # A prediction that fails inside the model is reported through its status, not the HTTP code
+    prediction = Prediction(f"{request.scheme}://{request.host}", model, version, body.get('input', {}),
+                            profile.job_seconds * random.uniform(0.8, 1.2), failed=random.random() < profile.error_rate)
+    request.app['predictions'][prediction.id] = prediction
+    wait = _wait_seconds(request)
+    if wait:
+        await asyncio.sleep(max(0.0, min(prediction.ready_at - time.time(), wait)))
+    return web.json_response(prediction.to_json(), status=201)
+
+
+async def handle_create_by_version(request: web.Request) -> web.Response:
+    body = await read_json(request) or {}
+    version = body.get('version', '')
+    return await _create(request, request.app['versions'].get(version, version), version, body)
+
+
+async def handle_create_by_model(request: web.Request) -> web.Response:
+    model = f"{request.match_info['owner']}/{request.match_info['name']}"
+    return await _create(request, model, None, await read_json(request) or {})
+
+
+async def handle_get_prediction(request: web.Request) -> web.Response:
+    prediction = request.app['predictions'].get(request.match_info['id'])
+    if prediction is None:
+        return json_error(404, 'Not found.')
+    return web.json_response(prediction.to_json())
+
+
+async def handle_cancel(request: web.Request) -> web.Response:
+    prediction = request.app['predictions'].get(request.match_info['id'])
+    if prediction is None:
+        return json_error(404, 'Not found.')
+    prediction.ready_at = min(prediction.ready_at, time.time())
+    prediction.failed = True
+    return web.json_response(prediction.to_json())
+
+
+async def handle_get_version(request: web.Request) -> web.Response:
+    model = f"{request.match_info['owner']}/{request.match_info['name']}"
+    version = request.match_info['version']
+    request.app['versions'][version] = model
+    return web.json_response({
+        'id': version,
+        'created_at': _iso(0),
+        'cog_version': '0.9.0',
+        'openapi_schema': OUTPUT_SCHEMA,
+    })
+
+
+async def handle_file(request: web.Request) -> web.Response:
+    return web.Response(body=PNG_BYTES, content_type='image/png')
+
+
+def create_app(profile: FaultProfile = None) -> web.Application:
+    app = make_app(profile or FaultProfile.from_env('replicate'))
+    app['predictions'] = {}
+    app['versions'] = dict(KNOWN_VERSIONS)  # version id -> owner/name, extended by version lookups
+    app.router.add_post('/v1/predictions', handle_create_by_version)
+    app.router.add_get('/v1/predictions/{id}', handle_get_prediction)
+    app.router.add_post('/v1/predictions/{id}/cancel', handle_cancel)
+    app.router.add_post('/v1/models/{owner}/{name}/predictions', handle_create_by_model)
+    app.router.add_get('/v1/models/{owner}/{name}/versions/{version}', handle_get_version)
+    app.router.add_get('/files/{name}', handle_file)
+    return app
@@ -0,0 +1,75 @@
+"""Wavespeed: image-to-video submit on any model path and /predictions/<id>/result polling.
+
+A task reports "processing" until job_seconds have passed and then "completed"
+with one output URL served by this emulator, or "failed" for the share of tasks
+picked by the error rate.
+"""
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+from .faults import FaultProfile, json_error, make_app, read_json
+
+API_PREFIX = '/api/v3'
+
+
+class VideoTask:
+    def __init__(self, base_url: str, model: str, job_seconds: float, failed: bool):
+        self.id = uuid.uuid4().hex
+        self.base_url = base_url
+        self.model = model
+        self.created = time.time()
+        self.ready_at = self.created + job_seconds
+        self.failed = failed
+
+    def to_json(self) -> dict:
+        done = time.time() >= self.ready_at
+        status = ('failed' if self.failed else 'completed') if done else 'processing'
+        return {
+            'id': self.id,
+            'model': self.model,
+            'status': status,
+            'outputs': [f"{self.base_url}/files/{self.id}.mp4"] if status == 'completed' else [],
+            'error': 'emulator: injected render failure' if status == 'failed' else '',
+            'has_nsfw_contents': [],
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.created)),
+            'urls': {'get': f"{self.base_url}{API_PREFIX}/predictions/{self.id}/result"},
+        }
+
+
+def _envelope(data: dict) -> web.Response:
+    return web.json_response({'code': 200, 'message': 'success', 'data': data})
+
+
+async def handle_submit(request: web.Request) -> web.Response:
+    profile: FaultProfile = request.app['profile']
+    body = await read_json(request) or {}
+    if not body.get('image') or not body.get('prompt'):
+        return json_error(400, 'image and prompt are required')
+    # Render failures surface on the result endpoint, like the real service
+    task = VideoTask(f"{request.scheme}://{request.host}", request.match_info['model'],
+                     profile.job_seconds * random.uniform(0.8, 1.2), failed=random.random() < profile.error_rate)
+    request.app['tasks'][task.id] = task
+    return _envelope(task.to_json())
+
+
+async def handle_result(request: web.Request) -> web.Response:
+    task = request.app['tasks'].get(request.match_info['id'])
+    if task is None:
+        return json_error(404, 'prediction not found')
+    return _envelope(task.to_json())
+
+
+async def handle_file(request: web.Request) -> web.Response:
+    return web.Response(body=b'\x00\x00\x00\x18ftypmp42' + bytes(1024), content_type='video/mp4')
+
+
+def create_app(profile: FaultProfile = None) -> web.Application:
+    app = make_app(profile or FaultProfile.from_env('wavespeed'))
+    app['tasks'] = {}
+    app.router.add_get(f'{API_PREFIX}/predictions/{{id}}/result', handle_result)
+    app.router.add_get('/files/{name}', handle_file)
+    app.router.add_post(f'{API_PREFIX}/{{model:.+}}', handle_submit)
+    return app
@@ -9,29 +9,49 @@ New features: Voice notes, voice calls, ElevenLabs v3 integration
 import os
 import asyncio
 import json
+import hashlib
+import hmac
 import logging
+import logging.handlers
+import queue
+import atexit
 import random
 import re
 import aiohttp
+import asyncpg
 import io
+import tempfile
+import shutil
+import signal
+import contextlib
+import threading
+import bisect
+import heapq
+import itertools
+import contextvars
+from time import perf_counter, time_ns
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import string
+import unicodedata
 from datetime import datetime, timedelta, timezone, time
-from typing import Dict, Optional, List, Any
+from typing import Dict, Optional, List, Any, Tuple
 from dataclasses import dataclass, field
-from collections import OrderedDict
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
-import requests
 from aiohttp import web
-import threading
 from pathlib import Path
 
-import replicate
-import elevenlabs
-from pydub import AudioSegment
+# replicate, elevenlabs and pydub are imported where they're first used; together
+# they are most of the import time and the bot can answer /start without them
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputFile,
     InputMediaPhoto,
     PhotoSize
 )
@@ -44,227 +64,159 @@ from telegram.ext import (
     filters,
     ContextTypes,
     JobQueue,
-    PreCheckoutQueryHandler
+    PreCheckoutQueryHandler,
+    BaseRateLimiter,
+    BaseUpdateProcessor
 )
 from telegram.constants import ParseMode
 from telegram.helpers import escape_markdown
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 
 from supabase import create_client, Client
 
-# Configure logging with enhanced format for debugging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
 # Load environment variables from .env file (development) or environment (production)
+# In production, environment variables are set directly by the platform
 env_path = Path('.env')
 if env_path.exists():
-    logger.info(f"[DEBUG] Loading .env file from: {env_path.absolute()}")
     load_dotenv()
-else:
-    logger.info(f"[DEBUG] No .env file found - using environment variables (production mode)")
-    # In production, environment variables are set directly by the platform
-
-# --- CONFIGURATION ---
-BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-KOBOLD_URL = os.getenv('KOBOLD_URL', 'http://localhost:5001/api/v1/generate')
-SUPABASE_URL = os.getenv('SUPABASE_URL')
-SUPABASE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
-REPLICATE_API_TOKEN = os.getenv('REPLICATE_API_TOKEN')
-WAVESPEED_API_TOKEN = os.getenv('WAVESPEED_API_TOKEN')
-ADMIN_CHAT_ID = os.getenv('ADMIN_CHAT_ID')
-ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
-TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
-TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
-TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER')
-
-# Debug logging to check environment variables
-logger.info(f"[DEBUG] Environment variables loaded:")
-logger.info(f"[DEBUG] BOT_TOKEN: {'SET' if BOT_TOKEN else 'NOT SET'}")
-logger.info(f"[DEBUG] SUPABASE_URL: {'SET' if SUPABASE_URL else 'NOT SET'}")
-logger.info(f"[DEBUG] SUPABASE_SERVICE_ROLE_KEY: {'SET' if SUPABASE_KEY else 'NOT SET'}")
-logger.info(f"[DEBUG] REPLICATE_API_TOKEN: {'SET' if REPLICATE_API_TOKEN else 'NOT SET'}")
-logger.info(f"[DEBUG] WAVESPEED_API_TOKEN: {'SET' if WAVESPEED_API_TOKEN else 'NOT SET'}")
-logger.info(f"[DEBUG] ADMIN_CHAT_ID: {'SET' if ADMIN_CHAT_ID else 'NOT SET'}")
-logger.info(f"[DEBUG] ELEVENLABS_API_KEY: {'SET' if ELEVENLABS_API_KEY else 'NOT SET'}")
-logger.info(f"[DEBUG] TWILIO_ACCOUNT_SID: {'SET' if TWILIO_ACCOUNT_SID else 'NOT SET'}")
-logger.info(f"[DEBUG] TWILIO_AUTH_TOKEN: {'SET' if TWILIO_AUTH_TOKEN else 'NOT SET'}")
-logger.info(f"[DEBUG] TWILIO_PHONE_NUMBER: {'SET' if TWILIO_PHONE_NUMBER else 'NOT SET'}")
 
-if not all([BOT_TOKEN, SUPABASE_URL, SUPABASE_KEY, REPLICATE_API_TOKEN, WAVESPEED_API_TOKEN, ADMIN_CHAT_ID, ELEVENLABS_API_KEY]):
-    logger.error("FATAL: Missing one or more environment variables (TELEGRAM_BOT_TOKEN, SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, REPLICATE_API_TOKEN, WAVESPEED_API_TOKEN, ADMIN_CHAT_ID, ELEVENLABS_API_KEY).")
-    raise ValueError("Missing required environment variables! Check your .env file or environment settings.")
-
-# Initialize Supabase with connection recovery
-def create_supabase_client():
-    """Create a new Supabase client instance."""
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
-
-supabase: Client = create_supabase_client()
+# --- LOGGING ---
+# A category is the [TAG] prefix of a message (upper case) or a library logger name (lower case)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s'
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_CATEGORY_LEVELS = os.getenv('LOG_CATEGORY_LEVELS', 'httpx=WARNING')  # e.g. "KOBOLD=DEBUG,SUBSCRIPTION CHECK=DEBUG,httpx=WARNING"
+LOG_RATE_LIMITS = os.getenv('LOG_RATE_LIMITS', 'TYPING=30,VIDEO STATUS=60,ADMISSION=60,TRACE=120')  # max records per minute per category
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')  # e.g. "CONTEXT SHIFT=0.1" keeps 10% of those records
+LOG_FILE = os.getenv('LOG_FILE')  # optional rotating log file, written in addition to stdout
+
+def _parse_log_map(spec: str, cast) -> Dict[str, Any]:
+    """Parse "KEY=value,KEY2=value2" into a dict, skipping malformed entries."""
+    values = {}
+    for item in spec.split(','):
+        key, sep, value = item.partition('=')
+        if sep and key.strip():
+            try:
+                values[key.strip()] = cast(value.strip())
+            except ValueError:
+                pass
+    return values
 
-async def execute_with_retry(operation, *args, max_retries=3, **kwargs):
-    """Execute a Supabase operation with retry and connection recovery."""
-    global supabase
-    
-    for attempt in range(max_retries):
-        try:
-            return operation(*args, **kwargs)
-        except Exception as e:
-            error_msg = str(e).lower()
-            if attempt < max_retries - 1 and any(keyword in error_msg for keyword in ['disconnected', 'connection', 'timeout', 'network']):
-                logger.warning(f"[DB RETRY] Attempt {attempt + 1} failed: {e}. Recreating connection...")
-                # Recreate the Supabase client
-                supabase = create_supabase_client()
-                await asyncio.sleep(2 ** attempt)  # Exponential backoff
-                continue
-            else:
-                # Final attempt failed or non-connection error
-                raise e
-    return None
+class LogPolicyFilter(logging.Filter):
+    """Per-category levels, sampling and rate limits, applied before a record is queued.
 
-# Initialize ElevenLabs
+    ERROR and above are never sampled or rate limited. When a category's rate limit
+    window rolls over, the first record of the new window reports how many were dropped.
+    """
 
-# Test ElevenLabs API key
-def test_elevenlabs_key():
-    """Test the ElevenLabs API key."""
-    try:
-        # Try to get voices to test the API key using the new API
-        from elevenlabs.client import ElevenLabs
-        # Test ElevenLabs connection with new API
-        client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
-        # Test by getting voices (simpler test)
-        voices = client.voices.get_all()
-        logger.info("✅ ElevenLabs API key is valid!")
-        return True
-    except Exception as e:
-        logger.error(f"[DEBUG] ElevenLabs API key test failed: {e}")
-        return False
+    def __init__(self, default_level: int, levels: Dict[str, int], rate_limits: Dict[str, int], sample_rates: Dict[str, float]):
+        super().__init__()
+        self.default_level = default_level
+        self.levels = levels
+        self.rate_limits = rate_limits
+        self.sample_rates = sample_rates
+        self._windows: Dict[str, list] = {}  # category -> [window start, records, suppressed]
+        self._lock = threading.Lock()  # records also arrive from to_thread workers
 
-# Test the API key on startup
-if ELEVENLABS_API_KEY:
-    # Set the API key as an environment variable for ElevenLabs
-    os.environ['ELEVENLABS_API_KEY'] = ELEVENLABS_API_KEY
-    test_elevenlabs_key()
-else:
-    logger.error("[DEBUG] ElevenLabs API key is not set!")
+    @staticmethod
+    def category(record: logging.LogRecord) -> Optional[str]:
+        msg = record.msg
+        if isinstance(msg, str) and msg.startswith('['):
+            end = msg.find(']', 1, 40)
+            if end > 0:
+                return msg[1:end]
+        return None
 
-# Test phone number import
-async def test_phone_number_import():
-    """Test the phone number import functionality."""
-    try:
-        from elevenlabs.client import ElevenLabs
-        client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
-        
-        # For now, just test that the API key works
-        logger.info("✅ ElevenLabs API key is valid for phone number import!")
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = self.category(record)
+        if category is None:
+            return True  # library records were already filtered by their logger's level
+        if record.levelno < self.levels.get(category, self.default_level):
+            return False
+        if record.levelno >= logging.ERROR:
+            return True
+        rate = self.sample_rates.get(category)
+        if rate is not None and random.random() >= rate:
+            return False
+        limit = self.rate_limits.get(category)
+        if limit:
+            with self._lock:
+                window = self._windows.get(category)
+                if window is None or record.created - window[0] >= 60:
+                    suppressed = window[2] if window else 0
+                    self._windows[category] = [record.created, 1, 0]
+                elif window[1] >= limit:
+                    window[2] += 1
+                    return False
+                else:
+                    window[1] += 1
+                    suppressed = 0
+            if suppressed:
+                record.msg = f"{record.msg} (+{suppressed} [{category}] records suppressed in the last minute)"
         return True
-    except Exception as e:
-        logger.error(f"[DEBUG] Phone number import test failed: {e}")
-        return False
-
-# --- CONSTANTS ---
-DAILY_MESSAGE_LIMIT = 50
-WELCOME_GEMS_BONUS = 100
-ACTIVE_USER_CACHE_LIMIT = 2000
-MAX_MESSAGE_LENGTH = 1024
-FREE_IMAGE_LIMIT = 12
-
-# --- ELEVENLABS VOICE MAPPING ---
-ELEVENLABS_VOICE_IDS = {
-    "isabella": "9bjVpXgvgd1TpT3tXHL8",
-    "scarlett": "Z0qZlABZILTNeODeXCuu", 
-    "aria": "U2O5xJJ6jMwqdtAI7VI4",
-    "priyanka": "qicvPeGDPufNM8uctpxv",
-    "valentina": "rMDx1aivlvWtnReBqF2L",
-    "luna": "5TLb171gsXHTKyiCAeG0",
-    "kiara": "ezWKCzemPTrGJWvylpbn",
-    "natasha": "qaEJoOC7rUxpj1zEGVun"
-}
-
-ELEVENLABS_AGENT_IDS = {
-    "isabella": "agent_01jzyr3hv3ef9afm06ptwr6np1",
-    "scarlett": "agent_01jzz6w5m3fcxake0c910wz6hx",
-    "aria": "agent_01jzz7jxg1ekra9x07a2qwfdy3", 
-    "priyanka": "agent_01jzz7wjp4fajaf1ftmren6szr",
-    "valentina": "agent_01jzz880zmfekt6pq6bnz1yvfx",
-    "luna": "agent_01jzz8nms0eeyrfr77ek4c0300",
-    "kiara": "agent_01jzz8xcvve7z9dvsh3mbkfsj4",
-    "natasha": "agent_01jzz931h8fjtvnvyjf3f8at6y"
-}
-
-# --- VOICE FEATURE CONSTANTS ---
-#!/usr/bin/env python3
-"""
-Secret Share Bot - Premium Adult AI Companion
-Version 69 - ElevenLabs Voice Integration
-Critical fixes: String casting, image variation, SFW enforcement, state validation
-New features: Voice notes, voice calls, ElevenLabs v3 integration
-"""
-
-import os
-import asyncio
-import json
-import logging
-import random
-import re
-import aiohttp
-import io
-from datetime import datetime, timedelta, timezone, time
-from typing import Dict, Optional, List, Any
-from dataclasses import dataclass, field
-from collections import OrderedDict
-from dotenv import load_dotenv
-import requests
-from aiohttp import web
-import threading
-from pathlib import Path
-
-import replicate
-import elevenlabs
-from pydub import AudioSegment
-
-from telegram import (
-    Update,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    InputMediaPhoto,
-    PhotoSize
-)
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    ConversationHandler,
-    filters,
-    ContextTypes,
-    JobQueue,
-    PreCheckoutQueryHandler
-)
-from telegram.constants import ParseMode
-from telegram.helpers import escape_markdown
-from telegram.error import BadRequest
 
-from supabase import create_client, Client
-
-# Configure logging with enhanced format for debugging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(funcName)s:%(lineno)d] - %(message)s',
-    level=logging.INFO
-)
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the listener thread without formatting them on the caller's thread."""
+
+    IMMUTABLE_ARGS = (str, int, float, bool, type(None), datetime, timedelta)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Freeze the message now only if an argument could change before the listener formats it
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(a, self.IMMUTABLE_ARGS) for a in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+def configure_logging(stream=None) -> logging.handlers.QueueListener:
+    """Route all logging through a queue so stdout and file writes happen on a background thread."""
+    default_level = logging.getLevelName(LOG_LEVEL)
+    if not isinstance(default_level, int):
+        default_level = logging.INFO
+    levels = {}
+    for name, level_name in _parse_log_map(LOG_CATEGORY_LEVELS, str.upper).items():
+        level = logging.getLevelName(level_name)
+        if not isinstance(level, int):
+            continue
+        if name.isupper():
+            levels[name] = level
+        else:
+            logging.getLogger(name).setLevel(level)
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(stream)]
+    if LOG_FILE:
+        handlers.append(logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=50 * 1024 * 1024, backupCount=5, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = BackgroundQueueHandler(log_queue)
+    queue_handler.addFilter(LogPolicyFilter(
+        default_level, levels,
+        _parse_log_map(LOG_RATE_LIMITS, int),
+        _parse_log_map(LOG_SAMPLE_RATES, float),
+    ))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(default_level)
+    # Categories turned up to DEBUG need the module logger to create their records
+    logging.getLogger(__name__).setLevel(min([default_level, *levels.values()]))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
 logger = logging.getLogger(__name__)
-
-# Load environment variables from .env file (development) or environment (production)
-env_path = Path('.env')
 if env_path.exists():
-    logger.info(f"[DEBUG] Loading .env file from: {env_path.absolute()}")
-    load_dotenv()
+    logger.info(f"[DEBUG] Loaded .env file from: {env_path.absolute()}")
 else:
-    logger.info(f"[DEBUG] No .env file found - using environment variables (production mode)")
-    # In production, environment variables are set directly by the platform
+    logger.info("[DEBUG] No .env file found - using environment variables (production mode)")
 
 # --- CONFIGURATION ---
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -278,6 +230,10 @@ ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
 TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
 TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER')
+# Provider API base URLs, overridable to run against the local emulators (see emulators/).
+# Replicate's client reads REPLICATE_BASE_URL itself.
+WAVESPEED_BASE_URL = os.getenv('WAVESPEED_BASE_URL', 'https://api.wavespeed.ai/api/v3').rstrip('/')
+ELEVENLABS_BASE_URL = os.getenv('ELEVENLABS_BASE_URL', 'https://api.elevenlabs.io').rstrip('/')
 
 # Debug logging to check environment variables
 logger.info(f"[DEBUG] Environment variables loaded:")
@@ -323,29 +279,10 @@ async def execute_with_retry(operation, *args, max_retries=3, **kwargs):
                 raise e
     return None
 
-# Initialize ElevenLabs
-
-# Test ElevenLabs API key
-def test_elevenlabs_key():
-    """Test the ElevenLabs API key."""
-    try:
-        # Try to get voices to test the API key using the new API
-        from elevenlabs.client import ElevenLabs
-        # Test ElevenLabs connection with new API
-        client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
-        # Test by getting voices (simpler test)
-        voices = client.voices.get_all()
-        logger.info("✅ ElevenLabs API key is valid!")
-        return True
-    except Exception as e:
-        logger.error(f"[DEBUG] ElevenLabs API key test failed: {e}")
-        return False
-
-# Test the API key on startup
+# The ElevenLabs key is checked by SecretShareBot.warm_up() once the bot is serving
 if ELEVENLABS_API_KEY:
     # Set the API key as an environment variable for ElevenLabs
     os.environ['ELEVENLABS_API_KEY'] = ELEVENLABS_API_KEY
-    test_elevenlabs_key()
 else:
     logger.error("[DEBUG] ElevenLabs API key is not set!")
 
@@ -396,6 +333,109 @@ ELEVENLABS_AGENT_IDS = {
 # --- VOICE FEATURE CONSTANTS ---
 VOICE_NOTE_COST = 30  # gems per voice note
 VOICE_CALL_COST_PER_MINUTE = 50  # gems per minute of call
+ELEVENLABS_TTS_MODEL = os.getenv('ELEVENLABS_TTS_MODEL', 'eleven_monolingual_v1')
+ELEVENLABS_VOICE_SETTINGS = {"stability": 0.71, "similarity_boost": 0.5, "style": 0.0, "use_speaker_boost": True}
+VOICE_CACHE_DIR = os.getenv('VOICE_CACHE_DIR', '/tmp/secret_share_voice_cache')
+VOICE_CACHE_MAX_BYTES = int(os.getenv('VOICE_CACHE_MAX_BYTES', str(200 * 1024 * 1024)))
+VOICE_PIPELINE_MIN_CHARS = 25  # merge shorter sentences so each TTS request has enough context
+VOICE_OPUS_BITRATE = os.getenv('VOICE_OPUS_BITRATE', '32k')  # speech is transparent at 24-32k Opus
+VOICE_ENCODE_WORKERS = int(os.getenv('VOICE_ENCODE_WORKERS', '2'))
+
+# --- WEB SERVER CONSTANTS ---
+WEB_SERVER_PORT = int(os.getenv('WEB_SERVER_PORT', '8081'))  # aiohttp server for provider webhooks and Mini App API
+
+# --- TELEGRAM UPDATE INGESTION ---
+TELEGRAM_MODE = os.getenv('TELEGRAM_MODE', 'polling').lower()  # 'webhook' in production, 'polling' for development
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '')  # public base URL of the load balancer
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', '/api/telegram-webhook')
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '15'))  # updates handled in parallel across all chats
+TELEGRAM_UPDATE_QUEUE_SIZE = int(os.getenv('TELEGRAM_UPDATE_QUEUE_SIZE', '1000'))  # per replica; updates not yet started, beyond this = 503 so Telegram retries
+
+# --- VIDEO DELIVERY CONSTANTS ---
+VIDEO_DELIVERY_WORKERS = int(os.getenv('VIDEO_DELIVERY_WORKERS', '3'))  # concurrent video uploads
+VIDEO_MAX_DOWNLOAD_BYTES = int(os.getenv('VIDEO_MAX_DOWNLOAD_BYTES', str(50 * 1024 * 1024)))  # Telegram bot upload limit
+VIDEO_SPOOL_MEMORY_BYTES = 8 * 1024 * 1024  # spool to disk beyond this size
+VIDEO_DOWNLOAD_CHUNK_BYTES = 256 * 1024
+VIDEO_DOWNLOAD_TIMEOUT = 180  # seconds for a full download
+VIDEO_EXPECTED_RENDER_SECONDS = int(os.getenv('VIDEO_EXPECTED_RENDER_SECONDS', '150'))  # typical Wavespeed render time
+VIDEO_TASK_TIMEOUT_SECONDS = int(os.getenv('VIDEO_TASK_TIMEOUT_SECONDS', '900'))  # give up on a render after this
+VIDEO_POLL_CONCURRENCY = 8  # max simultaneous Wavespeed status checks
+VIDEO_TASK_LEASE_SECONDS = 180  # another replica takes a task over after this long without a renewal
+VIDEO_TASK_CLAIM_INTERVAL_SECONDS = 60  # leases are renewed and abandoned tasks claimed this often
+VIDEO_DELIVERY_ATTEMPTS = 3  # a finished render that cannot be sent after this many tries is refunded
+VIDEO_DELIVERY_RETRY_SECONDS = 30
+
+# --- PREMIUM JOB QUEUE CONSTANTS ---
+PREMIUM_JOB_WORKERS = {'image': 3, 'video': 2, 'voice_note': 3}  # worker pool size per deliverable type
+PREMIUM_JOB_MAX_ATTEMPTS = 3  # attempts before a job is failed and refunded
+PREMIUM_JOB_BACKOFF_SECONDS = 5  # base delay, doubled on every retry
+PREMIUM_JOB_LEASE_SECONDS = 600  # a claimed job is only taken over by another replica after this long without progress
+PREMIUM_JOB_CLAIM_INTERVAL_SECONDS = 60  # how often each replica looks for unclaimed or abandoned jobs
+PREMIUM_JOB_LEASE_RENEW_SECONDS = 120  # a running job's lease is extended this often
+PREMIUM_JOB_STATUS_WRITE_ATTEMPTS = 5  # tries for the final succeeded/failed write before leaving it to the lease
+
+# --- ADMISSION CONTROL CONSTANTS ---
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '24'))  # chat replies in progress before deferring
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv('ADMISSION_MAX_WAIT_SECONDS', '20'))  # estimated Kobold queue wait before deferring
+ADMISSION_DUPLICATE_WINDOW_SECONDS = 10  # a repeat within this window of the first copy is dropped if that copy is pending or under load
+ADMISSION_MAX_DEFER_ATTEMPTS = 6  # after this many re-checks a deferred message is processed regardless
+
+# --- PAYMENT EVENT CONSTANTS ---
+SUPABASE_DB_URL = os.getenv('SUPABASE_DB_URL')  # direct Postgres DSN used to LISTEN for payment changes
+PAYMENT_EVENTS_CHANNEL = 'payment_events'  # must match Database/payment_events_notify.sql
+PAYMENT_LISTEN_RETRY_SECONDS = 15  # delay before reconnecting a dropped LISTEN connection
+PAYMENT_LISTEN_KEEPALIVE_SECONDS = 30  # an idle LISTEN connection is pinged this often to catch a dead socket
+PAYMENT_CATCH_UP_MARGIN_SECONDS = 60  # catch-up after a reconnect also covers this much before the outage
+PAYMENT_FALLBACK_SYNC_SECONDS = 120  # catch-up poll, only used when SUPABASE_DB_URL is not set
+
+# --- RE-ENGAGEMENT BROADCAST CONSTANTS ---
+BROADCAST_CONCURRENCY = 8  # send_message calls in flight at once
+BROADCAST_PAGE_SIZE = 500  # users fetched per keyset page
+BROADCAST_CHECKPOINT_BATCH = 25  # progress is checkpointed after this many users (about a second of sends)
+BROADCAST_LEASE_SECONDS = 300  # another replica may resume a run whose checkpoints stopped this long ago
+REENGAGEMENT_INACTIVE_HOURS = 24  # users idle longer than this are eligible
+REENGAGEMENT_COOLDOWN_DAYS = 7  # a still-dormant user is nudged again only after this long
+REENGAGEMENT_MESSAGE = "💖 I miss you! Come back and continue our conversation... I've been thinking about you! 😘"
+
+# --- FOLLOW-UP CONSTANTS ---
+FOLLOW_UP_DELAY_SECONDS = 300  # send a character follow-up after 5 minutes of silence
+FOLLOW_UP_TICK_SECONDS = 1.0  # timing wheel resolution
+
+# --- OUTBOUND SCHEDULER CONSTANTS ---
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))  # Telegram's bot-wide limit, messages/second
+OUTBOUND_PRIVATE_CHAT_RATE = 1.0  # messages/second into one private chat
+OUTBOUND_GROUP_CHAT_RATE = 20 / 60  # messages/second into one group
+OUTBOUND_CHAT_BURST = 3  # short bursts Telegram tolerates in a single chat
+OUTBOUND_CHAT_BUCKETS = 10000  # per-chat buckets kept, least recently used evicted first
+OUTBOUND_MAX_RETRIES = 2  # RetryAfter retries before the error reaches the caller
+# Served in this order; a request without a priority counts as interactive
+OUTBOUND_PRIORITIES = ('interactive', 'paid', 'background', 'broadcast')
+
+# --- TYPING INDICATOR CONSTANTS ---
+TYPING_REFRESH_SECONDS = 4.0  # Telegram shows a chat action for ~5s, so resend before it lapses
+TYPING_TICK_SECONDS = 0.5  # how often the ticker looks for chats due a refresh
+TYPING_ACTIONS_PER_SECOND = float(os.getenv('TYPING_ACTIONS_PER_SECOND', '20'))  # cap on sendChatAction calls
+
+# --- CALL SUPERVISOR CONSTANTS ---
+CALL_STATUS_CHECK_AFTER_SECONDS = 120  # first fallback status check when no webhook has ended the call
+CALL_STATUS_CHECK_INTERVAL_SECONDS = 120  # fallback checks repeat this often
+CALL_STALE_AFTER_MINUTES = 20  # a call whose status cannot be verified is ended after this long
+CALL_FAILSAFE_MINUTES = 60  # no call runs longer than this, whatever the gem balance
+TWILIO_API_URL = os.getenv('TWILIO_API_URL', 'https://api.twilio.com/2010-04-01').rstrip('/')
+
+# --- SHARED STATE CONSTANTS ---
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()  # 'memory' for a single node, 'supabase' for several replicas
+CALL_STATE_TTL_SECONDS = (CALL_FAILSAFE_MINUTES + 60) * 60  # a registered call is forgotten after this long
+CALL_END_CLAIM_TTL_SECONDS = 7 * 24 * 3600  # how long a processed call end blocks reprocessing
+INSTANCE_ID = f"{os.getenv('HOSTNAME', 'local')}:{os.getpid()}"  # names this replica in claims and leases
+LEADER_LOCK_KEY = 0x5EC2E75  # pg advisory lock held by the replica that runs cluster-wide chores
+LEADER_RETRY_SECONDS = 30  # how often a follower tries to take over leadership
+REPLICA_HEARTBEAT_SECONDS = 30  # a replica whose heartbeat is 3 intervals old is gone; its calls are adopted
+
+# --- TRACING CONSTANTS ---
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.05'))  # share of messages whose trace is logged
+TRACE_SLOW_THRESHOLD_SECONDS = float(os.getenv('TRACE_SLOW_THRESHOLD_SECONDS', '8'))  # slower messages are always logged
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH')  # optional file; kept traces are appended as OTLP/JSON lines
 
 # Audio tags for ElevenLabs v3 model
 VOCAL_SOUNDS = [
@@ -422,6 +462,18 @@ VOICE_CALL_KEYWORDS = [
     "speak to you", "get on a call", "voice call"
 ]
 
+# Name extraction, tried in order against the user's message
+NAME_PATTERNS = [
+    r"(?:my name is|call me|the name is|i(?:'m| am)|it's|this is|you can call me|just call me|name's)\s+([A-Za-z]{2,20})\b",
+    r"^([A-Z][a-z]{2,19})[.,!\s]*hi[.,!\s]*$",  # "Jacob, hi." or "Jacob hi"
+    r"^([A-Z][a-z]{2,19})[.,!\s]+here\b"       # "Jacob here"
+]
+# Looser patterns for digging a name out of earlier messages before a voice call
+HISTORY_NAME_PATTERNS = [
+    r"(?:my name is|call me|the name is|i(?:'m| am)|it's|this is|you can call me|just call me|name's)\s+([A-Za-z]{2,20})\b",
+    r"^([A-Za-z]{2,20})[.,!\s]*$"
+]
+
 # --- GEM PACKS AND SUBSCRIPTION TIERS (for payment processing) ---
 GEM_PACKS = {
     'gems_50': 50,
@@ -539,6 +591,46 @@ ANTICIPATION_PERIODIC_TEMPLATES = [
     "I want this to be perfect for you..."
 ]
 
+# Sent when the chat path is overloaded and a message is deferred
+ADMISSION_HOLD_TEMPLATES = [
+    "*I hold up a finger and smile.* Give me just a moment... I want to answer you properly 💕",
+    "Mmm, one second... let me gather my thoughts for you 😘",
+    "*I bite my lip.* Hold that thought, I'll be right with you...",
+    "Just a moment, handsome... I'm all yours in a second 💋"
+]
+
+# --- PROMPT TEMPLATE CONSTANTS ---
+PERSONA_CACHE_SIZE = int(os.getenv('PERSONA_CACHE_SIZE', '1024'))  # rendered personas kept per (character, user name)
+CHAT_STYLE_FIRST_TURNS = "**IMPORTANT:** For the first two messages, use simple, welcoming, and direct English. Be friendly and easy to understand. Keep responses concise (max 100 tokens). Think naturally but express yourself briefly and clearly."
+CHAT_STYLE = "**IMPORTANT:** Use simple, clear, easy-to-understand English. Keep responses concise (max 100 tokens). Avoid fancy words, complex sentences, or long paragraphs. Respond naturally and keep it friendly. Think like a real person having a casual conversation."
+# Keyed by clothing state; anything else counts as clothed
+IMAGE_CONTEXT_PROMPTS = {
+    'nude': "**IMAGE CONTEXT:** You have just revealed your naked body to the user in the last image. Your dialogue MUST acknowledge this reality. You are no longer wearing clothes. Reference the image naturally in your response.",
+    'undressing': "**IMAGE CONTEXT:** An image of you in a state of undress was just sent. You are partially removing your {outfit}. Your dialogue must acknowledge this ongoing action.",
+    'clothed': "**IMAGE CONTEXT:** An image of you wearing {outfit} was just sent. Your dialogue should naturally reference your appearance or the visual moment captured.",
+}
+ANTICIPATION_INSTRUCTION = (
+    "Generate a short, in-character anticipation message to build excitement for a custom video that is being prepared. "
+    "Keep it concise, playful, and in-character. Do not mention payment or gems. This is message number {msg_num}. "
+    "Make it feel natural and related to the ongoing conversation."
+)
+UPSELL_INSTRUCTION = (
+    "Generate a short, in-character, natural upsell line for offering a {offer_noun} to the user, based on the current conversation and your persona. "
+    "Do NOT break character. Do NOT mention gems, payment, or cost. Make it feel like a natural, playful, or enticing suggestion. "
+    "Do not use a template. Respond as you would in the ongoing roleplay."
+)
+VIDEO_PROMPT_INSTRUCTION = (
+    "Generate a short, visually rich, cinematic prompt for a video featuring the character. "
+    "Describe the scene, pose, and mood in a tasteful way. Do NOT include any talking, speech, text, or dialogue. "
+    "Focus on visual action, body language, and atmosphere. No words, no subtitles, no open mouth as if talking. "
+    "Keep it elegant and artistic, avoid explicit or suggestive language."
+)
+VOICE_NOTE_INSTRUCTION = (
+    "Generate a short, intimate voice note message (2-3 sentences max). "
+    "Make it personal and seductive. Do NOT use asterisks, brackets, or sound effect tags. Just write a natural, intimate voice note. It just needs to be a normal text to voice message without any special characters or formatting. No asterisks, brackets, or sound effect tags in the voice message. "
+    "Keep it natural and conversational."
+)
+
 # ==================================================================================
 # --- CHARACTER DICTIONARY v68 (Enhanced Context Awareness) ---
 # ==================================================================================
@@ -768,80 +860,881 @@ CHARACTERS = {
 }
 
 
-class TypingManager:
-    """
-    Lightweight typing indicator manager for better performance.
-    Simple start/stop with minimal overhead.
+class Metrics:
+    """Small in-process metrics registry, rendered in the Prometheus text format on /metrics.
+
+    Counters and histograms are keyed by (name, sorted labels). Gauges are
+    callables read at scrape time, so they cost nothing between scrapes.
     """
-    def __init__(self, bot, chat_id: int):
-        self.bot = bot
-        self.chat_id = chat_id
-        self.task = None
-        self.is_active = False
-        
-    async def start_typing(self):
-        """Start the typing indicator with smart refresh"""
-        if self.is_active:
-            return
-            
-        self.is_active = True
+
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], list] = {}  # -> [bucket counts..., +Inf count, sum]
+        self._gauges: Dict[str, Any] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            series[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            series[-1] += seconds
+
+    def gauge(self, name: str, read, help_text: str = ''):
+        """Register read() -> number, or -> {labels tuple: number} for labelled gauges."""
+        self._gauges[name] = read
+        self.describe(name, 'gauge', help_text)
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels):
+        start = perf_counter()
         try:
-            await self.bot.send_chat_action(chat_id=self.chat_id, action="typing")
-            # Start efficient refresh task
-            self.task = asyncio.create_task(self._smart_refresh())
-        except Exception:
-            pass
-        
-    async def stop_typing(self):
-        """Stop the typing indicator immediately"""
-        if not self.is_active:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = '') -> str:
+        parts = [f'{k}="{str(v)}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                help_text = self._help.get(name, (kind, ''))[1]
+                if help_text:
+                    lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(series)) for key, series in self._histograms.items())
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), series in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {series[-1]}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, read in sorted(self._gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                logger.warning(f"[METRICS] Gauge {name} failed: {e}")
+                continue
+            header(name, 'gauge')
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append(f"{name}{self._labels(labels)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+METRICS.describe('kobold_generation_seconds', 'histogram', 'KoboldCPP generation latency')
+METRICS.describe('supabase_request_seconds', 'histogram', 'Supabase REST call latency by table/RPC')
+METRICS.describe('replicate_run_seconds', 'histogram', 'Replicate model run latency')
+METRICS.describe('wavespeed_request_seconds', 'histogram', 'Wavespeed submit and poll latency')
+METRICS.describe('elevenlabs_request_seconds', 'histogram', 'ElevenLabs TTS and call API latency')
+METRICS.describe('telegram_request_seconds', 'histogram', 'Telegram Bot API call latency by method')
+METRICS.describe('upsells_total', 'counter', 'Premium offers shown')
+METRICS.describe('fallback_responses_total', 'counter', 'Canned replies sent because generation failed')
+METRICS.describe('gem_refunds_total', 'counter', 'Gem refunds issued')
+
+def instrument_supabase(client: Client):
+    """Time every Supabase REST call through httpx event hooks on the PostgREST session."""
+    session = client.postgrest.session
+
+    def on_request(request):
+        request.extensions['metrics_start'] = perf_counter()
+
+    def on_response(response):
+        start = response.request.extensions.get('metrics_start')
+        if start is None:
             return
-            
-        self.is_active = False
-        
-        # Cancel refresh task quickly
-        if self.task and not self.task.done():
-            self.task.cancel()
+        path = response.request.url.path.rsplit('/rest/v1/', 1)[-1]
+        METRICS.observe('supabase_request_seconds', perf_counter() - start, table=path, method=response.request.method)
+
+    hooks = session.event_hooks
+    hooks['request'].append(on_request)
+    hooks['response'].append(on_response)
+    session.event_hooks = hooks
+
+class MetricsHTTPXRequest(HTTPXRequest):
+    """Bot API transport that records the latency of every Telegram call."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with METRICS.time('telegram_request_seconds', method=url.rsplit('/', 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('message_trace', default=None)
+_trace_export_lock = threading.Lock()
+
+class MessageTrace:
+    """Stage timings for one chat message, held in a context variable.
+
+    Used as `with MessageTrace(user_id):` around message processing; code below it
+    records stages with `trace_stage(name)`. On exit one [TRACE] record is logged if
+    the trace was sampled (TRACE_SAMPLE_RATE) or slower than TRACE_SLOW_THRESHOLD_SECONDS,
+    and kept traces are appended to TRACE_EXPORT_PATH as OTLP/JSON when it is set.
+    """
+
+    def __init__(self, user_id: int, name: str = 'handle_message', **attributes):
+        self.name = name
+        self.attributes = {'user_id': user_id, **attributes}
+        self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.sampled = random.random() < TRACE_SAMPLE_RATE
+        self.spans: List[Tuple[str, float, float, Optional[str]]] = []  # (name, start, duration, error)
+        self.finished = False
+        self._token = None
+
+    def __enter__(self):
+        self.start_ns = time_ns()
+        self.start = perf_counter()
+        self._token = _current_trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_trace.reset(self._token)
+        self.finish(exc_type.__name__ if exc_type else None)
+        return False
+
+    def add_span(self, name: str, start: float, duration: float, error: Optional[str] = None):
+        # Background tasks inherit the context; anything they record after the reply is dropped
+        if not self.finished:
+            self.spans.append((name, start, duration, error))
+
+    def finish(self, error: Optional[str] = None):
+        self.finished = True
+        duration = perf_counter() - self.start
+        slow = duration >= TRACE_SLOW_THRESHOLD_SECONDS
+        if not (self.sampled or slow):
+            return
+        stages: Dict[str, float] = {}
+        for name, _, span_duration, _ in self.spans:
+            stages[name] = round(stages.get(name, 0) + span_duration * 1000, 1)
+        record = {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'duration_ms': round(duration * 1000, 1),
+            'slow': slow,
+            'error': error,
+            **self.attributes,
+            'stages': stages,
+        }
+        (logger.warning if slow else logger.info)(f"[TRACE] {json.dumps(record)}")
+        if TRACE_EXPORT_PATH:
+            line = json.dumps(self.to_otlp(duration, error))
             try:
-                await self.task
-            except asyncio.CancelledError:
-                pass
-    
-    async def _smart_refresh(self):
-        """Smart typing refresh - efficient 4-second intervals"""
+                asyncio.get_running_loop().run_in_executor(None, self._export, line)
+            except RuntimeError:
+                self._export(line)
+
+    def to_otlp(self, duration: float, error: Optional[str] = None) -> dict:
+        """The trace as an OTLP/JSON ExportTraceServiceRequest: a root span plus one child per stage."""
+        def attributes(values: dict) -> list:
+            return [{'key': k, 'value': {'intValue': str(v)} if isinstance(v, int) else {'stringValue': str(v)}}
+                    for k, v in values.items() if v is not None]
+
+        def span(span_id, name, start, span_duration, span_error, parent=None, attrs=None):
+            start_ns = self.start_ns + int((start - self.start) * 1e9)
+            data = {
+                'traceId': self.trace_id,
+                'spanId': span_id,
+                'name': name,
+                'kind': 1,
+                'startTimeUnixNano': str(start_ns),
+                'endTimeUnixNano': str(start_ns + int(span_duration * 1e9)),
+                'attributes': attributes(attrs or {}),
+                'status': {'code': 2, 'message': span_error} if span_error else {'code': 1},
+            }
+            if parent:
+                data['parentSpanId'] = parent
+            return data
+
+        spans = [span(self.span_id, self.name, self.start, duration, error, attrs=self.attributes)]
+        for name, start, span_duration, span_error in self.spans:
+            spans.append(span(os.urandom(8).hex(), name, start, span_duration, span_error, parent=self.span_id))
+        return {'resourceSpans': [{
+            'resource': {'attributes': attributes({'service.name': 'secret-share-bot'})},
+            'scopeSpans': [{'scope': {'name': 'secret_share_bot'}, 'spans': spans}],
+        }]}
+
+    @staticmethod
+    def _export(line: str):
         try:
-            while self.is_active:
-                await asyncio.sleep(4)  # Wait 4 seconds
-                if self.is_active:  # Double-check before API call
-                    try:
-                        await self.bot.send_chat_action(chat_id=self.chat_id, action="typing")
-                    except Exception:
-                        break  # Stop on any error to prevent spam
-        except asyncio.CancelledError:
-            pass  # Clean shutdown
+            with _trace_export_lock, open(TRACE_EXPORT_PATH, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            logger.warning("[TRACE] Could not write trace export to %s: %s", TRACE_EXPORT_PATH, e)
+
+@contextlib.contextmanager
+def trace_stage(name: str):
+    """Time a stage of the current message trace; a no-op outside a MessageTrace."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add_span(name, start, perf_counter() - start, error)
+
+@dataclass(frozen=True)
+class ScenarioTemplate:
+    """The fixed parts of every prompt for one (character, scenario)."""
+    scenario_prompt: str
+    context_head: str  # "\n**Current Scenario Context:** You are in ... You are wearing " + outfit + "."
+    assistant_tail: str  # "\n<full name>:" closing the assistant turn
+
+class PromptTemplates:
+    """Every Kobold prompt is built here.
+
+    Character personas are parsed once and scenario lines are compiled once per
+    (character, scenario) when the module loads. Rendered personas are kept in an
+    LRU keyed by (character, user name, escaped), since a user's name rarely
+    changes between messages. Each builder records its render time and prompt
+    size under prompt_render_seconds / prompt_chars_total, labelled by kind.
+    """
 
+    def __init__(self, characters: Dict[str, dict], cache_size: int = PERSONA_CACHE_SIZE):
+        self.characters = characters
+        self.cache_size = cache_size
+        self._personas: Dict[str, list] = {}
+        self._scenarios: Dict[Tuple[str, str], ScenarioTemplate] = {}
+        self._rendered: OrderedDict = OrderedDict()
+        for key, character in characters.items():
+            self._personas[key] = list(string.Formatter().parse(character['system_prompt_base']))
+            for scenario_key, scenario in character['scenarios'].items():
+                self._scenarios[(key, scenario_key)] = ScenarioTemplate(
+                    scenario_prompt=scenario['scenario_prompt'],
+                    context_head=f"\n**Current Scenario Context:** You are in {scenario['scenario_prompt']}. You are wearing ",
+                    assistant_tail=f"\n{character['full_name']}:",
+                )
 
-@dataclass
-class UserData:
-    """User session data with enhanced state tracking for v68."""
-    current_character: Optional[str] = None
-    current_scenario: Optional[str] = None
-    conversation_history: List[Dict[str, str]] = field(default_factory=list)
-    user_name: Optional[str] = None
-    last_interaction_time: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
-    last_image_url: Optional[str] = None
-    free_images_sent: int = 0
-    message_count_since_last_image: int = 0
-    # NSFW STATE MACHINE (v68): Enhanced with validation
-    clothing_state: str = "clothed"  # Can be 'clothed', 'undressing', 'nude'
-    character_current_outfit: str = ""
-    # v68: Track state transitions for validation
-    state_transition_history: List[str] = field(default_factory=list)
-    # v72: Track if we've already asked for the user's name
-    asked_for_name: bool = False
-    # Premium upsell tracking (v69+)
-    session_message_count: int = 0  # Total messages exchanged in this session (reset on new scenario)
-    premium_offer_state: Optional[dict] = field(default_factory=dict)  # e.g., {'type': 'image', 'status': 'pending', 'offer_id': 'xyz'}
+    def persona(self, character_key: str, user_name: str, escape: bool = True) -> str:
+        """The character's system prompt addressed to user_name (MarkdownV2-escaped unless escape=False)."""
+        key = (character_key, user_name, escape)
+        rendered = self._rendered.get(key)
+        if rendered is not None:
+            self._rendered.move_to_end(key)
+            return rendered
+        value = escape_markdown(user_name, version=2) if escape else user_name
+        rendered = ''.join(literal + (value if field is not None else '') for literal, field, _, _ in self._personas[character_key])
+        self._rendered[key] = rendered
+        if len(self._rendered) > self.cache_size:
+            self._rendered.popitem(last=False)
+        return rendered
+
+    def scenario(self, character_key: str, scenario_key: str) -> ScenarioTemplate:
+        return self._scenarios[(character_key, scenario_key)]
+
+    def record(self, kind: str, prompt: str, started: float) -> str:
+        METRICS.observe('prompt_render_seconds', perf_counter() - started, kind=kind)
+        METRICS.inc('prompt_chars_total', len(prompt), kind=kind)
+        return prompt
+
+    def _session_context(self, user_session: "UserData", user_name: str):
+        character_key = user_session.current_character
+        template = self.scenario(character_key, user_session.current_scenario)
+        persona = self.persona(character_key, user_name)
+        return persona + template.context_head + f"{user_session.character_current_outfit}.", template
+
+    def chat_system(self, user_session: "UserData", user_name: str, image_context: Optional[Tuple[str, str]] = None) -> str:
+        """System section for a chat reply. image_context is (clothing_state, outfit) of an image just sent."""
+        context, _ = self._session_context(user_session, user_name)
+        style = CHAT_STYLE_FIRST_TURNS if len(user_session.conversation_history) <= 1 else CHAT_STYLE
+        system = f"{context}\n{style}"
+        if image_context:
+            clothing_state, outfit = image_context
+            image_prompt = IMAGE_CONTEXT_PROMPTS.get(clothing_state, IMAGE_CONTEXT_PROMPTS['clothed'])
+            system += "\n" + image_prompt.format(outfit=outfit)
+        return system
+
+    def chat(self, system: str, history: List[dict], user_message: str, user_session: "UserData", started: float) -> str:
+        """The full ChatML chat prompt for a system section and a window of history."""
+        template = self.scenario(user_session.current_character, user_session.current_scenario)
+        parts = [f"<|im_start|>system\n{system}<|im_end|>"]
+        for turn in history:
+            parts.append(f"<|im_start|>{turn['role']}\n{turn['content']}<|im_end|>")
+        parts.append(f"<|im_start|>user\n{user_message}<|im_end|>")
+        parts.append(f"<|im_start|>assistant{template.assistant_tail}")
+        return self.record('chat', "".join(parts), started)
+
+    def anticipation(self, user_session: "UserData", user_name: str, anticipation_context: str, msg_num: int) -> str:
+        started = perf_counter()
+        context, template = self._session_context(user_session, user_name)
+        prompt = (
+            f"<|im_start|>system\n{context}\n<|im_end|>"
+            f"<|im_start|>user\n{anticipation_context}<|im_end|>"
+            f"<|im_start|>assistant\n{ANTICIPATION_INSTRUCTION.format(msg_num=msg_num)}{template.assistant_tail}"
+        )
+        return self.record('anticipation', prompt, started)
+
+    def upsell(self, user_session: "UserData", user_name: str, offer_noun: str, user_message: Optional[str] = None) -> str:
+        started = perf_counter()
+        context, template = self._session_context(user_session, user_name)
+        history_text = "\n".join(f"{turn['role']}: {turn['content']}" for turn in user_session.conversation_history[-4:])
+        parts = [f"<|im_start|>system\n{context}\n<|im_end|>"]
+        if history_text:
+            parts.append(f"<|im_start|>history\n{history_text}<|im_end|>")
+        if user_message:
+            parts.append(f"<|im_start|>user\n{user_message}<|im_end|>")
+        parts.append(f"<|im_start|>assistant\n{UPSELL_INSTRUCTION.format(offer_noun=offer_noun)}{template.assistant_tail}")
+        return self.record('upsell', "".join(parts), started)
+
+    def video(self, user_session: "UserData", user_message: str) -> str:
+        started = perf_counter()
+        template = self.scenario(user_session.current_character, user_session.current_scenario)
+        persona = self.persona(user_session.current_character, user_session.user_name or "you", escape=False)
+        history_text = "\n".join(f"{turn['role']}: {turn['content']}" for turn in user_session.conversation_history[-4:])
+        prompt = (
+            f"<|im_start|>system\n{persona}\nCurrent scenario: {template.scenario_prompt}\n<|im_end|>"
+            f"<|im_start|>history\n{history_text}<|im_end|>"
+            f"<|im_start|>user\n{user_message}<|im_end|>"
+            f"<|im_start|>assistant\n{VIDEO_PROMPT_INSTRUCTION}\nPrompt:"
+        )
+        return self.record('video', prompt, started)
+
+    def voice_note(self, user_session: "UserData", user_name: str) -> str:
+        started = perf_counter()
+        template = self.scenario(user_session.current_character, user_session.current_scenario)
+        prompt = (
+            f"<|im_start|>system\n{self.persona(user_session.current_character, user_name)}\n"
+            f"**Current Scenario:** {template.scenario_prompt}\n"
+            f"**Current Outfit:** {user_session.character_current_outfit}\n"
+            f"{VOICE_NOTE_INSTRUCTION}<|im_end|>\n"
+            f"<|im_start|>user\nCreate a voice note for me<|im_end|>\n"
+            f"<|im_start|>assistant{template.assistant_tail}"
+        )
+        return self.record('voice_note', prompt, started)
+
+PROMPTS = PromptTemplates(CHARACTERS)
+METRICS.describe('prompt_render_seconds', 'histogram', 'Time spent building a Kobold prompt by kind')
+METRICS.describe('prompt_chars_total', 'counter', 'Characters of Kobold prompt built by kind')
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping each chat's updates in order.
+
+    Every chat gets a FIFO lane; an update waits for its lane, then for one of the
+    global slots. A slow Kobold or Replicate call only delays the chat it belongs to.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        # PTB spawns a task per update and takes its semaphore inside that task, so it bounds
+        # nothing here; the concurrency limit is self._slots and the backlog is capped by
+        # handle_telegram_update refusing updates once self.backlog is full
+        super().__init__(max_concurrent_updates=max_concurrent_updates + TELEGRAM_UPDATE_QUEUE_SIZE)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._lanes: Dict[Any, dict] = {}  # chat_id -> {'lock', 'waiting'}
+        self.in_flight = 0
+        self.backlog = 0  # updates handed to us that are still waiting for their lane or a slot
+        self.recent_waits = deque(maxlen=1000)  # seconds from arrival to start of processing
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _lane_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._lane_key(update)
+        arrived = asyncio.get_running_loop().time()
+        self.backlog += 1
+        waiting = True
+        try:
+            async with (self._slots if key is None else self.lane(key)):
+                self.backlog -= 1
+                waiting = False
+                await self._run(coroutine, arrived)
+        finally:
+            if waiting:
+                self.backlog -= 1
+
+    @contextlib.asynccontextmanager
+    async def lane(self, key):
+        """Hold a chat's lane and a global slot, so work started outside an update
+        (e.g. from the JobQueue) runs in order with that chat's updates."""
+        lane = self._lanes.setdefault(key, {'lock': asyncio.Lock(), 'waiting': 0})
+        lane['waiting'] += 1
+        started = False
+        try:
+            async with lane['lock']:
+                async with self._slots:
+                    lane['waiting'] -= 1
+                    started = True
+                    yield
+        finally:
+            if not started:
+                lane['waiting'] -= 1
+            if not lane['waiting'] and not lane['lock'].locked():
+                self._lanes.pop(key, None)
+
+    async def _run(self, coroutine, arrived: float):
+        self.recent_waits.append(asyncio.get_running_loop().time() - arrived)
+        self.in_flight += 1
+        try:
+            await coroutine
+        finally:
+            self.in_flight -= 1
+
+    def queue_lengths(self) -> Dict[Any, int]:
+        """Updates waiting per chat (only chats with a backlog)."""
+        return {key: lane['waiting'] for key, lane in self._lanes.items() if lane['waiting']}
+
+    def stats(self) -> dict:
+        waits = sorted(self.recent_waits)
+        queued = self.queue_lengths()
+        return {
+            'in_flight': self.in_flight,
+            'limit': self.limit,
+            'backlog': self.backlog,
+            'queued': sum(queued.values()),
+            'busiest_chats': sorted(queued.items(), key=lambda item: item[1], reverse=True)[:5],
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+class AdmissionController:
+    """Decides whether a chat message is answered now or deferred until the LLM queue drains.
+
+    Load is judged by chat replies in flight and by the estimated wait for a Kobold
+    slot. A repeat of the same message is dropped only while the first one is still
+    being answered or the chat path is overloaded.
+    """
+
+    def __init__(self, kobold_api: 'KoboldAPI', max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_wait: float = ADMISSION_MAX_WAIT_SECONDS):
+        self.kobold_api = kobold_api
+        self.max_in_flight = max_in_flight
+        self.max_wait = max_wait
+        self.in_flight = 0
+        # deferred: messages held back; deferred_users: hold-back batches started; dropped: repeats ignored
+        self.counts = {'admitted': 0, 'deferred': 0, 'deferred_users': 0, 'dropped': 0}
+        self._recent: Dict[int, dict] = {}  # user_id -> {'text', 'since', 'in_flight'}
+
+    def estimated_wait(self) -> float:
+        return self.kobold_api.estimated_wait()
+
+    def overloaded(self) -> bool:
+        return self.in_flight >= self.max_in_flight or self.estimated_wait() > self.max_wait
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return " ".join(text.lower().split())
+
+    def is_duplicate(self, user_id: int, text: str) -> bool:
+        now = asyncio.get_running_loop().time()
+        key = self._normalize(text)
+        previous = self._recent.get(user_id)
+        if previous and previous['text'] == key and now - previous['since'] < ADMISSION_DUPLICATE_WINDOW_SECONDS:
+            # The window runs from the first copy, so repeating a message never extends it
+            if previous['in_flight'] or self.overloaded():
+                self.counts['dropped'] += 1
+                return True
+            return False
+        self._recent[user_id] = {'text': key, 'since': now, 'in_flight': 0}
+        if len(self._recent) > 10000:
+            self._recent = {uid: entry for uid, entry in self._recent.items()
+                            if entry['in_flight'] or now - entry['since'] < ADMISSION_DUPLICATE_WINDOW_SECONDS}
+        return False
+
+    @contextlib.contextmanager
+    def track(self, user_id: Optional[int] = None, text: Optional[str] = None):
+        entry = self._recent.get(user_id) if user_id is not None else None
+        if entry and entry['text'] != self._normalize(text or ''):
+            entry = None
+        if entry:
+            entry['in_flight'] += 1
+        self.in_flight += 1
+        self.counts['admitted'] += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if entry:
+                entry['in_flight'] -= 1
+
+class TokenBucket:
+    """Async token bucket shared by concurrent senders.
+
+    pause() holds every caller back at once, which is what Telegram asks for
+    when it answers with RetryAfter.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated: Optional[float] = None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        now = asyncio.get_running_loop().time()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+_outbound_priority: contextvars.ContextVar = contextvars.ContextVar('outbound_priority', default='interactive')
+
+@contextlib.contextmanager
+def outbound_priority(name: str):
+    """Send every Bot API call made inside the block with this OUTBOUND_PRIORITIES class."""
+    token = _outbound_priority.set(name)
+    try:
+        yield
+    finally:
+        _outbound_priority.reset(token)
+
+class OutboundScheduler(BaseRateLimiter):
+    """Rate limiter for application.bot: per-chat and global token buckets, served by priority.
+
+    A send first waits on its chat's bucket, then queues for a global token.
+    Global tokens go to the highest waiting class in OUTBOUND_PRIORITIES (FIFO
+    within a class), so a live reply overtakes a broadcast that is already
+    queued. The class comes from rate_limit_args, else from outbound_priority().
+    RetryAfter pauses both buckets and the call is retried. Only sends and edits
+    are limited; callback answers, webhook setup and the like go straight through.
+    """
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.bucket = TokenBucket(global_rate)
+        self.max_retries = max_retries
+        self._chat_buckets: OrderedDict = OrderedDict()
+        self._waiting: list = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.queued: Dict[str, int] = {name: 0 for name in OUTBOUND_PRIORITIES}
+
+    async def initialize(self):
+        if not self._dispatcher:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def queue_depths(self) -> Dict[tuple, int]:
+        return {(('priority', name),): count for name, count in self.queued.items()}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            private = isinstance(chat_id, int) and chat_id > 0
+            rate = OUTBOUND_PRIVATE_CHAT_RATE if private else OUTBOUND_GROUP_CHAT_RATE
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, OUTBOUND_CHAT_BURST)
+            if len(self._chat_buckets) > OUTBOUND_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            await self._wake.wait()
+            while self._waiting:
+                await self.bucket.acquire()
+                # Hand the token to the best waiter at the moment it became available
+                while self._waiting:
+                    _, _, future = heapq.heappop(self._waiting)
+                    if not future.done():
+                        future.set_result(None)
+                        break
+            self._wake.clear()
+
+    async def _acquire(self, rank: int, chat_bucket: Optional[TokenBucket]):
+        if chat_bucket:
+            await chat_bucket.acquire()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (rank, next(self._seq), future))
+        self._wake.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(('send', 'edit', 'copyMessage', 'forwardMessage')):
+            return await callback(*args, **kwargs)
+        priority = rate_limit_args or _outbound_priority.get()
+        if priority not in self.queued:
+            priority = 'interactive'
+        rank = OUTBOUND_PRIORITIES.index(priority)
+        chat_id = data.get('chat_id')
+        # Chat actions are cosmetic; they shouldn't spend the chat's allowance for real messages
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None and endpoint != 'sendChatAction' else None
+        for attempt in range(self.max_retries + 1):
+            started = perf_counter()
+            self.queued[priority] += 1
+            try:
+                await self._acquire(rank, chat_bucket)
+            finally:
+                self.queued[priority] -= 1
+                waited = perf_counter() - started
+                METRICS.observe('outbound_wait_seconds', waited, priority=priority)
+                METRICS.inc('outbound_throttle_seconds_total', waited, priority=priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                METRICS.inc('outbound_retry_after_total', priority=priority)
+                logger.warning(f"[OUTBOUND] {endpoint} to {chat_id} hit the flood limit, pausing {retry_after}s ({priority})")
+                self.bucket.pause(retry_after)
+                if chat_bucket:
+                    chat_bucket.pause(retry_after)
+                if attempt == self.max_retries:
+                    raise
+
+METRICS.describe('outbound_wait_seconds', 'histogram', 'Time a Bot API send waited for the outbound limits, by priority')
+METRICS.describe('outbound_throttle_seconds_total', 'counter', 'Total seconds Bot API sends spent throttled, by priority')
+METRICS.describe('outbound_retry_after_total', 'counter', 'Bot API sends answered with RetryAfter, by priority')
+
+class InactivityTracker:
+    """Hashed timing wheel that fires a callback for chats that have gone quiet.
+
+    touch() moves a chat to the bucket for its new deadline in O(1), so a busy
+    chat never piles up timers. A single sweeper task pops due buckets each
+    tick and hands the chats to on_due in one batch.
+    """
+
+    def __init__(self, on_due, delay: float = FOLLOW_UP_DELAY_SECONDS, tick: float = FOLLOW_UP_TICK_SECONDS):
+        self.on_due = on_due  # async (chat_ids: List[int])
+        self.delay = delay
+        self.tick = tick
+        self._buckets: Dict[int, set] = {}  # absolute tick -> chat ids due in it
+        self._slot_of: Dict[int, int] = {}  # chat id -> its current tick
+        self._last_swept: Optional[int] = None
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def _tick_at(self, when: float) -> int:
+        return int(when // self.tick)
+
+    def touch(self, chat_id: int, now: Optional[float] = None):
+        """(Re)arm the follow-up for chat_id, replacing any pending one."""
+        now = asyncio.get_running_loop().time() if now is None else now
+        slot = self._tick_at(now + self.delay)
+        previous = self._slot_of.get(chat_id)
+        if previous == slot:
+            return
+        if previous is not None:
+            bucket = self._buckets.get(previous)
+            if bucket is not None:
+                bucket.discard(chat_id)
+                if not bucket:
+                    del self._buckets[previous]
+        self._buckets.setdefault(slot, set()).add(chat_id)
+        self._slot_of[chat_id] = slot
+
+    def cancel(self, chat_id: int):
+        slot = self._slot_of.pop(chat_id, None)
+        bucket = self._buckets.get(slot)
+        if bucket is not None:
+            bucket.discard(chat_id)
+            if not bucket:
+                del self._buckets[slot]
+
+    def pop_due(self, now: Optional[float] = None) -> List[int]:
+        """Remove and return every chat whose deadline has passed."""
+        now_tick = self._tick_at(asyncio.get_running_loop().time() if now is None else now)
+        if self._last_swept is None:
+            self._last_swept = now_tick - 1
+        due = []
+        if now_tick - self._last_swept > len(self._buckets):
+            # Long gap (e.g. a stalled loop): walking the buckets is cheaper than every tick
+            ticks = [t for t in self._buckets if t <= now_tick]
+        else:
+            ticks = range(self._last_swept + 1, now_tick + 1)
+        for t in ticks:
+            bucket = self._buckets.pop(t, None)
+            if bucket:
+                for chat_id in bucket:
+                    del self._slot_of[chat_id]
+                due.extend(bucket)
+        self._last_swept = max(self._last_swept, now_tick)
+        return due
+
+    async def start(self):
+        if not self._sweeper:
+            self._sweeper = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            due = self.pop_due()
+            if not due:
+                continue
+            try:
+                await self.on_due(due)
+            except Exception as e:
+                logger.error(f"[FOLLOW UP] Batch of {len(due)} follow-ups failed: {e}")
+
+class TypingTicker:
+    """Keeps "typing..." showing in every chat that is waiting on a reply, from one task.
+
+    start_typing()/stop_typing() only add or remove the chat from a dict. The
+    ticker sends the first action as soon as it is woken, then refreshes every
+    chat that is due each tick, paced by a token bucket so chat actions never
+    crowd out real replies. Sends run as their own tasks, so a chat stuck behind
+    a RetryAfter pause never holds up the tick; a chat is skipped while its
+    previous action is still in flight.
+    """
+
+    def __init__(self, refresh: float = TYPING_REFRESH_SECONDS, tick: float = TYPING_TICK_SECONDS, rate: float = TYPING_ACTIONS_PER_SECOND):
+        self.refresh = refresh
+        self.tick = tick
+        self.bucket = TokenBucket(rate)
+        self.bot = None
+        self._due_at: Dict[int, float] = {}  # chat id -> loop time its next action is due
+        self._sending: Dict[int, asyncio.Task] = {}  # chat id -> action still waiting or in flight
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._due_at)
+
+    def start_typing(self, chat_id: int):
+        if chat_id not in self._due_at:
+            self._due_at[chat_id] = 0.0
+            self._wake.set()
+
+    def stop_typing(self, chat_id: int):
+        self._due_at.pop(chat_id, None)
+
+    async def start(self, bot):
+        self.bot = bot
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        sends = list(self._sending.values())
+        for task in sends:
+            task.cancel()
+        await asyncio.gather(*sends, return_exceptions=True)
+        self._sending.clear()
+        self._due_at.clear()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self.tick)
+            self._wake.clear()
+            now = loop.time()
+            for chat_id, due_at in list(self._due_at.items()):
+                if due_at > now or chat_id in self._sending:
+                    continue
+                self._due_at[chat_id] = now + self.refresh
+                task = self._sending[chat_id] = asyncio.create_task(self._send(chat_id))
+                task.add_done_callback(lambda done, chat_id=chat_id: self._sending.get(chat_id) is done and self._sending.pop(chat_id))
+
+    async def _send(self, chat_id: int):
+        await self.bucket.acquire()
+        if chat_id not in self._due_at:
+            return  # the reply went out while this waited for a token
+        try:
+            await self.bot.send_chat_action(chat_id=chat_id, action="typing", rate_limit_args='background')
+            if chat_id in self._due_at:
+                # Count the refresh from when the action actually went out
+                self._due_at[chat_id] = asyncio.get_running_loop().time() + self.refresh
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            self.bucket.pause(retry_after)
+        except Exception as e:
+            # Blocked or gone: stop refreshing rather than retrying every tick
+            self._due_at.pop(chat_id, None)
+            logger.debug("[TYPING] Chat action failed for %s: %s", chat_id, e)
+
+
+@dataclass
+class UserData:
+    """User session data with enhanced state tracking for v68."""
+    current_character: Optional[str] = None
+    current_scenario: Optional[str] = None
+    conversation_history: List[Dict[str, str]] = field(default_factory=list)
+    user_name: Optional[str] = None
+    last_interaction_time: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    last_image_url: Optional[str] = None
+    free_images_sent: int = 0
+    message_count_since_last_image: int = 0
+    # NSFW STATE MACHINE (v68): Enhanced with validation
+    clothing_state: str = "clothed"  # Can be 'clothed', 'undressing', 'nude'
+    character_current_outfit: str = ""
+    # v68: Track state transitions for validation
+    state_transition_history: List[str] = field(default_factory=list)
+    # v72: Track if we've already asked for the user's name
+    asked_for_name: bool = False
+    # Premium upsell tracking (v69+)
+    session_message_count: int = 0  # Total messages exchanged in this session (reset on new scenario)
+    premium_offer_state: Optional[dict] = field(default_factory=dict)  # e.g., {'type': 'image', 'status': 'pending', 'offer_id': 'xyz'}
     last_blurred_image_url: Optional[str] = None
     last_video_task: Optional[dict] = field(default_factory=dict)  # Stores video task data
     # v68: Track last image context for text response
@@ -852,8 +1745,9 @@ class UserData:
     gems: int = 0
     messages_today: int = 0
     subscription_type: Optional[str] = None
-    # Robust typing indicator manager
-    typing_manager: Optional['TypingManager'] = None
+    # Admission control: messages held back while the LLM queue is overloaded
+    deferred_messages: List[str] = field(default_factory=list)
+    deferred_update: Optional[Any] = None
 
     def validate_state_transition(self, new_state: str) -> bool:
         """v68: Validates that clothing state transitions are logical."""
@@ -1010,6 +1904,7 @@ class Database:
                 if pending is not None:
                     supabase.table('users').update({'gems': pending, 'pending_gem_refund': None}).eq('telegram_id', user_id).execute()
                     logger.info(f"[REFUND] Restored gems to pre-deduction value {pending} for user {user_id}")
+                    METRICS.inc('gem_refunds_total', kind='restore')
                     return True
             # Fallback: add gems to current balance (legacy)
             result = supabase.table('users').select('gems').eq('telegram_id', user_id).execute()
@@ -1018,6 +1913,7 @@ class Database:
                 new_balance = current_gems + gem_amount
                 supabase.table('users').update({'gems': new_balance}).eq('telegram_id', user_id).execute()
                 logger.info(f"[REFUND] (Fallback) Refunded {gem_amount} gems to user {user_id}. New balance: {new_balance}")
+                METRICS.inc('gem_refunds_total', kind='credit')
                 return True
         except Exception as e:
             logger.error(f"[REFUND] Failed to refund gems: {e}")
@@ -1060,6 +1956,137 @@ class Database:
             logger.error(f"[CALL UPDATE] Failed to update call duration: {e}")
             return False
 
+    @staticmethod
+    def save_video_task(task_id: str, user_id: int, gem_cost: int) -> bool:
+        """Persist a submitted video task, leased to this replica, so it can be resumed after a restart."""
+        try:
+            supabase.table('video_tasks').upsert({
+                'task_id': task_id,
+                'user_id': user_id,
+                'gem_cost': gem_cost,
+                'status': 'pending',
+                'claimed_by': INSTANCE_ID,
+                'lease_until': (datetime.now(timezone.utc) + timedelta(seconds=VIDEO_TASK_LEASE_SECONDS)).isoformat()
+            }, on_conflict='task_id', ignore_duplicates=True).execute()
+            return True
+        except Exception as e:
+            logger.error(f"[VIDEO TASK] Failed to save task {task_id}: {e}")
+            return False
+
+    @staticmethod
+    def move_video_task(task_id: str, status: str, from_status: str = 'pending', video_url: Optional[str] = None) -> bool:
+        """Move a task held by this replica from from_status to status.
+
+        Returns False if the task already moved on or belongs to another replica,
+        so the caller never delivers or refunds the same task twice. Database errors
+        propagate so the caller can retry.
+        """
+        values = {'status': status, 'updated_at': datetime.now(timezone.utc).isoformat()}
+        if video_url:
+            values['video_url'] = video_url
+        result = supabase.table('video_tasks').update(values) \
+            .eq('task_id', task_id).eq('status', from_status).eq('claimed_by', INSTANCE_ID).execute()
+        return bool(result.data)
+
+    @staticmethod
+    def claim_video_tasks() -> List[dict]:
+        """Renew this replica's leases and take over pending or delivering tasks whose lease has run out."""
+        try:
+            result = supabase.rpc('claim_video_tasks', {
+                'p_claimed_by': INSTANCE_ID,
+                'p_lease_seconds': VIDEO_TASK_LEASE_SECONDS
+            }).execute()
+            return result.data or []
+        except Exception as e:
+            logger.error(f"[VIDEO TASK] Failed to claim pending tasks: {e}")
+            return []
+
+    @staticmethod
+    def credit_gems(user_id: int, gem_amount: int) -> bool:
+        """Add gems to the user's current balance (a single atomic increment)."""
+        try:
+            result = supabase.rpc('credit_user_gems', {'p_user_id': user_id, 'p_amount': gem_amount}).execute()
+            if result.data is not None:
+                logger.info(f"[REFUND] Credited {gem_amount} gems to user {user_id}. New balance: {result.data}")
+                METRICS.inc('gem_refunds_total', kind='credit')
+                return True
+        except Exception as e:
+            logger.error(f"[REFUND] Failed to credit {gem_amount} gems to user {user_id}: {e}")
+        return False
+
+    @staticmethod
+    def enqueue_premium_job(idempotency_key: str, user_id: int, job_type: str, gem_cost: int, payload: dict) -> Optional[dict]:
+        """Insert a premium job and debit its gems in one transaction.
+
+        Returns None if a job with this idempotency key already exists. Raises if the
+        user cannot cover the cost, in which case nothing is written. The new job is
+        leased to this replica, which runs it straight away.
+        """
+        result = supabase.rpc('enqueue_premium_job', {
+            'p_idempotency_key': idempotency_key,
+            'p_user_id': user_id,
+            'p_job_type': job_type,
+            'p_gem_cost': gem_cost,
+            'p_payload': payload,
+            'p_claimed_by': INSTANCE_ID,
+            'p_lease_seconds': PREMIUM_JOB_LEASE_SECONDS
+        }).execute()
+        return result.data[0] if result.data else None
+
+    @staticmethod
+    def update_premium_job(job_id: int, **fields) -> bool:
+        try:
+            fields['updated_at'] = datetime.now(timezone.utc).isoformat()
+            supabase.table('premium_jobs').update(fields).eq('id', job_id).execute()
+            return True
+        except Exception as e:
+            logger.error(f"[PREMIUM JOB] Failed to update job {job_id}: {e}")
+            return False
+
+    @staticmethod
+    def renew_premium_job_lease(job_id: int, lease_until: str) -> bool:
+        """Extend a running job's lease. False if the job is no longer held by this replica."""
+        try:
+            result = supabase.table('premium_jobs').update({'lease_until': lease_until}) \
+                .eq('id', job_id).eq('claimed_by', INSTANCE_ID).execute()
+            return bool(result.data)
+        except Exception as e:
+            logger.error(f"[PREMIUM JOB] Failed to renew lease for job {job_id}: {e}")
+            return True  # keep trying; the lease has time left
+
+    @staticmethod
+    def claim_premium_jobs() -> List[dict]:
+        """Lease queued jobs and jobs whose lease has run out to this replica.
+
+        Only the rows returned were won; another replica claiming at the same time
+        gets a disjoint set.
+        """
+        try:
+            result = supabase.rpc('claim_premium_jobs', {
+                'p_claimed_by': INSTANCE_ID,
+                'p_lease_seconds': PREMIUM_JOB_LEASE_SECONDS
+            }).execute()
+            return result.data or []
+        except Exception as e:
+            logger.error(f"[PREMIUM JOB] Failed to claim open jobs: {e}")
+            return []
+
+    @staticmethod
+    def refund_premium_job(job: dict) -> bool:
+        """Refund a failed job's gems. The status flip makes this a no-op if already refunded."""
+        try:
+            result = supabase.table('premium_jobs').update({
+                'status': 'refunded',
+                'updated_at': datetime.now(timezone.utc).isoformat()
+            }).eq('id', job['id']).eq('status', 'failed').execute()
+        except Exception as e:
+            logger.error(f"[REFUND] Failed to mark job {job['id']} refunded: {e}")
+            return False
+        if not result.data:
+            logger.info(f"[REFUND] Job {job['id']} was already refunded")
+            return False
+        return Database.credit_gems(job['user_id'], job['gem_cost'])
+
     @staticmethod
     async def save_user_session(user_id: int, session_data: dict) -> bool:
         """Save user session data to database for persistence across bot restarts."""
@@ -1086,7 +2113,7 @@ class Database:
                 }).eq('telegram_id', user_id).execute()
             )
             
-            logger.info(f"[SESSION SAVE] Saved session for user {user_id}")
+            logger.debug("[SESSION SAVE] Saved session for user %s", user_id)
             return True
         except Exception as e:
             logger.error(f"[SESSION SAVE] Failed to save session for user {user_id}: {e}")
@@ -1131,7 +2158,7 @@ class Database:
         """Returns the active subscription tier or None if not subscribed or expired."""
         try:
             now = datetime.now(timezone.utc)
-            logger.info(f"[SUBSCRIPTION CHECK] Checking subscription for user {user_id} at {now}")
+            logger.debug("[SUBSCRIPTION CHECK] Checking subscription for user %s at %s", user_id, now)
             
             res = supabase.table('subscriptions').select('tier, expires_at').eq('user_id', user_id).order('expires_at', desc=True).limit(1).execute()
             
@@ -1141,13 +2168,13 @@ class Database:
                 expires_at_str = subscription['expires_at']
                 expires_at = datetime.fromisoformat(expires_at_str.replace('Z', '+00:00'))
                 
-                logger.info(f"[SUBSCRIPTION CHECK] User {user_id} has subscription: tier='{tier}', expires_at={expires_at}")
+                logger.debug("[SUBSCRIPTION CHECK] User %s has subscription: tier=%r, expires_at=%s", user_id, tier, expires_at)
                 
                 if expires_at > now:
-                    logger.info(f"[SUBSCRIPTION CHECK] ✅ User {user_id} has ACTIVE {tier} subscription (expires {expires_at})")
+                    logger.debug("[SUBSCRIPTION CHECK] ✅ User %s has ACTIVE %s subscription (expires %s)", user_id, tier, expires_at)
                     return tier
         except Exception as e:
-            logger.error(f"[SUBSCRIPTION CHECK] ❌ Error checking subscription for user {user_id}: {e}")
+            logger.error("[SUBSCRIPTION CHECK] ❌ Error checking subscription for user %s: %s", user_id, e)
         return None
 
     @staticmethod
@@ -1177,12 +2204,91 @@ class Database:
         except Exception as e:
             logger.error(f"[DB] update_subscription error: {e}")
 
+    @staticmethod
+    def get_reengagement_candidates(inactive_before: str, cooldown_before: str, after_last_seen: Optional[str], after_telegram_id: int, limit: int) -> List[dict]:
+        """Next keyset page of dormant users, ordered by (last_seen, telegram_id)."""
+        result = supabase.rpc('get_reengagement_candidates', {
+            'p_inactive_before': inactive_before,
+            'p_cooldown_before': cooldown_before,
+            'p_after_last_seen': after_last_seen,
+            'p_after_telegram_id': after_telegram_id,
+            'p_limit': limit
+        }).execute()
+        return result.data or []
+
+    @staticmethod
+    def mark_users_reengaged(user_ids: List[int]):
+        if user_ids:
+            supabase.table('users').update({'last_reengaged_at': datetime.now(timezone.utc).isoformat()}).in_('telegram_id', user_ids).execute()
+
+    @staticmethod
+    def mark_users_blocked(user_ids: List[int]):
+        if user_ids:
+            supabase.table('users').update({'bot_blocked_at': datetime.now(timezone.utc).isoformat()}).in_('telegram_id', user_ids).execute()
+
+    @staticmethod
+    def get_unfinished_broadcast_run(kind: str) -> Optional[dict]:
+        try:
+            result = supabase.table('broadcast_runs').select('*').eq('kind', kind).eq('status', 'running')\
+                .order('started_at', desc=True).limit(1).execute()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            logger.error(f"[BROADCAST] Failed to look up unfinished {kind} runs: {e}")
+            return None
+
+    @staticmethod
+    def claim_broadcast_run(run: dict) -> Optional[dict]:
+        """Take ownership of a broadcast run. Returns the claimed row, or None if another replica has it.
+
+        A new run_key is claimed by inserting it (the primary key makes that atomic). An
+        existing run can only be taken over while it is unfinished and its lease has run out.
+        """
+        now = datetime.now(timezone.utc)
+        lease = {
+            'claimed_by': INSTANCE_ID,
+            'lease_until': (now + timedelta(seconds=BROADCAST_LEASE_SECONDS)).isoformat(),
+            'updated_at': now.isoformat()
+        }
+        try:
+            result = supabase.table('broadcast_runs').insert({**run, **lease}).execute()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            if getattr(e, 'code', None) != '23505':
+                logger.error(f"[BROADCAST] Failed to claim run {run['run_key']}: {e}")
+                return None
+        try:
+            result = supabase.table('broadcast_runs').update(lease).eq('run_key', run['run_key']).eq('status', 'running')\
+                .or_(f"claimed_by.eq.{INSTANCE_ID},lease_until.is.null,lease_until.lt.{now.isoformat()}").execute()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            logger.error(f"[BROADCAST] Failed to take over run {run['run_key']}: {e}")
+            return None
+
+    @staticmethod
+    def save_broadcast_run(run: dict) -> bool:
+        """Checkpoint a broadcast run this replica holds, renewing its lease."""
+        now = datetime.now(timezone.utc)
+        try:
+            supabase.table('broadcast_runs').update({
+                **run,
+                'lease_until': (now + timedelta(seconds=BROADCAST_LEASE_SECONDS)).isoformat(),
+                'updated_at': now.isoformat()
+            }).eq('run_key', run['run_key']).eq('claimed_by', INSTANCE_ID).execute()
+            return True
+        except Exception as e:
+            logger.error(f"[BROADCAST] Failed to checkpoint run {run.get('run_key')}: {e}")
+            return False
+
 class KoboldAPI:
     def __init__(self, base_url: str):
         self.base_url = base_url
         self.session = None
         # Optimized for single GPU - balanced speed and throughput
-        self._semaphore = asyncio.Semaphore(4)  # 4 concurrent users for better experience
+        self.max_concurrency = 4
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)  # 4 concurrent users for better experience
+        # Load tracking for admission control
+        self.waiting = 0  # requests queued for a generation slot
+        self.avg_latency = 8.0  # EWMA of generation time in seconds
 
     async def start_session(self):
         if self.session is None or self.session.closed:
@@ -1204,56 +2310,116 @@ class KoboldAPI:
         except (asyncio.TimeoutError, aiohttp.ClientError):
             return False
 
-    async def generate(self, prompt: str, max_tokens: int = 100) -> str:
-        start_time = datetime.now()
-        async with self._semaphore:  # Limit concurrent requests for maximum single-GPU performance
+    @staticmethod
+    def _build_payload(prompt: str, max_tokens: int) -> dict:
+        # ULTRA-SPEED payload for 10-second generation
+        return {
+            "prompt": prompt, 
+            "max_length": max_tokens, 
+            "temperature": 0.8,  # Higher for fastest decisions
+            "top_p": 0.75,      # More aggressive sampling
+            "min_p": 0.2,       # Much faster token selection
+            "rep_pen": 1.02,    # Absolute minimal penalty
+            "stop_sequence": ["<|im_end|>", "\n\n"]  # Ultra-minimal stops
+        }
+
+    async def generate_stream(self, prompt: str, max_tokens: int = 100):
+        """Yield tokens from KoboldCPP's SSE endpoint as they are generated."""
+        stream_url = self.base_url.replace('/api/v1/generate', '/api/extra/generate/stream')
+        async with self._semaphore:
             if not self.session or self.session.closed:
                 raise RuntimeError("API session is not started or has been closed.")
-            
-            # ULTRA-SPEED payload for 10-second generation
-            payload = {
-                "prompt": prompt, 
-                "max_length": max_tokens, 
-                "temperature": 0.8,  # Higher for fastest decisions
-                "top_p": 0.75,      # More aggressive sampling
-                "min_p": 0.2,       # Much faster token selection
-                "rep_pen": 1.02,    # Absolute minimal penalty
-                "stop_sequence": ["<|im_end|>", "\n\n"]  # Ultra-minimal stops
-            }
-            logger.info(f"[KOBOLD FAST] Starting generation, prompt: {prompt[:50]}...")
-            try:
-                async with self.session.post(self.base_url, json=payload, timeout=60) as response:  # Extended timeout for complete generation
-                    if response.status == 200:
-                        data = await response.json()
-                        text = data['results'][0]['text'].strip()
-                        if "User:" in text: text = text.split("User:")[0].strip()
-                        if "<|im_start|>" in text: text = text.split("<|im_start|>")[0].strip()
-                        for char_key in CHARACTERS:
-                            char_name = CHARACTERS[char_key]['full_name']
-                            if text.lower().startswith(char_name.lower() + ":"):
-                                text = text[len(char_name)+1:].lstrip()
-                        
-                        end_time = datetime.now()
-                        duration = (end_time - start_time).total_seconds()
-                        logger.info(f"[KOBOLD] ✅ Generation completed in {duration:.2f}s: {text[:100]}...")
-                        return text
-                    else:
-                        logger.error(f"Kobold API returned status {response.status}")
-                        return ""
-            except asyncio.TimeoutError:
-                logger.error(f"[KOBOLD TIMEOUT] Request timed out after 60 seconds for prompt: {prompt[:100]}...")
-                return "Hey there! Sorry, I'm thinking a bit slow right now... What's on your mind? 😊"
-            except aiohttp.ClientError as e:
-                logger.error(f"[KOBOLD ERROR] Client error during generation: {e}")
-                return "I'm having some connection issues... let's try chatting again! 💕"
+            start = perf_counter()
+            async with self.session.post(stream_url, json=self._build_payload(prompt, max_tokens), timeout=60) as response:
+                if response.status != 200:
+                    logger.error("[KOBOLD STREAM] API returned status %s", response.status)
+                    return
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8', 'ignore').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    try:
+                        token = json.loads(line[5:]).get('token', '')
+                    except json.JSONDecodeError:
+                        continue
+                    if token:
+                        yield token
+            METRICS.observe('kobold_generation_seconds', perf_counter() - start, mode='stream')
+
+    def estimated_wait(self) -> float:
+        """Rough seconds a new request would wait for a generation slot."""
+        return self.waiting / self.max_concurrency * self.avg_latency
+
+    async def generate(self, prompt: str, max_tokens: int = 100) -> str:
+        start_time = datetime.now()
+        # Limit concurrent requests for maximum single-GPU performance
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            slot_time = datetime.now()
+            with METRICS.time('kobold_generation_seconds', mode='complete'):
+                text = await self._generate(prompt, max_tokens, start_time)
+            self.avg_latency = 0.8 * self.avg_latency + 0.2 * (datetime.now() - slot_time).total_seconds()
+            return text
+        finally:
+            self._semaphore.release()
+
+    async def _generate(self, prompt: str, max_tokens: int, start_time: datetime) -> str:
+        if not self.session or self.session.closed:
+            raise RuntimeError("API session is not started or has been closed.")
+        
+        payload = self._build_payload(prompt, max_tokens)
+        logger.debug("[KOBOLD FAST] Starting generation, prompt: %.50s...", prompt)
+        try:
+            async with self.session.post(self.base_url, json=payload, timeout=60) as response:  # Extended timeout for complete generation
+                if response.status == 200:
+                    data = await response.json()
+                    text = data['results'][0]['text'].strip()
+                    if "User:" in text: text = text.split("User:")[0].strip()
+                    if "<|im_start|>" in text: text = text.split("<|im_start|>")[0].strip()
+                    for char_key in CHARACTERS:
+                        char_name = CHARACTERS[char_key]['full_name']
+                        if text.lower().startswith(char_name.lower() + ":"):
+                            text = text[len(char_name)+1:].lstrip()
+                    
+                    end_time = datetime.now()
+                    duration = (end_time - start_time).total_seconds()
+                    logger.info("[KOBOLD] ✅ Generation completed in %.2fs", duration)
+                    logger.debug("[KOBOLD] Output: %.100s...", text)
+                    return text
+                else:
+                    logger.error(f"Kobold API returned status {response.status}")
+                    return ""
+        except asyncio.TimeoutError:
+            logger.error("[KOBOLD TIMEOUT] Request timed out after 60 seconds for prompt: %s...", prompt[:100])
+            METRICS.inc('fallback_responses_total', source='kobold_timeout')
+            return "Hey there! Sorry, I'm thinking a bit slow right now... What's on your mind? 😊"
+        except aiohttp.ClientError as e:
+            logger.error(f"[KOBOLD ERROR] Client error during generation: {e}")
+            METRICS.inc('fallback_responses_total', source='kobold_error')
+            return "I'm having some connection issues... let's try chatting again! 💕"
+
+_replicate_clients: Dict[str, Any] = {}
+
+def get_replicate_client(api_token: str):
+    """Shared Replicate client per token; the SDK is imported on first use."""
+    client = _replicate_clients.get(api_token)
+    if client is None:
+        import replicate
+        client = _replicate_clients[api_token] = replicate.Client(api_token=api_token)
+    return client
 
 def classify_image_nsfw(image_url: str, api_token: str) -> str:
     """Classifies the image as 'normal', 'sexy', or 'porn' using Replicate's NSFW model."""
-    client = replicate.Client(api_token=api_token)
-    output = client.run(
-        "falcons-ai/nsfw_image_detection:97116600cabd3037e5f22ca08ffcc33b92cfacebf7ccd3609e9c1d29e43d3a8d",
-        input={"image": image_url}
-    )
+    client = get_replicate_client(api_token)
+    with METRICS.time('replicate_run_seconds', model='nsfw_detection'):
+        output = client.run(
+            "falcons-ai/nsfw_image_detection:97116600cabd3037e5f22ca08ffcc33b92cfacebf7ccd3609e9c1d29e43d3a8d",
+            input={"image": image_url}
+        )
     return output  # 'normal', 'sexy', or 'porn'
 
 class ImageGenerator:
@@ -1261,13 +2427,15 @@ class ImageGenerator:
     def __init__(self, api_token: str, kobold_api: KoboldAPI):
         if not api_token:
             logger.warning("Replicate API token is not set. Image generation will be disabled.")
-            self.client = None
-        else:
-            self.client = replicate.Client(api_token=api_token)
-            logger.info("ImageGenerator initialized with Replicate client.")
+        self.api_token = api_token
         self.kobold_api = kobold_api
         self.nsfw_keywords = ['naked', 'nude', 'sex', 'fuck', 'cock', 'pussy', 'slut', 'horny', 'undress', 'strip']
 
+    @property
+    def client(self):
+        """The Replicate client, created on the first image request; None without a token."""
+        return get_replicate_client(self.api_token) if self.api_token else None
+
     async def _engineer_prompt(self, character: Dict, scenario_prompt: str, outfit: str, clothing_state: str, user_message: Optional[str] = None) -> str:
         """
         Builds a short, direct image prompt using the character's trigger word, scenario, outfit, and the latest user message.
@@ -1353,11 +2521,12 @@ class ImageGenerator:
             }
             if not self.client:
                 return None, None, engineered_prompt
-            output = await asyncio.to_thread(
-                self.client.run,
-                character['lora_model_id'],
-                input=input_params
-            )
+            with METRICS.time('replicate_run_seconds', model='character_lora'):
+                output = await asyncio.to_thread(
+                    self.client.run,
+                    character['lora_model_id'],
+                    input=input_params
+                )
             if output and isinstance(output, list) and len(output) > 0:
                 final_image_url = str(output[0])
                 if not REPLICATE_API_TOKEN:
@@ -1405,7 +2574,16 @@ class VideoGenerator:
     def __init__(self, api_token: str):
         self.api_token = api_token
         # Wavespeed API endpoint
-        self.wavespeed_api_url = os.getenv('WAVESPEED_API_URL', 'https://api.wavespeed.ai/api/v3/wavespeed-ai/wan-2.1/i2v-480p-lora')
+        self.wavespeed_api_url = os.getenv('WAVESPEED_API_URL', f'{WAVESPEED_BASE_URL}/wavespeed-ai/wan-2.1/i2v-480p-lora')
+        self.session = None
+
+    async def start_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+
+    async def close_session(self):
+        if self.session:
+            await self.session.close()
 
     async def submit_video_task(self, image_url: str, prompt: str, lora_url: Optional[str] = None) -> Optional[str]:
         """
@@ -1463,22 +2641,23 @@ class VideoGenerator:
                     "Content-Type": "application/json"
                 }
                 
-                async with session.post(
-                    self.wavespeed_api_url,
-                    json=payload,
-                    headers=headers,
-                    timeout=30
-                ) as response:
+                with METRICS.time('wavespeed_request_seconds', operation='submit'):
+                    async with session.post(
+                        self.wavespeed_api_url,
+                        json=payload,
+                        headers=headers,
+                        timeout=30
+                    ) as response:
                     
-                    if response.status == 200:
-                        result = await response.json()
-                        # According to Wavespeed docs, the task ID is in data.id
-                        task_id = result.get('data', {}).get('id')
-                        logger.info(f"[VIDEO] Task submitted successfully, task_id: {task_id}")
-                        logger.info(f"[VIDEO] Full response: {result}")
+                        if response.status == 200:
+                            result = await response.json()
+                            # According to Wavespeed docs, the task ID is in data.id
+                            task_id = result.get('data', {}).get('id')
+                            logger.info(f"[VIDEO] Task submitted successfully, task_id: {task_id}")
+                            logger.debug("[VIDEO] Full response: %s", result)
                         
-                        # Return the actual task ID from the response
-                        return task_id
+                            # Return the actual task ID from the response
+                            return task_id
         except Exception as e:
             logger.error(f"[VIDEO] Video task submission failed: {e}")
             return None
@@ -1522,93 +2701,964 @@ class VideoGenerator:
 
 
 
-    async def poll_video_completion(self, task_id: str, user_id: int, max_attempts: int = 60) -> Optional[str]:
-        """Poll for video completion and deliver when ready."""
-        logger.info(f"[VIDEO POLL] Starting polling for task {task_id}, user {user_id}")
-        
-        for attempt in range(max_attempts):
-            try:
-                # check_video_status returns video URL (string) if completed, None if not ready
-                video_url = await self.check_video_status(task_id)
-                
-                logger.info(f"[VIDEO POLL] Attempt {attempt + 1}/{max_attempts} - Task {task_id}: {'completed' if video_url else 'processing'}")
-                
-                if video_url:
-                    # Video is ready
-                    logger.info(f"[VIDEO POLL] Task {task_id} completed! Video URL: {video_url}")
-                    return video_url
-                else:
-                    # Still processing, wait and try again
-                    logger.info(f"[VIDEO POLL] Task {task_id} still processing, waiting 10 seconds...")
-                    await asyncio.sleep(10)  # Wait 10 seconds between polls
-                    continue
-                    
-            except Exception as e:
-                logger.error(f"[VIDEO POLL] Error polling task {task_id}: {e}")
-                await asyncio.sleep(10)
-                continue
-        
-        logger.error(f"[VIDEO POLL] Task {task_id} timed out after {max_attempts} attempts")
-        return None
-
     def _get_conservative_video_prompt(self, original_prompt: str) -> str:
         """Generate a very conservative video prompt as fallback."""
         return "elegant woman, graceful movement, cinematic lighting, artistic composition, beautiful, sophisticated, no explicit content"
 
     async def check_video_status(self, task_id: str) -> Optional[str]:
         """Check video status and return video URL if completed."""
+        status, video_url = await self.get_video_status(task_id)
+        return video_url if status == 'completed' else None
+
+    async def get_video_status(self, task_id: str) -> Tuple[str, Optional[str]]:
+        """Return (status, video_url) for a task. Status is completed, failed, processing or error."""
         if not self.api_token:
-            return None
-            
-        try:
-            async with aiohttp.ClientSession() as session:
-                headers = {
-                    "Authorization": f"Bearer {self.api_token}",
-                    "Content-Type": "application/json"
-                }
-                
-                # Use the result URL from the task submission
-                result_url = f"https://api.wavespeed.ai/api/v3/predictions/{task_id}/result"
-                
-                async with session.get(result_url, headers=headers, timeout=30) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        logger.info(f"[VIDEO STATUS] Task {task_id} status: {result}")
-                        
-                        # Check if video is completed
-                        status = result.get('data', {}).get('status')
-                        outputs = result.get('data', {}).get('outputs', [])
-                        
-                        if status == 'completed' and outputs:
-                            video_url = outputs[0]
-                            logger.info(f"[VIDEO STATUS] Video completed: {video_url}")
-                            return video_url
-                        elif status == 'failed':
-                            logger.error(f"[VIDEO STATUS] Task {task_id} failed")
-                            return None
-        except Exception as e:
-            logger.error(f"[VIDEO STATUS] Error checking video status: {e}")
-            return None
+            return 'error', None
+        if not self.session or self.session.closed:
+            await self.start_session()
 
-class ElevenLabsManager:
-    """Manages ElevenLabs API interactions for voice notes and calls."""
-    
-    def __init__(self, api_key: str):
-        # Set API key as environment variable for ElevenLabs
-        self.api_key = api_key
-        self._init_client()
-    
-    def _init_client(self):
-        """Initialize the ElevenLabs client."""
+        headers = {
+            "Authorization": f"Bearer {self.api_token}",
+            "Content-Type": "application/json"
+        }
+        result_url = f"{WAVESPEED_BASE_URL}/predictions/{task_id}/result"
         try:
-            from elevenlabs.client import ElevenLabs
-            self.client = ElevenLabs(api_key=self.api_key)
-            logger.info("[ELEVENLABS] Client initialized successfully")
+            with METRICS.time('wavespeed_request_seconds', operation='poll'):
+                async with self.session.get(result_url, headers=headers, timeout=30) as response:
+                    if response.status != 200:
+                        logger.warning("[VIDEO STATUS] Task %s returned HTTP %s", task_id, response.status)
+                        return 'error', None
+                    result = await response.json()
         except Exception as e:
-            logger.error(f"[ELEVENLABS] Failed to initialize client: {e}")
-    
-    def add_audio_tags(self, text: str) -> str:
-        """Add audio tags to make the text more natural for voice generation."""
+            logger.error("[VIDEO STATUS] Error checking video status: %s", e)
+            return 'error', None
+
+        status = result.get('data', {}).get('status')
+        outputs = result.get('data', {}).get('outputs', [])
+        logger.debug("[VIDEO STATUS] Task %s: %s", task_id, status)
+        if status == 'completed' and outputs:
+            logger.info("[VIDEO STATUS] Video completed: %s", outputs[0])
+            return 'completed', outputs[0]
+        if status == 'failed':
+            logger.error("[VIDEO STATUS] Task %s failed: %s", task_id, result.get('data', {}).get('error'))
+            return 'failed', None
+        return 'processing', None
+
+class VideoTaskPoller:
+    """Owns every pending Wavespeed task and polls them all from a single loop.
+
+    Checks are sparse while a render is young and tighten around the expected
+    finish time. A task is never checked twice at once, and pending tasks are
+    stored in the video_tasks table so a restart picks them back up. Each task
+    is leased to one replica, which must still hold it to deliver or refund.
+    A finished render stays 'delivering' until Telegram has accepted the video,
+    so a crash mid-send is retried instead of losing the paid video.
+    """
+
+    def __init__(self, video_generator: 'VideoGenerator', on_complete, on_failed):
+        self.video_generator = video_generator
+        self.on_complete = on_complete  # async (user_id, task_id, video_url) -> delivered
+        self.on_failed = on_failed  # async (user_id, task_id, reason, gem_cost)
+        self.pending: Dict[str, dict] = {}
+        self._in_flight = set()
+        self._semaphore = asyncio.Semaphore(VIDEO_POLL_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._lease_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.video_generator.start_session()
+        resumed = await self._claim()
+        if resumed:
+            logger.info("[VIDEO POLL] Resumed %s pending video tasks", resumed)
+        if not self._loop_task:
+            self._loop_task = asyncio.create_task(self._run())
+            self._lease_task = asyncio.create_task(self._lease_loop())
+
+    async def stop(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+            self._lease_task.cancel()
+            await asyncio.gather(self._loop_task, self._lease_task, return_exceptions=True)
+            self._loop_task = self._lease_task = None
+        await self.video_generator.close_session()
+
+    async def add(self, task_id: str, user_id: int, gem_cost: int = 0):
+        """Start tracking a freshly submitted task."""
+        await asyncio.to_thread(Database.save_video_task, task_id, user_id, gem_cost)
+        self._track(task_id, user_id, gem_cost, datetime.now(timezone.utc))
+        logger.info("[VIDEO POLL] Tracking task %s for user %s (%s pending)", task_id, user_id, len(self.pending))
+
+    async def _claim(self) -> int:
+        claimed = 0
+        for row in await asyncio.to_thread(Database.claim_video_tasks):
+            if row['task_id'] in self.pending:
+                continue
+            submitted_at = datetime.now(timezone.utc)
+            if row.get('created_at'):
+                try:
+                    submitted_at = datetime.fromisoformat(row['created_at'].replace('Z', '+00:00'))
+                except ValueError:
+                    pass
+            self._track(row['task_id'], row['user_id'], row.get('gem_cost', 0), submitted_at)
+            if row.get('status') == 'delivering':
+                self.pending[row['task_id']].update(status='delivering', video_url=row.get('video_url'), next_check=datetime.now(timezone.utc))
+            claimed += 1
+        return claimed
+
+    async def _lease_loop(self):
+        """Keep our leases alive and pick up tasks left behind by a replica that went away."""
+        while True:
+            await asyncio.sleep(VIDEO_TASK_CLAIM_INTERVAL_SECONDS)
+            try:
+                claimed = await self._claim()
+                if claimed:
+                    logger.info("[VIDEO POLL] Took over %s abandoned video tasks", claimed)
+            except Exception as e:
+                logger.error("[VIDEO POLL] Lease renewal failed: %s", e)
+
+    def _track(self, task_id: str, user_id: int, gem_cost: int, submitted_at: datetime):
+        self.pending[task_id] = {
+            'user_id': user_id,
+            'gem_cost': gem_cost,
+            'submitted_at': submitted_at,
+            'status': 'pending',
+            'video_url': None,
+            'attempts': 0,
+            'next_check': submitted_at + timedelta(seconds=self._next_interval(0))
+        }
+        self._wakeup.set()
+
+    @staticmethod
+    def _next_interval(elapsed: float) -> float:
+        """Seconds until the next check for a task that has been rendering for `elapsed` seconds."""
+        expected = VIDEO_EXPECTED_RENDER_SECONDS
+        if elapsed < expected * 0.6:
+            return min(30, expected * 0.6 - elapsed + 1)
+        if elapsed < expected * 1.5:
+            return 5
+        return 15
+
+    async def _run(self):
+        while True:
+            now = datetime.now(timezone.utc)
+            next_due = None
+            for task_id, task in list(self.pending.items()):
+                if task_id in self._in_flight:
+                    continue
+                if task['next_check'] <= now:
+                    self._in_flight.add(task_id)
+                    asyncio.create_task(self._check(task_id))
+                elif next_due is None or task['next_check'] < next_due:
+                    next_due = task['next_check']
+            sleep_for = (next_due - now).total_seconds() if next_due else 60
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.5, sleep_for))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, task_id: str):
+        try:
+            task = self.pending.get(task_id)
+            if task and task['status'] in ('delivering', 'delivered'):
+                await self._deliver(task_id, task)
+                return
+            async with self._semaphore:
+                status, video_url = await self.video_generator.get_video_status(task_id)
+            task = self.pending.get(task_id)
+            if not task:
+                return
+            now = datetime.now(timezone.utc)
+            elapsed = (now - task['submitted_at']).total_seconds()
+            if status == 'completed':
+                # Claim the delivery first so only one replica sends it; the row stays open until it is sent
+                started = await asyncio.to_thread(Database.move_video_task, task_id, 'delivering', 'pending', video_url)
+                if not started:
+                    self.pending.pop(task_id, None)
+                    logger.info("[VIDEO POLL] Task %s already finished or owned elsewhere, not delivering", task_id)
+                    return
+                task.update(status='delivering', video_url=video_url)
+                await self._deliver(task_id, task)
+            elif status == 'failed' or elapsed > VIDEO_TASK_TIMEOUT_SECONDS:
+                final_status = 'failed' if status == 'failed' else 'timed_out'
+                logger.warning("[VIDEO POLL] Task %s %s after %.0fs", task_id, final_status, elapsed)
+                finished = await asyncio.to_thread(Database.move_video_task, task_id, final_status)
+                self.pending.pop(task_id, None)
+                if not finished:
+                    logger.info("[VIDEO POLL] Task %s already finished or owned elsewhere, not refunding", task_id)
+                    return
+                await self.on_failed(task['user_id'], task_id, final_status, task['gem_cost'])
+            else:
+                task['next_check'] = now + timedelta(seconds=self._next_interval(elapsed))
+        except Exception as e:
+            logger.error("[VIDEO POLL] Error checking task %s: %s", task_id, e)
+            task = self.pending.get(task_id)
+            if task:
+                task['next_check'] = datetime.now(timezone.utc) + timedelta(seconds=10)
+        finally:
+            self._in_flight.discard(task_id)
+            self._wakeup.set()
+
+    async def _deliver(self, task_id: str, task: dict):
+        """Send a finished render; close the task once it is sent, refund it once retries run out."""
+        if task['status'] == 'delivering':
+            task['attempts'] += 1
+            if not await self.on_complete(task['user_id'], task_id, task['video_url']):
+                if task['attempts'] < VIDEO_DELIVERY_ATTEMPTS:
+                    logger.warning("[VIDEO POLL] Delivery of task %s failed (attempt %s), retrying", task_id, task['attempts'])
+                    task['next_check'] = datetime.now(timezone.utc) + timedelta(seconds=VIDEO_DELIVERY_RETRY_SECONDS)
+                    return
+                refund = await asyncio.to_thread(Database.move_video_task, task_id, 'delivery_failed', 'delivering')
+                self.pending.pop(task_id, None)
+                if refund:
+                    await self.on_failed(task['user_id'], task_id, 'delivery_failed', task['gem_cost'])
+                return
+            # Sent: from here on only the status write is retried, never the video
+            task['status'] = 'delivered'
+        await asyncio.to_thread(Database.move_video_task, task_id, 'completed', 'delivering')
+        self.pending.pop(task_id, None)
+
+class VideoDeliveryService:
+    """Delivers finished videos to Telegram through a bounded worker pool.
+
+    Telegram is first asked to fetch the video URL itself. Only if it refuses is the
+    file downloaded, streamed in chunks into a spooled temp file (capped at
+    VIDEO_MAX_DOWNLOAD_BYTES) and uploaded from there, so a delivery never holds the
+    whole MP4 in memory and never blocks the event loop.
+    """
+
+    def __init__(self, workers: int = VIDEO_DELIVERY_WORKERS, max_bytes: int = VIDEO_MAX_DOWNLOAD_BYTES):
+        self.workers = max(1, workers)
+        self.max_bytes = max_bytes
+        self.bot = None
+        self.session = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+
+    async def start(self, bot):
+        self.bot = bot
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=VIDEO_DOWNLOAD_TIMEOUT, sock_read=30)
+            )
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+            logger.info("[DELIVER VIDEO] Started %s delivery workers", self.workers)
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # Nobody will send what is still queued; answer every waiting deliver() with a failure
+        while not self._queue.empty():
+            _chat_id, _video_url, future = self._queue.get_nowait()
+            self._queue.task_done()
+            if not future.done():
+                future.set_result(False)
+        if self.session:
+            await self.session.close()
+
+    async def deliver(self, chat_id: int, video_url: str) -> bool:
+        """Queue a video for delivery and wait for the outcome."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((chat_id, video_url, future))
+        return await future
+
+    async def _worker(self, worker_id: int):
+        while True:
+            chat_id, video_url, future = await self._queue.get()
+            delivered = False
+            try:
+                with outbound_priority('paid'):
+                    delivered = await self._send(chat_id, video_url)
+            except Exception as e:
+                logger.error("[DELIVER VIDEO] Worker %s failed to deliver video to %s: %s", worker_id, chat_id, e)
+            finally:
+                # Also runs when stop() cancels us mid-send, so the caller is never left waiting
+                self._queue.task_done()
+                if not future.done():
+                    future.set_result(delivered)
+
+    async def _send(self, chat_id: int, video_url: str) -> bool:
+        try:
+            await self.bot.send_video(chat_id=chat_id, video=video_url, supports_streaming=True)
+            logger.info("[DELIVER VIDEO] Video sent by URL to user %s", chat_id)
+            return True
+        except BadRequest as e:
+            # Telegram could not fetch the URL (too large, wrong content type, ...)
+            logger.info("[DELIVER VIDEO] Telegram rejected URL for user %s (%s), uploading file instead", chat_id, e)
+
+        with tempfile.SpooledTemporaryFile(max_size=VIDEO_SPOOL_MEMORY_BYTES) as spool:
+            size = await self._download(video_url, spool)
+            if size is None:
+                return False
+            spool.seek(0)
+            await self.bot.send_video(
+                chat_id=chat_id,
+                video=InputFile(spool, filename='video.mp4', read_file_handle=False),
+                supports_streaming=True,
+                write_timeout=120
+            )
+        logger.info("[DELIVER VIDEO] Uploaded %.1fMB video to user %s", size / 1024 / 1024, chat_id)
+        return True
+
+    async def _download(self, video_url: str, spool) -> Optional[int]:
+        """Stream the video into spool. Returns the byte count, or None on failure."""
+        try:
+            async with self.session.get(video_url) as response:
+                if response.status != 200:
+                    logger.error("[DELIVER VIDEO] Download failed with HTTP %s: %s", response.status, video_url)
+                    return None
+                if response.content_length and response.content_length > self.max_bytes:
+                    logger.error("[DELIVER VIDEO] Video too large (%s bytes): %s", response.content_length, video_url)
+                    return None
+                size = 0
+                async for chunk in response.content.iter_chunked(VIDEO_DOWNLOAD_CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        logger.error("[DELIVER VIDEO] Video exceeded %s bytes mid-download: %s", self.max_bytes, video_url)
+                        return None
+                    spool.write(chunk)
+                return size
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.error("[DELIVER VIDEO] Download error for %s: %s", video_url, e)
+            return None
+
+class PremiumJobError(Exception):
+    """Raised by premium job handlers. Non-retryable errors fail the job straight away."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+class PremiumJobQueue:
+    """Durable background queue for paid deliverables (images, videos, voice notes).
+
+    Jobs live in the premium_jobs table under an idempotency key tied to the gem
+    debit, and each deliverable type has its own worker pool so a slow provider only
+    backs up its own queue. Failures are retried with exponential backoff; once the
+    attempts run out the job's gems are refunded exactly once.
+
+    Every replica runs a queue. A job is leased to the replica that created or
+    claimed it, renewed while it runs, and only picked up elsewhere once that
+    lease runs out.
+    """
+
+    def __init__(self, handlers: Dict[str, Any], on_failed, workers: Dict[str, int] = PREMIUM_JOB_WORKERS):
+        self.handlers = handlers  # job_type -> async handler(job)
+        self.on_failed = on_failed  # async (job, error, refunded)
+        self.workers = workers
+        self._queues: Dict[str, asyncio.Queue] = {job_type: asyncio.Queue() for job_type in handlers}
+        self._held = set()  # ids of jobs leased to this replica and not yet finished
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        resumed = await self._claim()
+        if resumed:
+            logger.info(f"[PREMIUM JOB] Resumed {resumed} unfinished jobs")
+        if not self._tasks:
+            for job_type in self.handlers:
+                for i in range(self.workers.get(job_type, 1)):
+                    self._tasks.append(asyncio.create_task(self._worker(job_type, i)))
+            self._tasks.append(asyncio.create_task(self._claim_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, job: dict):
+        self._held.add(job['id'])
+        await self._queues[job['job_type']].put(job)
+
+    def queue_depths(self) -> Dict[str, int]:
+        return {job_type: queue.qsize() for job_type, queue in self._queues.items()}
+
+    async def _claim(self) -> int:
+        claimed = 0
+        for job in await asyncio.to_thread(Database.claim_premium_jobs):
+            if job['job_type'] in self._queues and job['id'] not in self._held:
+                self._held.add(job['id'])
+                self._queues[job['job_type']].put_nowait(job)
+                claimed += 1
+        return claimed
+
+    async def _claim_loop(self):
+        """Pick up jobs left behind by a replica that stopped before finishing them."""
+        while True:
+            await asyncio.sleep(PREMIUM_JOB_CLAIM_INTERVAL_SECONDS)
+            try:
+                claimed = await self._claim()
+                if claimed:
+                    logger.info(f"[PREMIUM JOB] Took over {claimed} abandoned jobs")
+            except Exception as e:
+                logger.error(f"[PREMIUM JOB] Claim sweep failed: {e}")
+
+    @staticmethod
+    def _lease_until(delay: float = 0) -> str:
+        return (datetime.now(timezone.utc) + timedelta(seconds=delay + PREMIUM_JOB_LEASE_SECONDS)).isoformat()
+
+    async def _worker(self, job_type: str, worker_id: int):
+        queue = self._queues[job_type]
+        while True:
+            job = await queue.get()
+            try:
+                with outbound_priority('paid'):
+                    await self._run(job)
+            except Exception as e:
+                logger.error(f"[PREMIUM JOB] {job_type} worker {worker_id} crashed on job {job.get('id')}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _keep_leased(self, job: dict):
+        """Extend the job's lease while it runs, so a long render is never taken over and redone."""
+        while True:
+            await asyncio.sleep(PREMIUM_JOB_LEASE_RENEW_SECONDS)
+            if not await asyncio.to_thread(Database.renew_premium_job_lease, job['id'], self._lease_until()):
+                logger.warning(f"[PREMIUM JOB] Lost the lease on job {job['id']} while running it")
+                return
+
+    async def _write_status(self, job: dict, **fields):
+        """Retry a final status write; giving up leaves the job to be picked up once its lease runs out."""
+        for attempt in range(PREMIUM_JOB_STATUS_WRITE_ATTEMPTS):
+            if await asyncio.to_thread(Database.update_premium_job, job['id'], **fields):
+                return True
+            await asyncio.sleep(min(2 ** attempt, 30))
+        logger.error(f"[PREMIUM JOB] Could not record status {fields.get('status')} for job {job['id']}")
+        return False
+
+    async def _run(self, job: dict):
+        renewer = asyncio.create_task(self._keep_leased(job))
+        try:
+            await self._attempt(job)
+        finally:
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+
+    async def _attempt(self, job: dict):
+        job['attempts'] = job.get('attempts', 0) + 1
+        logger.info(f"[PREMIUM JOB] Running {job['job_type']} job {job['id']} for user {job['user_id']} (attempt {job['attempts']})")
+        await asyncio.to_thread(Database.update_premium_job, job['id'], status='running', attempts=job['attempts'],
+                                claimed_by=INSTANCE_ID, lease_until=self._lease_until())
+        try:
+            await self.handlers[job['job_type']](job)
+        except Exception as e:
+            if getattr(e, 'retryable', True) and job['attempts'] < PREMIUM_JOB_MAX_ATTEMPTS:
+                delay = PREMIUM_JOB_BACKOFF_SECONDS * 2 ** (job['attempts'] - 1) + random.uniform(0, 1)
+                logger.warning(f"[PREMIUM JOB] Job {job['id']} failed ({e}), retrying in {delay:.1f}s")
+                # The lease covers the backoff so no other replica takes the retry
+                await asyncio.to_thread(Database.update_premium_job, job['id'], status='queued', last_error=str(e),
+                                        lease_until=self._lease_until(delay))
+                asyncio.get_running_loop().call_later(delay, self._queues[job['job_type']].put_nowait, job)
+                return
+            logger.error(f"[PREMIUM JOB] Job {job['id']} failed permanently after {job['attempts']} attempts: {e}")
+            if not await self._write_status(job, status='failed', last_error=str(e)):
+                return  # the refund needs the 'failed' row; the job is picked up again once its lease runs out
+            self._held.discard(job['id'])
+            refunded = await asyncio.to_thread(Database.refund_premium_job, job)
+            await asyncio.to_thread(Database.clear_pending_gem_refund, job['user_id'])
+            await self.on_failed(job, e, refunded)
+            return
+        if not await self._write_status(job, status='succeeded', last_error=None):
+            return  # still held here, so our own claim sweep will not hand it back to a worker
+        self._held.discard(job['id'])
+        await asyncio.to_thread(Database.clear_pending_gem_refund, job['user_id'])
+        logger.info(f"[PREMIUM JOB] Job {job['id']} succeeded")
+
+class PaymentEventBus:
+    """Pushes gem and subscription changes to subscribers the moment they happen.
+
+    Payments processed in this process are published directly. Changes made
+    anywhere else (web app, SQL RPCs, another replica) arrive over Postgres
+    LISTEN/NOTIFY on PAYMENT_EVENTS_CHANNEL when a database DSN is configured.
+    """
+
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn
+        self.on_reconnect = None  # optional async (since) that replays changes NOTIFY may have missed
+        self._subscribers = []
+        self._connection = None
+        self._listen_task: Optional[asyncio.Task] = None
+        self._catch_up_task: Optional[asyncio.Task] = None
+
+    @property
+    def listening(self) -> bool:
+        return self._connection is not None and not self._connection.is_closed()
+
+    def subscribe(self, callback):
+        """Register callback(event) for every payment event."""
+        self._subscribers.append(callback)
+
+    def publish(self, event: dict):
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"[PAYMENT EVENTS] Subscriber failed for {event}: {e}")
+
+    async def start(self):
+        if not self.dsn:
+            logger.warning("[PAYMENT EVENTS] SUPABASE_DB_URL not set - only locally processed payments are pushed")
+            return
+        if not self._listen_task:
+            self._listen_task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        for task in (self._listen_task, self._catch_up_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._listen_task = self._catch_up_task = None
+
+    async def _listen(self):
+        down_since: Optional[datetime] = None  # when the previous connection was lost
+        while True:
+            lost = asyncio.Event()
+            try:
+                self._connection = await asyncpg.connect(self.dsn)
+                self._connection.add_termination_listener(lambda _conn: lost.set())
+                await self._connection.add_listener(PAYMENT_EVENTS_CHANNEL, self._on_notify)
+                logger.info(f"[PAYMENT EVENTS] Listening on '{PAYMENT_EVENTS_CHANNEL}'")
+                if down_since and self.on_reconnect:
+                    # NOTIFYs sent while we were disconnected are gone; replay that window from the table
+                    since = down_since - timedelta(seconds=PAYMENT_CATCH_UP_MARGIN_SECONDS)
+                    self._catch_up_task = asyncio.create_task(self.on_reconnect(since))
+                down_since = None
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), PAYMENT_LISTEN_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        # A half-open socket never fires the termination listener; a ping notices it
+                        await asyncio.wait_for(self._connection.fetchval('SELECT 1'), PAYMENT_LISTEN_RETRY_SECONDS)
+                logger.warning("[PAYMENT EVENTS] LISTEN connection lost")
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                logger.warning("[PAYMENT EVENTS] LISTEN connection stopped answering keepalives")
+            except Exception as e:
+                logger.error(f"[PAYMENT EVENTS] LISTEN connection failed: {e}")
+            finally:
+                if self._connection and not self._connection.is_closed():
+                    # terminate() rather than close(): a dead socket would hang the close handshake
+                    self._connection.terminate()
+                if self._connection and not down_since:
+                    down_since = datetime.now(timezone.utc)
+                self._connection = None
+            await asyncio.sleep(PAYMENT_LISTEN_RETRY_SECONDS)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            event = json.loads(payload)
+        except (TypeError, ValueError):
+            logger.warning(f"[PAYMENT EVENTS] Ignoring malformed payload: {payload!r}")
+            return
+        event.setdefault('source', 'database')
+        self.publish(event)
+
+class LeaderLock:
+    """Elects the one replica that runs cluster-wide chores (the daily broadcast, state purges).
+
+    Leadership is a Postgres session-level advisory lock held on a dedicated asyncpg
+    connection, so it passes to another replica as soon as the leader's connection
+    drops. Without a DSN there is nothing to coordinate with and this process leads.
+    """
+
+    def __init__(self, dsn: Optional[str] = None, key: int = LEADER_LOCK_KEY):
+        self.dsn = dsn
+        self.key = key
+        self.is_leader = False
+        self.on_elected = None  # optional async callback, run each time this replica becomes leader
+        self._connection = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not self.dsn:
+            self.is_leader = True
+            if self.on_elected:
+                await self.on_elected()
+            return
+        # Try once up front so startup knows whether to resume leader-only work
+        await self._try_acquire()
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._close()
+
+    async def _try_acquire(self) -> bool:
+        try:
+            if self._connection is None or self._connection.is_closed():
+                self._connection = await asyncpg.connect(self.dsn)
+            if await self._connection.fetchval('SELECT pg_try_advisory_lock($1)', self.key):
+                self.is_leader = True
+                logger.info(f"[LEADER] {INSTANCE_ID} is now the leader")
+        except Exception as e:
+            logger.error(f"[LEADER] Could not try the leader lock: {e}")
+            await self._close()
+        return self.is_leader
+
+    async def _run(self):
+        while True:
+            if self.is_leader:
+                lost = asyncio.Event()
+                self._connection.add_termination_listener(lambda _conn: lost.set())
+                if self.on_elected:
+                    try:
+                        await self.on_elected()
+                    except Exception as e:
+                        logger.error(f"[LEADER] Leader start-up work failed: {e}")
+                await lost.wait()
+                logger.warning("[LEADER] Lost the leader lock connection")
+                self.is_leader = False
+                await self._close()
+            await asyncio.sleep(LEADER_RETRY_SECONDS)
+            await self._try_acquire()
+
+    async def _close(self):
+        if self._connection and not self._connection.is_closed():
+            await self._connection.close()
+        self._connection = None
+
+class ReengagementBroadcaster:
+    """Sends the daily "I miss you" nudge to dormant users.
+
+    Users are paged with a keyset cursor on (last_seen, telegram_id). Sends go
+    out in the outbound scheduler's lowest class, which owns pacing and
+    RetryAfter retries. The cursor is checkpointed in broadcast_runs after
+    every small batch, so a restart resumes where it stopped. A run belongs to the replica that claimed its row; checkpoints
+    renew that lease. Users nudged recently are skipped and users who blocked
+    the bot are marked so later runs leave them out.
+    """
+
+    def __init__(self, concurrency: int = BROADCAST_CONCURRENCY):
+        self.concurrency = concurrency
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot, run: Optional[dict] = None) -> bool:
+        """Start (or resume) a run in the background. Returns False if one is already going."""
+        if self.running:
+            return False
+        self._task = asyncio.create_task(self._run(bot, run))
+        return True
+
+    async def resume(self, bot):
+        run = await asyncio.to_thread(Database.get_unfinished_broadcast_run, 'reengagement')
+        if run:
+            logger.info(f"[BROADCAST] Resuming {run['run_key']} after user {run.get('cursor_telegram_id')}")
+            self.start(bot, run)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, bot, run: Optional[dict]):
+        now = datetime.now(timezone.utc)
+        if run is None:
+            run = {
+                'run_key': f"reengagement:{now.date().isoformat()}",
+                'kind': 'reengagement',
+                'status': 'running',
+                'inactive_before': (now - timedelta(hours=REENGAGEMENT_INACTIVE_HOURS)).isoformat(),
+                'cursor_last_seen': None,
+                'cursor_telegram_id': 0,
+                'sent': 0,
+                'failed': 0,
+                'blocked': 0,
+                'started_at': now.isoformat()
+            }
+        # Only the replica that wins the claim sends; the others leave the run alone
+        claimed = await asyncio.to_thread(Database.claim_broadcast_run, run)
+        if not claimed:
+            logger.info(f"[BROADCAST] {run['run_key']} already completed or running on another replica")
+            return
+        run = {key: value for key, value in claimed.items() if key not in ('claimed_by', 'lease_until', 'updated_at')}
+        cooldown_before = (now - timedelta(days=REENGAGEMENT_COOLDOWN_DAYS)).isoformat()
+
+        try:
+            while True:
+                page = await asyncio.to_thread(
+                    Database.get_reengagement_candidates,
+                    run['inactive_before'], cooldown_before,
+                    run.get('cursor_last_seen'), run.get('cursor_telegram_id') or 0,
+                    BROADCAST_PAGE_SIZE
+                )
+                if not page:
+                    break
+                for i in range(0, len(page), BROADCAST_CHECKPOINT_BATCH):
+                    batch = page[i:i + BROADCAST_CHECKPOINT_BATCH]
+                    sent, blocked, failed = await self._send_page(bot, [row['telegram_id'] for row in batch])
+                    await asyncio.to_thread(Database.mark_users_reengaged, sent)
+                    await asyncio.to_thread(Database.mark_users_blocked, blocked)
+                    run['cursor_last_seen'] = batch[-1]['last_seen']
+                    run['cursor_telegram_id'] = batch[-1]['telegram_id']
+                    run['sent'] += len(sent)
+                    run['blocked'] += len(blocked)
+                    run['failed'] += failed
+                    await asyncio.to_thread(Database.save_broadcast_run, run)
+                if len(page) < BROADCAST_PAGE_SIZE:
+                    break
+            run['status'] = 'completed'
+            await asyncio.to_thread(Database.save_broadcast_run, run)
+            logger.info(f"[RETENTION] {run['run_key']} done: {run['sent']} sent, {run['blocked']} blocked, {run['failed']} failed")
+        except asyncio.CancelledError:
+            logger.info(f"[BROADCAST] {run['run_key']} interrupted; will resume from checkpoint")
+            raise
+        except Exception as e:
+            logger.error(f"[BROADCAST] {run['run_key']} stopped: {e}")
+
+    async def _send_page(self, bot, user_ids: List[int]) -> Tuple[List[int], List[int], int]:
+        sent, blocked = [], []
+        failed = 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id: int):
+            nonlocal failed
+            async with semaphore:
+                try:
+                    # The scheduler paces the broadcast class and already retries RetryAfter
+                    await bot.send_message(chat_id=user_id, text=REENGAGEMENT_MESSAGE, rate_limit_args='broadcast')
+                    sent.append(user_id)
+                except Forbidden:
+                    blocked.append(user_id)
+                except BadRequest as e:
+                    if 'chat not found' in str(e).lower():
+                        blocked.append(user_id)
+                    else:
+                        failed += 1
+                        logger.warning(f"[RETENTION] Failed to send message to user {user_id}: {e}")
+                except Exception as e:
+                    failed += 1
+                    logger.warning(f"[RETENTION] Failed to send message to user {user_id}: {e}")
+
+        await asyncio.gather(*(send(user_id) for user_id in user_ids))
+        return sent, blocked, failed
+
+class VoiceNoteCache:
+    """On-disk LRU cache of synthesized audio, keyed by (voice_id, model, normalized text).
+
+    Recency is the file mtime, bumped on every hit, and the oldest files are evicted
+    once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory: str = VOICE_CACHE_DIR, max_bytes: int = VOICE_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()  # path -> size, oldest first
+        self._total_bytes = 0
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            files = sorted(self.directory.glob('*.mp3'), key=lambda p: p.stat().st_mtime)
+            for path in files:
+                size = path.stat().st_size
+                self._entries[path] = size
+                self._total_bytes += size
+            logger.info(f"[VOICE CACHE] {len(self._entries)} cached clips ({self._total_bytes / 1024 / 1024:.1f}MB) in {self.directory}")
+        except OSError as e:
+            logger.warning(f"[VOICE CACHE] Cache directory unavailable, caching disabled: {e}")
+            self.directory = None
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize('NFC', text).split())
+
+    def path_for(self, voice_id: str, model: str, text: str) -> Optional[Path]:
+        if self.directory is None:
+            return None
+        digest = hashlib.sha256(f"{voice_id}|{model}|{self.normalize(text)}".encode('utf-8')).hexdigest()
+        return self.directory / f"{digest}.mp3"
+
+    def get(self, path: Optional[Path]) -> Optional[bytes]:
+        if path is None or path not in self._entries:
+            return None
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            self._forget(path)
+            return None
+        self._entries.move_to_end(path)
+        return data
+
+    def commit(self, tmp_path: Path, path: Path):
+        """Move a fully written temp file into the cache and evict old clips."""
+        os.replace(tmp_path, path)
+        self._forget(path)
+        size = path.stat().st_size
+        self._entries[path] = size
+        self._total_bytes += size
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest, _ = next(iter(self._entries.items()))
+            self._forget(oldest)
+            try:
+                oldest.unlink()
+            except OSError:
+                pass
+
+    def _forget(self, path: Path):
+        size = self._entries.pop(path, None)
+        if size:
+            self._total_bytes -= size
+
+_MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],  # MPEG-1 Layer III
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],  # MPEG-2/2.5 Layer III
+}
+_MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def mp3_duration_seconds(data: bytes) -> float:
+    """Duration of an MP3 (Layer III) clip, computed by walking its frame headers."""
+    pos = 0
+    # Skip an ID3v2 tag if present
+    if data[:3] == b'ID3' and len(data) >= 10:
+        pos = 10 + ((data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f))
+    duration = 0.0
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+            pos += 1
+            continue
+        version_bits = (data[pos + 1] >> 3) & 0x03
+        layer_bits = (data[pos + 1] >> 1) & 0x03
+        bitrate_index = data[pos + 2] >> 4
+        rate_index = (data[pos + 2] >> 2) & 0x03
+        padding = (data[pos + 2] >> 1) & 0x01
+        if version_bits == 1 or layer_bits != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            pos += 1
+            continue
+        sample_rate = _MP3_SAMPLE_RATES[version_bits][rate_index]
+        mpeg1 = version_bits == 3
+        bitrate = _MP3_BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+        samples = 1152 if mpeg1 else 576
+        frame_length = (samples // 8) * bitrate // sample_rate + padding
+        duration += samples / sample_rate
+        pos += max(frame_length, 1)
+    return duration
+
+def encode_voice_opus(mp3_bytes: bytes) -> Tuple[bytes, float]:
+    """Transcode an MP3 clip to mono Opus-in-OGG. Runs in a worker process."""
+    from pydub import AudioSegment
+    segment = AudioSegment.from_file(io.BytesIO(mp3_bytes), format='mp3').set_channels(1).set_frame_rate(48000)
+    buffer = io.BytesIO()
+    segment.export(buffer, format='ogg', codec='libopus', bitrate=VOICE_OPUS_BITRATE, parameters=['-application', 'voip'])
+    return buffer.getvalue(), len(segment) / 1000.0
+
+@dataclass
+class EncodedVoiceNote:
+    data: bytes
+    extension: str
+    duration: int  # seconds, as Telegram expects
+
+class VoiceEncoder:
+    """Turns ElevenLabs MP3 output into Telegram-native OGG/Opus voice notes.
+
+    Encoding runs in a process pool so ffmpeg work never touches the event loop.
+    Workers come from a forkserver, not a fork of this process with its logging
+    and to_thread threads, and a pool broken by a dying worker is rebuilt on the
+    next call. Without ffmpeg the MP3 is sent unchanged and its duration is read
+    from the frame headers instead.
+    """
+
+    def __init__(self, workers: int = VOICE_ENCODE_WORKERS):
+        self.workers = workers
+        self.ffmpeg_available = shutil.which('ffmpeg') is not None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        if not self.ffmpeg_available:
+            logger.warning("[VOICE ENCODE] ffmpeg not found - voice notes will be sent as MP3")
+
+    async def encode(self, mp3_bytes: bytes) -> EncodedVoiceNote:
+        start_time = datetime.now()
+        if self.ffmpeg_available:
+            try:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+                ogg_bytes, duration = await asyncio.get_running_loop().run_in_executor(self._pool, encode_voice_opus, mp3_bytes)
+                elapsed = (datetime.now() - start_time).total_seconds()
+                saved = len(mp3_bytes) - len(ogg_bytes)
+                logger.info(
+                    f"[VOICE ENCODE] MP3 {len(mp3_bytes) / 1024:.1f}KB -> Opus {len(ogg_bytes) / 1024:.1f}KB "
+                    f"(saved {saved / 1024:.1f}KB, {saved / max(len(mp3_bytes), 1):.0%}) in {elapsed:.2f}s, {duration:.1f}s audio"
+                )
+                return EncodedVoiceNote(ogg_bytes, 'ogg', max(1, round(duration)))
+            except BrokenProcessPool as e:
+                # A worker died (e.g. ffmpeg OOM); drop the pool so the next note gets a fresh one
+                logger.error(f"[VOICE ENCODE] Encoder pool broke, rebuilding it; sending MP3: {e}")
+                self.shutdown()
+            except Exception as e:
+                logger.error(f"[VOICE ENCODE] Opus encoding failed, sending MP3: {e}")
+        duration = mp3_duration_seconds(mp3_bytes)
+        return EncodedVoiceNote(mp3_bytes, 'mp3', max(1, round(duration)))
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+class ElevenLabsManager:
+    """Manages ElevenLabs API interactions for voice notes and calls."""
+    
+    def __init__(self, api_key: str):
+        # Set API key as environment variable for ElevenLabs
+        self.api_key = api_key
+        self.session = None
+        self.voice_cache = VoiceNoteCache()
+        self._client = None
+
+    async def start_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120, sock_read=30))
+
+    async def close_session(self):
+        if self.session:
+            await self.session.close()
+
+    @contextlib.asynccontextmanager
+    async def _http(self):
+        """The shared session when started, otherwise a throwaway one."""
+        if self.session and not self.session.closed:
+            yield self.session
+        else:
+            async with aiohttp.ClientSession() as session:
+                yield session
+    
+    @property
+    def client(self):
+        """The ElevenLabs SDK client, created on first use. Speech and calls go through aiohttp."""
+        if self._client is None:
+            try:
+                from elevenlabs.client import ElevenLabs
+                self._client = ElevenLabs(api_key=self.api_key, base_url=ELEVENLABS_BASE_URL)
+                logger.info("[ELEVENLABS] Client initialized successfully")
+            except Exception as e:
+                logger.error(f"[ELEVENLABS] Failed to initialize client: {e}")
+        return self._client
+
+    async def check_api_key(self) -> bool:
+        """Validate the API key by listing voices."""
+        if not self.api_key:
+            return False
+        try:
+            async with self._http() as session:
+                async with session.get(f"{ELEVENLABS_BASE_URL}/v1/voices", headers={"xi-api-key": self.api_key},
+                                       timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    return response.status == 200
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.error(f"[ELEVENLABS] API key check failed: {e}")
+            return False
+    
+    def add_audio_tags(self, text: str) -> str:
+        """Add audio tags to make the text more natural for voice generation."""
         # Remove all asterisks from text before processing
         text = text.replace('*', '')
         # Add pauses and emphasis for more natural speech
@@ -1621,19 +3671,118 @@ class ElevenLabsManager:
         return text
     
     async def create_voice_note(self, text: str, voice_id: str) -> Optional[bytes]:
-        """Create a voice note using ElevenLabs API."""
+        """Create a voice note using the ElevenLabs streaming API, served from the disk cache when possible."""
+        # Add audio tags for better voice generation
+        enhanced_text = self.add_audio_tags(text)
+        cache_path = self.voice_cache.path_for(voice_id, ELEVENLABS_TTS_MODEL, enhanced_text)
+        cached = self.voice_cache.get(cache_path)
+        if cached:
+            logger.info("[VOICE NOTE] Cache hit for voice %s (%s bytes)", voice_id, len(cached))
+            return cached
+
+        chunks = []
+        tmp_file = None
         try:
-            # Add audio tags for better voice generation
-            enhanced_text = self.add_audio_tags(text)
-            # Generate audio using the initialized client
-            audio_generator = self.client.generate(text=enhanced_text, voice=voice_id)
-            # Convert generator to bytes
-            audio_chunks = list(audio_generator)
-            audio = b''.join(audio_chunks)
-            return audio
+            if cache_path:
+                tmp_file = tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix='.part', delete=False)
+            async for chunk in self.stream_speech(enhanced_text, voice_id):
+                chunks.append(chunk)
+                if tmp_file:
+                    tmp_file.write(chunk)
+            audio = b''.join(chunks)
+            if tmp_file:
+                tmp_file.close()
+                if audio:
+                    self.voice_cache.commit(Path(tmp_file.name), cache_path)
+            return audio or None
         except Exception as e:
-            logger.error(f"[VOICE NOTE] Failed to create voice note: {e}")
+            logger.error("[VOICE NOTE] Failed to create voice note: %s", e)
             return None
+        finally:
+            if tmp_file:
+                tmp_file.close()
+                if os.path.exists(tmp_file.name):
+                    os.unlink(tmp_file.name)
+
+    async def create_voice_note_from_sentences(self, sentences, voice_id: str) -> Optional[bytes]:
+        """Synthesize each sentence as soon as it arrives and stitch the clips together in order.
+
+        `sentences` is an async iterator, so TTS for the first sentence overlaps with the
+        LLM still writing the rest of the script.
+        """
+        pending: asyncio.Queue = asyncio.Queue()
+
+        async def stitch() -> Optional[bytes]:
+            from pydub import AudioSegment
+            clips = []
+            combined = AudioSegment.empty()
+            decodable = True
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                clip = await task
+                if not clip:
+                    return None
+                clips.append(clip)
+                if decodable:
+                    try:
+                        combined += await asyncio.to_thread(AudioSegment.from_file, io.BytesIO(clip), format='mp3')
+                    except Exception as e:
+                        # No ffmpeg available: MP3 frames can still be joined byte-wise
+                        logger.warning("[VOICE NOTE] Cannot decode clip for stitching, joining raw MP3: %s", e)
+                        decodable = False
+            if not clips:
+                return None
+            if len(clips) == 1 or not decodable:
+                return b''.join(clips)
+            buffer = io.BytesIO()
+            await asyncio.to_thread(combined.export, buffer, format='mp3', bitrate='128k')
+            return buffer.getvalue()
+
+        stitcher = asyncio.create_task(stitch())
+        tasks = []
+        try:
+            async for sentence in sentences:
+                if stitcher.done():
+                    break  # a clip failed; don't keep paying for TTS on the rest of the script
+                task = asyncio.create_task(self.create_voice_note(sentence, voice_id))
+                tasks.append(task)
+                await pending.put(task)
+                logger.info("[VOICE NOTE] Synthesizing sentence %s: %s", len(tasks), sentence[:60])
+            await pending.put(None)
+            return await stitcher
+        finally:
+            # Also runs when the script stream raises or we are cancelled: no orphaned paid TTS calls
+            if hasattr(sentences, 'aclose'):
+                await sentences.aclose()
+            for task in tasks:
+                task.cancel()
+            stitcher.cancel()
+            await asyncio.gather(stitcher, *tasks, return_exceptions=True)
+
+    async def stream_speech(self, text: str, voice_id: str):
+        """Yield MP3 chunks from the ElevenLabs text-to-speech streaming endpoint."""
+        if not self.session or self.session.closed:
+            await self.start_session()
+        url = f"{ELEVENLABS_BASE_URL}/v1/text-to-speech/{voice_id}/stream"
+        headers = {
+            "xi-api-key": self.api_key,
+            "Content-Type": "application/json",
+            "Accept": "audio/mpeg"
+        }
+        payload = {
+            "text": text,
+            "model_id": ELEVENLABS_TTS_MODEL,
+            "voice_settings": ELEVENLABS_VOICE_SETTINGS
+        }
+        with METRICS.time('elevenlabs_request_seconds', operation='tts'):
+            async with self.session.post(url, json=payload, headers=headers, params={"output_format": "mp3_44100_128"}) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    raise RuntimeError(f"ElevenLabs TTS returned {response.status}: {error_text[:200]}")
+                async for chunk in response.content.iter_chunked(16 * 1024):
+                    yield chunk
     
     async def get_phone_number_id(self) -> Optional[str]:
         """
@@ -1642,7 +3791,7 @@ class ElevenLabsManager:
         Handles both list and dict API responses for robustness.
         """
         try:
-            url = "https://api.elevenlabs.io/v1/convai/phone-numbers"
+            url = f"{ELEVENLABS_BASE_URL}/v1/convai/phone-numbers"
             headers = {
                 "xi-api-key": self.api_key,
                 "Content-Type": "application/json"
@@ -1715,7 +3864,7 @@ class ElevenLabsManager:
             logger.info(f"[ELEVENLABS] Voice call parameters: agent_id='{agent_id}', phone_number='{phone_number}', agent_phone_number_id='{agent_phone_number_id}', user_name='{user_name}'")
             logger.warning(f"[ELEVENLABS] 🔧 NEW APPROACH: Asking user to state their name during call since dynamic variables are broken")
             
-            url = "https://api.elevenlabs.io/v1/convai/twilio/outbound-call"
+            url = f"{ELEVENLABS_BASE_URL}/v1/convai/twilio/outbound-call"
             headers = {
                 "xi-api-key": self.api_key,
                 "Content-Type": "application/json"
@@ -1735,29 +3884,29 @@ class ElevenLabsManager:
             
             # Note: Using name-asking strategy instead of relying on broken dynamic variables
             # Log the complete payload for debugging
-            logger.info(f"[ELEVENLABS] Voice call payload: {payload}")
+            logger.debug("[ELEVENLABS] Voice call payload: %s", payload)
             logger.info(f"[ELEVENLABS] 🎯 STRATEGY: First message will ask user to state their name, then agent should learn it naturally")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=payload) as response:
-                    logger.info(f"[ELEVENLABS] Voice call API response status: {response.status}")
+            async with self._http() as session:
+                with METRICS.time('elevenlabs_request_seconds', operation='call_start'):
+                    async with session.post(url, headers=headers, json=payload) as response:
+                        logger.info(f"[ELEVENLABS] Voice call API response status: {response.status}")
                     
-                    if response.status == 200:
-                        response_data = await response.json()
-                        # ElevenLabs returns 'callSid', not 'call_id'
-                        call_id = response_data.get('callSid') or response_data.get('call_id')
-                        logger.info(f"[ELEVENLABS] Voice call response data: {response_data}")
-                        logger.info(f"[ELEVENLABS] Successfully initiated voice call. Call ID: {call_id}")
+                        if response.status == 200:
+                            response_data = await response.json()
+                            # ElevenLabs returns 'callSid', not 'call_id'
+                            call_id = response_data.get('callSid') or response_data.get('call_id')
+                            logger.debug("[ELEVENLABS] Voice call response data: %s", response_data)
+                            logger.info(f"[ELEVENLABS] Successfully initiated voice call. Call ID: {call_id}")
                         
-                        # Debug: Log what we sent vs what we got back
-                        logger.info(f"[ELEVENLABS] 🔍 DEBUG - Sent user_name: '{final_user_name}'")
-                        logger.info(f"[ELEVENLABS] 🔍 DEBUG - Full payload sent: {payload}")
+                            # Debug: Log what we sent vs what we got back
+                            logger.debug("[ELEVENLABS] Sent user_name: %r", final_user_name)
                         
-                        return call_id
-                    else:
-                        response_text = await response.text()
-                        logger.error(f"[ELEVENLABS] Voice call API error: Status {response.status}, Response: {response_text}")
-                        return None
+                            return call_id
+                        else:
+                            response_text = await response.text()
+                            logger.error(f"[ELEVENLABS] Voice call API error: Status {response.status}, Response: {response_text}")
+                            return None
         except Exception as e:
             logger.error(f"[ELEVENLABS] Error initiating voice call: {e}")
             return None
@@ -1767,19 +3916,20 @@ class ElevenLabsManager:
         try:
             # Note: This endpoint may need to be confirmed with ElevenLabs documentation
             # For now, we'll use a placeholder URL - you'll need to check their API docs
-            url = f"https://api.elevenlabs.io/v1/convai/calls/{call_id}/terminate"
+            url = f"{ELEVENLABS_BASE_URL}/v1/convai/calls/{call_id}/terminate"
             headers = {
                 "xi-api-key": self.api_key,
                 "Content-Type": "application/json"
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers) as response:
-                    if response.status == 200:
-                        logger.info(f"[ELEVENLABS] Successfully terminated call {call_id}")
-                        return True
-                    else:
-                        return False
+            async with self._http() as session:
+                with METRICS.time('elevenlabs_request_seconds', operation='call_terminate'):
+                    async with session.post(url, headers=headers) as response:
+                        if response.status == 200:
+                            logger.info(f"[ELEVENLABS] Successfully terminated call {call_id}")
+                            return True
+                        else:
+                            return False
         except Exception as e:
             logger.error(f"[ELEVENLABS] Error terminating call {call_id}: {e}")
             return False
@@ -1792,28 +3942,363 @@ class ElevenLabsManager:
                 logger.warning(f"[ELEVENLABS] Skipping ElevenLabs status check for Twilio call ID: {call_id}")
                 return {"status": "unknown", "message": "Twilio call ID, not ElevenLabs"}
             
-            url = f"https://api.elevenlabs.io/v1/convai/calls/{call_id}"
+            url = f"{ELEVENLABS_BASE_URL}/v1/convai/calls/{call_id}"
             headers = {
                 "xi-api-key": self.api_key,
                 "Content-Type": "application/json"
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        logger.info(f"[ELEVENLABS] Call {call_id} status: {data.get('status', 'unknown')}")
-                        return data
-                    elif response.status == 404:
-                        logger.warning(f"[ELEVENLABS] Call {call_id} not found (404) - may have ended or expired")
-                        return {"status": "ended", "message": "Call not found"}
-                    else:
-                        logger.warning(f"[ELEVENLABS] Failed to get call status for {call_id}: {response.status}")
-                        return {}
+            async with self._http() as session:
+                with METRICS.time('elevenlabs_request_seconds', operation='call_status'):
+                    async with session.get(url, headers=headers) as response:
+                        if response.status == 200:
+                            data = await response.json()
+                            logger.info(f"[ELEVENLABS] Call {call_id} status: {data.get('status', 'unknown')}")
+                            return data
+                        elif response.status == 404:
+                            logger.warning(f"[ELEVENLABS] Call {call_id} not found (404) - may have ended or expired")
+                            return {"status": "ended", "message": "Call not found"}
+                        else:
+                            logger.warning(f"[ELEVENLABS] Failed to get call status for {call_id}: {response.status}")
+                            return {}
         except Exception as e:
             logger.error(f"[ELEVENLABS] Error getting call status for {call_id}: {e}")
             return {}
 
+class StateBackend(ABC):
+    """Key/value store for state every replica has to agree on.
+
+    Values are JSON-serialisable and may expire after a TTL. claim() is an
+    atomic set-if-absent, used to make something happen exactly once no
+    matter which replica gets there first.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        ...
+
+    @abstractmethod
+    async def keys(self, prefix: str) -> List[str]:
+        ...
+
+    async def purge_expired(self) -> int:
+        return 0
+
+class InMemoryStateBackend(StateBackend):
+    """Process-local backend for single-node deployments and local runs."""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}  # key -> (value, expires at loop time)
+
+    def _live(self, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        entry = self._data.get(key)
+        if entry and entry[1] is not None and entry[1] <= asyncio.get_running_loop().time():
+            del self._data[key]
+            return None
+        return entry
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._live(key)
+        return entry[0] if entry else None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires = asyncio.get_running_loop().time() + ttl if ttl else None
+        self._data[key] = (value, expires)
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        if self._live(key):
+            return False
+        await self.set(key, owner, ttl)
+        return True
+
+    async def keys(self, prefix: str) -> List[str]:
+        return [key for key in list(self._data) if key.startswith(prefix) and self._live(key)]
+
+    async def purge_expired(self) -> int:
+        before = len(self._data)
+        for key in list(self._data):
+            self._live(key)
+        return before - len(self._data)
+
+class SupabaseStateBackend(StateBackend):
+    """Shared backend on the bot_state table, for running several replicas."""
+
+    TABLE = 'bot_state'
+
+    @staticmethod
+    def _expires_at(ttl: Optional[float]) -> Optional[str]:
+        return (datetime.now(timezone.utc) + timedelta(seconds=ttl)).isoformat() if ttl else None
+
+    async def get(self, key: str) -> Optional[Any]:
+        now = datetime.now(timezone.utc).isoformat()
+        result = await asyncio.to_thread(
+            lambda: supabase.table(self.TABLE).select('value').eq('key', key)
+                .or_(f"expires_at.is.null,expires_at.gt.{now}").limit(1).execute()
+        )
+        return result.data[0]['value'] if result.data else None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        row = {'key': key, 'value': value, 'expires_at': self._expires_at(ttl)}
+        await asyncio.to_thread(lambda: supabase.table(self.TABLE).upsert(row, on_conflict='key').execute())
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(lambda: supabase.table(self.TABLE).delete().eq('key', key).execute())
+
+    async def claim(self, key: str, owner: str, ttl: float) -> bool:
+        now = datetime.now(timezone.utc).isoformat()
+        row = {'key': key, 'value': owner, 'expires_at': self._expires_at(ttl)}
+
+        def insert() -> bool:
+            # An expired claim no longer counts; the primary key makes the insert the atomic step
+            supabase.table(self.TABLE).delete().eq('key', key).lt('expires_at', now).execute()
+            try:
+                supabase.table(self.TABLE).insert(row).execute()
+                return True
+            except Exception as e:
+                if getattr(e, 'code', None) == '23505':
+                    return False
+                raise
+        return await asyncio.to_thread(insert)
+
+    async def keys(self, prefix: str) -> List[str]:
+        now = datetime.now(timezone.utc).isoformat()
+        result = await asyncio.to_thread(
+            lambda: supabase.table(self.TABLE).select('key').like('key', f"{prefix}%")
+                .or_(f"expires_at.is.null,expires_at.gt.{now}").execute()
+        )
+        return [row['key'] for row in result.data or []]
+
+    async def purge_expired(self) -> int:
+        result = await asyncio.to_thread(lambda: supabase.rpc('purge_expired_bot_state').execute())
+        return result.data or 0
+
+class BotState:
+    """Typed accessors for the state that has to survive a webhook landing on another replica."""
+
+    def __init__(self, backend: StateBackend):
+        self.backend = backend
+        self.owner = INSTANCE_ID
+
+    async def register_call(self, call_id: str, user_id: int, max_minutes: int):
+        await self.backend.set(f"call:{call_id}", {
+            'user_id': user_id,
+            'max_minutes': max_minutes,
+            'start_time': datetime.now(timezone.utc).isoformat(),
+            'owner': self.owner
+        }, CALL_STATE_TTL_SECONDS)
+
+    async def get_call(self, call_id: str) -> Optional[dict]:
+        return await self.backend.get(f"call:{call_id}")
+
+    async def call_user(self, call_id: str) -> Optional[int]:
+        call = await self.get_call(call_id)
+        return call['user_id'] if call else None
+
+    async def active_call_ids(self) -> List[str]:
+        return [key.split(':', 1)[1] for key in await self.backend.keys('call:')]
+
+    async def heartbeat(self):
+        await self.backend.set(f"replica:{self.owner}", datetime.now(timezone.utc).isoformat(), REPLICA_HEARTBEAT_SECONDS * 3)
+
+    async def retire(self):
+        """Drop this replica's heartbeat on shutdown so its calls are adopted straight away."""
+        await self.backend.delete(f"replica:{self.owner}")
+
+    async def replica_alive(self, owner: str) -> bool:
+        return await self.backend.get(f"replica:{owner}") is not None
+
+    async def adopt_call(self, call_id: str, call: dict) -> bool:
+        """Take over supervision of a call whose replica went away. True for exactly one replica."""
+        if not await self.backend.claim(f"call_adopt:{call_id}", self.owner, REPLICA_HEARTBEAT_SECONDS * 3):
+            return False
+        await self.backend.set(f"call:{call_id}", {**call, 'owner': self.owner}, CALL_STATE_TTL_SECONDS)
+        return True
+
+    async def claim_call_end(self, call_id: str) -> bool:
+        """True exactly once per call, for whichever replica should bill it."""
+        return await self.backend.claim(f"call_end:{call_id}", self.owner, CALL_END_CLAIM_TTL_SECONDS)
+
+    async def release_call_end(self, call_id: str):
+        """Give up a call end claim whose billing failed, so the next end signal can bill it."""
+        await self.backend.delete(f"call_end:{call_id}")
+
+    async def end_call(self, call_id: str):
+        await self.backend.delete(f"call:{call_id}")
+
+class CallSupervisor:
+    """Owns every active voice call from a single task.
+
+    Twilio and ElevenLabs webhooks are the primary end-of-call signal. The
+    supervisor sleeps until the next exact deadline across all calls: the
+    1-minute warning, the gem-limit cutoff, or a fallback status check. Due
+    work is spawned as tracked tasks, so a slow provider call never delays
+    another call's deadline.
+    """
+
+    LIVE_STATUSES = {'queued', 'initiated', 'ringing', 'in-progress', 'active', 'processing'}
+    UNANSWERED_STATUSES = {'busy', 'failed', 'canceled', 'no-answer'}
+
+    def __init__(self, elevenlabs_manager: 'ElevenLabsManager', on_warning, on_limit, on_ended):
+        self.elevenlabs_manager = elevenlabs_manager
+        self.on_warning = on_warning  # async (call)
+        self.on_limit = on_limit  # async (call, reason)
+        self.on_ended = on_ended  # async (call, duration_minutes, reason); 0 minutes means it never connected
+        self.calls: Dict[str, dict] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._wakeup = asyncio.Event()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._actions = set()  # warnings, cutoffs and status checks still running
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            auth = aiohttp.BasicAuth(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN) if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN else None
+            self.session = aiohttp.ClientSession(auth=auth, timeout=aiohttp.ClientTimeout(total=15))
+        if not self._loop_task:
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+        actions = list(self._actions)
+        for task in actions:
+            task.cancel()
+        await asyncio.gather(*actions, return_exceptions=True)
+        if self.session:
+            await self.session.close()
+
+    def add(self, call_id: str, user_id: int, max_minutes: int, start_time: Optional[datetime] = None):
+        """Supervise a call; pass start_time when adopting one that started elsewhere."""
+        now = asyncio.get_running_loop().time()
+        start_time = start_time or datetime.now(timezone.utc)
+        started = now - max(0.0, (datetime.now(timezone.utc) - start_time).total_seconds())
+        cutoff_minutes = min(max_minutes, CALL_FAILSAFE_MINUTES)
+        self.calls[call_id] = {
+            'call_id': call_id,
+            'user_id': user_id,
+            'max_minutes': max_minutes,
+            'cutoff_minutes': cutoff_minutes,
+            'start_time': start_time,
+            'started': started,
+            'warn_at': started + (max_minutes - 1) * 60 if 1 < max_minutes <= CALL_FAILSAFE_MINUTES else None,
+            'limit_at': started + cutoff_minutes * 60,
+            'limit_reason': 'gem_limit' if cutoff_minutes == max_minutes else 'failsafe_timeout',
+            # An adopted call may have ended while nobody watched it, so check it right away
+            'check_at': max(now, started + CALL_STATUS_CHECK_AFTER_SECONDS)
+        }
+        self._wakeup.set()
+        logger.info("[CALL MONITOR] Supervising call %s for user %s: cutoff in %s minutes (%s active)", call_id, user_id, cutoff_minutes, len(self.calls))
+
+    def remove(self, call_id: str) -> bool:
+        return self.calls.pop(call_id, None) is not None
+
+    def elapsed_minutes(self, call: dict) -> int:
+        return int((asyncio.get_running_loop().time() - call['started']) / 60)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self.calls:
+                next_deadline = min(
+                    min(t for t in (c['warn_at'], c['limit_at'], c['check_at']) if t is not None)
+                    for c in self.calls.values()
+                )
+                timeout = max(0.0, next_deadline - loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            now = loop.time()
+            for call in list(self.calls.values()):
+                if now >= call['limit_at']:
+                    self.calls.pop(call['call_id'], None)
+                    self._spawn(self.on_limit(call, call['limit_reason']), call)
+                    continue
+                if call['warn_at'] is not None and now >= call['warn_at']:
+                    call['warn_at'] = None
+                    self._spawn(self.on_warning(call))
+                if now >= call['check_at']:
+                    # The next check is scheduled well past the status request's 15s timeout
+                    call['check_at'] = now + CALL_STATUS_CHECK_INTERVAL_SECONDS
+                    self._spawn(self._check_status(call), call)
+
+    def _spawn(self, coroutine, call: Optional[dict] = None):
+        task = asyncio.create_task(self._guard(coroutine, call))
+        self._actions.add(task)
+        task.add_done_callback(self._actions.discard)
+
+    async def _guard(self, coroutine, call: Optional[dict]):
+        try:
+            await coroutine
+        except Exception as e:
+            logger.error("[CALL MONITOR] Supervisor action failed: %s", e)
+            if call and call['call_id'] not in self.calls:
+                # Ending the call failed (e.g. billing); look at it again on the next check
+                retry_at = asyncio.get_running_loop().time() + CALL_STATUS_CHECK_INTERVAL_SECONDS
+                call['check_at'] = retry_at
+                call['limit_at'] = max(call['limit_at'], retry_at)
+                self.calls[call['call_id']] = call
+                self._wakeup.set()
+
+    async def _check_status(self, call: dict):
+        """Fallback for a missed webhook: ask the provider whether the call is still live."""
+        call_id = call['call_id']
+        status, duration_seconds = await self._fetch_status(call_id)
+        if call_id not in self.calls:
+            return  # a webhook ended it while we were asking
+        elapsed = self.elapsed_minutes(call)
+        if status in self.UNANSWERED_STATUSES:
+            self.calls.pop(call_id, None)
+            logger.warning("[CALL MONITOR] Call %s never connected (status: %s) and no webhook arrived", call_id, status)
+            await self.on_ended(call, 0, f"status_check_{status}")
+        elif status and status not in self.LIVE_STATUSES:
+            self.calls.pop(call_id, None)
+            duration_minutes = max(1, int(duration_seconds / 60)) if duration_seconds else max(1, elapsed)
+            logger.warning("[CALL MONITOR] Call %s already ended (status: %s) but webhook missed. Processing end.", call_id, status)
+            await self.on_ended(call, duration_minutes, 'status_check')
+        elif not status and elapsed >= CALL_STALE_AFTER_MINUTES:
+            self.calls.pop(call_id, None)
+            logger.warning("[CALL MONITOR] Call %s running %s minutes without status verification. Assuming stale.", call_id, elapsed)
+            await self.on_ended(call, max(1, elapsed), 'stale_detection_fallback')
+
+    async def _fetch_status(self, call_id: str) -> Tuple[Optional[str], Optional[int]]:
+        """Return (lowercase status, duration in seconds), or (None, None) if it could not be checked."""
+        try:
+            if call_id.startswith('CA'):
+                if not TWILIO_ACCOUNT_SID:
+                    return None, None
+                url = f"{TWILIO_API_URL}/Accounts/{TWILIO_ACCOUNT_SID}/Calls/{call_id}.json"
+                async with self.session.get(url) as response:
+                    if response.status != 200:
+                        logger.warning("[CALL MONITOR] Twilio status check for %s returned %s", call_id, response.status)
+                        return None, None
+                    data = await response.json()
+                    return (data.get('status') or '').lower() or None, int(data.get('duration') or 0)
+            data = await self.elevenlabs_manager.get_call_status(call_id)
+            return (data.get('status') or '').lower() or None, None
+        except Exception as e:
+            logger.warning("[CALL MONITOR] Could not check status for %s: %s", call_id, e)
+            return None, None
+
 class SecretShareBot:
     """Main bot class with v69 enhancements for voice integration."""
     
@@ -1830,10 +4315,20 @@ class SecretShareBot:
         self.image_generator = ImageGenerator(REPLICATE_API_TOKEN or "", self.kobold_api)
         self.video_generator = VideoGenerator(WAVESPEED_API_TOKEN or "")
         self.elevenlabs_manager = ElevenLabsManager(ELEVENLABS_API_KEY or "")
-        # Request queue to prevent overwhelming the system
-        self._request_semaphore = asyncio.Semaphore(15)  # Max 15 concurrent message handlers
+        self.voice_encoder = VoiceEncoder()
+        self.video_delivery = VideoDeliveryService()
+        self.typing = TypingTicker()
+        self.admission = AdmissionController(self.kobold_api)
+        self.video_poller = VideoTaskPoller(self.video_generator, self._on_video_ready, self._on_video_failed)
+        self.premium_jobs = PremiumJobQueue({
+            'image': self._run_image_job,
+            'video': self._run_video_job,
+            'voice_note': self._run_voice_note_job
+        }, self._on_premium_job_failed)
         self.db = Database()
-        self.kobold_available = False
+        # Assume Kobold is up until warm_up() checks; generate() falls back by itself if it is not
+        self.kobold_available = True
+        self.warm_up_task: Optional[asyncio.Task] = None
         self.active_users: Dict[int, UserData] = {}
         # Fast-path cache: users who have verified age in this process lifetime
         self.age_verified_cache = set()
@@ -1849,17 +4344,111 @@ class SecretShareBot:
             web.post('/api/initiate-payment', self.handle_payment_request),
             web.post('/api/create-invoice', self.create_invoice_link),
             web.options('/api/create-invoice', self.handle_cors_options),
+            web.post(TELEGRAM_WEBHOOK_PATH, self.handle_telegram_update),
+            web.get('/metrics', self.handle_metrics),
         ])
-        self.webhook_thread = threading.Thread(target=self._run_webhook_server, daemon=True)
-        self.webhook_thread.start()
-        # Call tracking for webhooks
-        self.active_calls: Dict[str, int] = {}  # call_id -> user_id
-
-    def _run_webhook_server(self):
-       import asyncio
-       loop = asyncio.new_event_loop()
-       asyncio.set_event_loop(loop)
-       web.run_app(self.web_app, port=8081, handle_signals=False)
+        self._register_gauges()
+        self.web_runner: Optional[web.AppRunner] = None
+        # Gem balance changes pushed from payments instead of polled
+        self.payment_events = PaymentEventBus(SUPABASE_DB_URL)
+        self.leader = LeaderLock(SUPABASE_DB_URL)
+        self.payment_events.subscribe(self._apply_payment_event)
+        self.payment_events.on_reconnect = self._catch_up_payments
+        self._synced_charge_ids: OrderedDict = OrderedDict()
+        self.reengagement = ReengagementBroadcaster()
+        self.follow_ups = InactivityTracker(self._send_follow_ups)
+        self.call_supervisor = CallSupervisor(self.elevenlabs_manager, self._warn_call_ending, self._end_call_at_limit, self._on_call_ended_detected)
+        # Call tracking for webhooks, shared between replicas when STATE_BACKEND=supabase
+        self.state = BotState(SupabaseStateBackend() if STATE_BACKEND == 'supabase' else InMemoryStateBackend())
+
+    def _register_gauges(self):
+        METRICS.gauge('active_users', lambda: len(self.active_users), 'User sessions held in memory')
+        METRICS.gauge('active_calls', lambda: len(self.call_supervisor.calls), 'Voice calls supervised by this replica')
+        METRICS.gauge('kobold_waiters', lambda: self.kobold_api.waiting, 'Requests waiting for a Kobold generation slot')
+        METRICS.gauge('kobold_estimated_wait_seconds', self.kobold_api.estimated_wait, 'Estimated Kobold queue wait')
+        METRICS.gauge('handlers_in_flight', lambda: getattr(self.application.update_processor, 'in_flight', 0), 'Update handlers currently running')
+        METRICS.gauge('update_backlog', lambda: getattr(self.application.update_processor, 'backlog', 0), 'Updates waiting for their chat lane or a handler slot')
+        METRICS.gauge('typing_chats', lambda: len(self.typing), 'Chats currently shown as typing')
+        METRICS.gauge('outbound_queue_depth', self._outbound_queue_depths, 'Bot API sends waiting for the outbound limits, by priority')
+        METRICS.gauge('chat_replies_in_flight', lambda: self.admission.in_flight, 'Chat replies past admission control')
+        METRICS.gauge('premium_jobs_queued', lambda: {(('type', t),): n for t, n in self.premium_jobs.queue_depths().items()}, 'Premium jobs waiting per type')
+        METRICS.gauge('video_tasks_pending', lambda: len(self.video_poller.pending), 'Wavespeed renders being polled')
+
+    def _outbound_queue_depths(self) -> Dict[tuple, int]:
+        scheduler = self.application.bot.rate_limiter if self.application else None
+        return scheduler.queue_depths() if isinstance(scheduler, OutboundScheduler) else {}
+
+    async def handle_metrics(self, request):
+        """Prometheus scrape endpoint. Requires METRICS_TOKEN as a bearer token when it is set."""
+        token = os.getenv('METRICS_TOKEN')
+        if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            return web.Response(status=401, text='Unauthorized')
+        return web.Response(text=METRICS.render(), content_type='text/plain', charset='utf-8')
+
+    async def start_web_server(self):
+       """Serve web_app from the bot's own event loop so handlers share its sessions and state."""
+       self.web_runner = web.AppRunner(self.web_app, handle_signals=False)
+       await self.web_runner.setup()
+       site = web.TCPSite(self.web_runner, port=WEB_SERVER_PORT)
+       await site.start()
+       logger.info(f"[WEB] Webhook server listening on port {WEB_SERVER_PORT}")
+
+    async def stop_web_server(self):
+       if self.web_runner:
+           await self.web_runner.cleanup()
+           self.web_runner = None
+
+    async def warm_up(self):
+       """Provider checks that used to block startup, run concurrently once the bot is already serving."""
+       started = perf_counter()
+       kobold, elevenlabs_key, last_seen = await asyncio.gather(
+           self.kobold_api.check_availability(),
+           self.elevenlabs_manager.check_api_key(),
+           asyncio.to_thread(lambda: supabase.table('users').select('last_seen').limit(1).execute()),
+           return_exceptions=True
+       )
+       self.kobold_available = kobold is True
+       if self.kobold_available:
+           logger.info("✅ KoboldCPP is running and connected!")
+       else:
+           logger.warning("⚠️ KoboldCPP not available - bot will use fallback text responses.")
+       if elevenlabs_key is True:
+           logger.info("✅ ElevenLabs API key is valid!")
+       elif self.elevenlabs_manager.api_key:
+           logger.error(f"[ELEVENLABS] API key check failed: {elevenlabs_key}")
+       if isinstance(last_seen, Exception):
+           logger.error(f"!!! CRITICAL DATABASE ERROR: 'last_seen' column not found in 'users' table ({last_seen}).")
+           logger.error("!!! The 24-hour retention feature WILL NOT WORK without it. Run the provided Supabase SQL script to add the column.")
+       else:
+           logger.info("✅ Database check successful: 'last_seen' column exists.")
+       logger.info(f"[INIT] Warm-up finished in {perf_counter() - started:.2f}s")
+
+    async def handle_telegram_update(self, request):
+       """Receive a Telegram update pushed by the Bot API and hand it to the application's update queue."""
+       if not self._webhook_secret:
+           logger.error("[TELEGRAM WEBHOOK] Rejecting update: TELEGRAM_WEBHOOK_SECRET is not configured")
+           return web.Response(status=403)
+       token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+       if not hmac.compare_digest(token, self._webhook_secret):
+           logger.warning(f"[TELEGRAM WEBHOOK] Invalid secret token from {request.remote}")
+           return web.Response(status=403)
+       try:
+           update = Update.de_json(await request.json(), self.application.bot)
+       except Exception as e:
+           logger.error(f"[TELEGRAM WEBHOOK] Malformed update: {e}")
+           return web.Response(status=400)
+       # The queue itself drains straight into tasks, so count what is still waiting for a lane or slot.
+       # Non-2xx makes Telegram redeliver later, possibly to a less busy replica
+       queue = self.application.update_queue
+       if queue.qsize() + self.application.update_processor.backlog >= TELEGRAM_UPDATE_QUEUE_SIZE:
+           logger.warning("[TELEGRAM WEBHOOK] Update backlog full, asking Telegram to retry")
+           return web.Response(status=503)
+       try:
+           queue.put_nowait(update)
+       except asyncio.QueueFull:
+           logger.warning("[TELEGRAM WEBHOOK] Update queue full, asking Telegram to retry")
+           return web.Response(status=503)
+       return web.Response(text='ok')
 
     async def handle_wavespeed_webhook(self, request):
        """Handle Wavespeed webhook - NOTE: Wavespeed doesn't actually support webhooks, this is unused."""
@@ -1889,20 +4478,21 @@ class SecretShareBot:
                logger.info(f"[TWILIO WEBHOOK] Updated call {call_sid} duration to {duration_minutes} minutes")
                
                # Find user by call_sid and process call end
-               user_id = self.active_calls.get(call_sid)
+               user_id = await self.state.call_user(call_sid)
                if user_id:
                    try:
                        # Use the existing call end processing logic
                        await self._process_call_end(call_sid, user_id, duration_minutes, datetime.now(), 'twilio_webhook')
                        logger.info(f"[TWILIO WEBHOOK] Processed call end for user {user_id}")
                    except Exception as e:
+                       # Billing gave its claim back; the call stays supervised so a status check can retry it
                        logger.error(f"[TWILIO WEBHOOK] Failed to process call end for user {user_id}: {e}")
-                       # Even if processing fails, stop the monitoring job
-                       await self.stop_call_monitoring(call_sid, "twilio_webhook_fallback")
                else:
                    logger.warning(f"[TWILIO WEBHOOK] No active user found for call {call_sid}")
                    # Still stop monitoring for unknown calls
                    await self.stop_call_monitoring(call_sid, "twilio_webhook_unknown_user")
+           elif call_sid and call_status in CallSupervisor.UNANSWERED_STATUSES:
+               await self._release_unanswered_call(call_sid, f"twilio_webhook_{call_status}")
            
            return web.Response(text='ok', status=200)
            
@@ -1985,7 +4575,6 @@ class SecretShareBot:
        logger.info(f"[ELEVENLABS WEBHOOK DEBUG] Extracted duration: {duration}")
        logger.info(f"[ELEVENLABS WEBHOOK DEBUG] Event type: {event_type}")
        logger.info(f"[ELEVENLABS WEBHOOK DEBUG] Webhook type: {webhook_type}")
-       logger.info(f"[ELEVENLABS WEBHOOK DEBUG] Active calls: {list(self.active_calls.keys())}")
        
        # Handle both call_ended and post_call_transcription events
        is_call_end_event = (event_type == 'call_ended') or (webhook_type == 'post_call_transcription')
@@ -1995,25 +4584,20 @@ class SecretShareBot:
            event_source = event_type or webhook_type
            logger.info(f"[ELEVENLABS WEBHOOK] Call {call_id} ended via {event_source}. Duration: {duration} seconds = {duration_minutes} minutes")
            
-           user_id = self.active_calls.get(call_id)
+           user_id = await self.state.call_user(call_id)
            logger.info(f"[ELEVENLABS WEBHOOK DEBUG] User lookup for call {call_id}: {user_id}")
            
            if user_id:
                logger.info(f"[ELEVENLABS WEBHOOK] Processing call end for user {user_id}, call {call_id}")
                # Use centralized call end processing for consistency
-               await self._process_call_end(call_id, user_id, duration_minutes, datetime.now(), 'elevenlabs_webhook')
-               
-               # Stop call monitoring job if it exists
                try:
-                   if hasattr(self, 'application') and self.application.job_queue:
-                       current_jobs = self.application.job_queue.get_jobs_by_name(f"call_monitor_{call_id}")
-                       for job in current_jobs:
-                           job.schedule_removal()
-                       logger.info(f"[ELEVENLABS WEBHOOK] Stopped monitoring job for call {call_id}")
+                   await self._process_call_end(call_id, user_id, duration_minutes, datetime.now(), 'elevenlabs_webhook')
                except Exception as e:
-                   logger.error(f"[ELEVENLABS WEBHOOK] Failed to stop monitoring job for call {call_id}: {e}")
+                   # Billing gave its claim back; a non-2xx lets ElevenLabs deliver the event again
+                   logger.error(f"[ELEVENLABS WEBHOOK] Failed to process call end for user {user_id}: {e}")
+                   return web.Response(text='error', status=500)
            else:
-               logger.warning(f"[ELEVENLABS WEBHOOK] No active user found for call {call_id}. Active calls: {self.active_calls}")
+               logger.warning(f"[ELEVENLABS WEBHOOK] No active user found for call {call_id}")
        elif call_id and is_call_end_event:
            event_source = event_type or webhook_type
            logger.warning(f"[ELEVENLABS WEBHOOK] Call {call_id} end event received but no duration found. Event: {event_source}")
@@ -2021,58 +4605,28 @@ class SecretShareBot:
            logger.info(f"[ELEVENLABS WEBHOOK] Ignoring webhook - not a call end event or missing data. call_id={call_id}, is_end_event={is_call_end_event}, duration={duration}")
        return web.Response(text='ok')
 
-    async def _deliver_video(self, user_id, video_path_or_url):
-       logger.info(f"[DELIVER VIDEO] Attempting to send video to user {user_id}")
-       logger.info(f"[DELIVER VIDEO] Video path/URL type: {type(video_path_or_url)}, value: {video_path_or_url}")
+    async def _deliver_video(self, user_id, video_path_or_url) -> bool:
+       """Send a finished video. Returns False on failure; the poller retries and finally refunds."""
+       logger.info("[DELIVER VIDEO] Attempting to send video to user %s", user_id)
+       logger.info("[DELIVER VIDEO] Video path/URL type: %s, value: %s", type(video_path_or_url), video_path_or_url)
        self._cancel_anticipation_jobs(user_id)
        try:
            # Validate video_path_or_url before sending to Telegram
            if not video_path_or_url:
-               logger.error(f"[VIDEO DELIVERY] Video path/URL is None or empty")
-               await self.application.bot.send_message(chat_id=user_id, text="Sorry, there was a problem delivering your video. Please try again later.")
-               return
+               logger.error("[VIDEO DELIVERY] Video path/URL is None or empty")
+               return False
            
            if not isinstance(video_path_or_url, str):
-               logger.error(f"[VIDEO DELIVERY] Video path/URL is not a string: {type(video_path_or_url)}")
-               await self.application.bot.send_message(chat_id=user_id, text="Sorry, there was a problem delivering your video. Please try again later.")
-               return
-           
-           # Check if it's a file path or URL
-           if video_path_or_url.startswith("https://"):
-               # It's a URL - download and send as file to ensure proper video format
-               logger.info(f"[DELIVER VIDEO] Downloading video from URL: {video_path_or_url}")
-               try:
-                   import requests
-                   from io import BytesIO
-                   
-                   # Download the video
-                   response = requests.get(video_path_or_url, timeout=60)
-                   response.raise_for_status()
-                   
-                   # Create a file-like object
-                   video_data = BytesIO(response.content)
-                   video_data.name = 'video.mp4'  # Set filename with .mp4 extension
-                   
-                   # Send as video with explicit parameters
-                   await self.application.bot.send_video(
-                       chat_id=user_id, 
-                       video=video_data,
-                       supports_streaming=True,
-                       has_spoiler=False
-                   )
-                   logger.info(f"[DELIVER VIDEO] Video sent successfully as MP4 to user {user_id}")
-                   
-               except Exception as e:
-                   logger.error(f"[DELIVER VIDEO] Failed to download/send video: {e}")
-                   # Fallback: try sending as URL directly
-                   await self.application.bot.send_video(
-                       chat_id=user_id, 
-                       video=video_path_or_url,
-                       supports_streaming=True
-                   )
-           logger.info(f"[DELIVER VIDEO] Video sent successfully to user {user_id}")
+               logger.error("[VIDEO DELIVERY] Video path/URL is not a string: %s", type(video_path_or_url))
+               return False
+           
+           if await self.video_delivery.deliver(user_id, video_path_or_url):
+               logger.info("[DELIVER VIDEO] Video sent successfully to user %s", user_id)
+               return True
+           return False
        except Exception as e:
-           logger.error(f"[VIDEO DELIVERY] Failed to send video to user {user_id}: {e}")
+           logger.error("[VIDEO DELIVERY] Failed to send video to user %s: %s", user_id, e)
+           return False
 
     def _cancel_anticipation_jobs(self, user_id):
        jobs = self.anticipation_jobs.pop(user_id, [])
@@ -2113,80 +4667,54 @@ class SecretShareBot:
        # AI-generated anticipation message (fallback to template)
        anticipation_line = await self._generate_anticipation_line(user_id, anticipation_context, msg_num)
        try:
-           await context.bot.send_message(chat_id=user_id, text=anticipation_line)
+           await context.bot.send_message(chat_id=user_id, text=anticipation_line, rate_limit_args='background')
        except Exception:
            import random
            fallback = random.choice(ANTICIPATION_PERIODIC_TEMPLATES)
-           await context.bot.send_message(chat_id=user_id, text=fallback)
+           await context.bot.send_message(chat_id=user_id, text=fallback, rate_limit_args='background')
 
     async def _generate_anticipation_line(self, user_id, anticipation_context, msg_num):
        # Use AI to generate a short, in-character anticipation line
        user_session = self.active_users.get(user_id)
        if not user_session or not user_session.current_character:
            return random.choice(ANTICIPATION_PERIODIC_TEMPLATES)
-       character = CHARACTERS[user_session.current_character]
        user_name = user_session.user_name or random.choice(['handsome', 'bello', 'there'])
-       persona_prompt = character['system_prompt_base'].format(user_name=escape_markdown(user_name, version=2))
-       scenario = character['scenarios'][user_session.current_scenario]
-       scenario_prompt = f"You are in {scenario['scenario_prompt']}. You are wearing {user_session.character_current_outfit}."
-       instruction = (
-           "Generate a short, in-character anticipation message to build excitement for a custom video that is being prepared. "
-           "Keep it concise, playful, and in-character. Do not mention payment or gems. This is message number " + str(msg_num) + ". "
-           "Make it feel natural and related to the ongoing conversation."
-       )
-       prompt = (
-           f"<|im_start|>system\n{persona_prompt}\n**Current Scenario Context:** {scenario_prompt}\n<|im_end|>"
-           f"<|im_start|>user\n{anticipation_context}<|im_end|>"
-           f"<|im_start|>assistant\n{instruction}\n{character['full_name']}:"
-       )
+       prompt = PROMPTS.anticipation(user_session, user_name, anticipation_context, msg_num)
        if self.kobold_available:
            raw = await self.kobold_api.generate(prompt, max_tokens=40)
            return self._ensure_complete_sentence(raw)
-    async def _poll_video_completion(self, user_id: int, task_id: str, max_attempts: int = 60):
-       """Poll for video completion using the new VideoGenerator polling method."""
-       logger.info(f"[POLL] Starting video polling for user {user_id}, task {task_id}")
-       
+    async def _on_video_ready(self, user_id: int, task_id: str, video_url: str) -> bool:
+       """Called by the video poller when a render has completed; False asks it to retry."""
+       logger.info("[POLL] Video completed for user %s: %s", user_id, video_url)
+       delivered = await self._deliver_video(user_id, video_url)
+       user_session = self.active_users.get(user_id)
+       if user_session and delivered:
+           user_session.last_video_task = {}
+       return delivered
+
+    async def _on_video_failed(self, user_id: int, task_id: str, reason: str, gem_cost: int = 0):
+       """Called by the video poller when a render failed or timed out."""
+       logger.warning("[POLL] Video task %s for user %s %s", task_id, user_id, reason)
+       self._cancel_anticipation_jobs(user_id)
+       user_session = self.active_users.get(user_id)
+       if user_session:
+           user_session.last_video_task = {}
+       refunded = gem_cost > 0 and await asyncio.to_thread(Database.credit_gems, user_id, gem_cost)
+       if reason == 'delivery_failed':
+           text = "Sorry, there was a problem delivering your video. Please try again later."
+       else:
+           text = "Sorry, your video took longer than expected or failed to generate. Please try again later."
+       if refunded:
+           text += " The Gems have been automatically refunded to your account."
        try:
-           # Use the VideoGenerator's polling method
-           video_url = await self.video_generator.poll_video_completion(task_id, user_id, max_attempts)
-           
-           if video_url:
-               logger.info(f"[POLL] Video completed for user {user_id}: {video_url}")
-               await self._deliver_video(user_id, video_url)
-               
-               # Clear the video task from user session
-               user_session = self.active_users.get(user_id)
-               if user_session:
-                   user_session.last_video_task = {}
-           else:
-               logger.warning(f"[POLL] Video task {task_id} for user {user_id} failed or timed out")
-               await self.application.bot.send_message(
-                   chat_id=user_id, 
-                   text="Sorry, your video took longer than expected or failed to generate. Please try again later."
-               )
-               
-               # Clear the video task from user session
-               user_session = self.active_users.get(user_id)
-               if user_session:
-                   user_session.last_video_task = {}
-                   
+           await self.application.bot.send_message(chat_id=user_id, text=text)
        except Exception as e:
-           logger.error(f"[POLL] Error polling video completion for user {user_id}: {e}")
-           await self.application.bot.send_message(
-               chat_id=user_id, 
-               text="Sorry, there was an error processing your video. Please try again later."
-           )
-           
-           # Clear the video task from user session
-           user_session = self.active_users.get(user_id)
-           if user_session:
-               user_session.last_video_task = {}
+           logger.error("[POLL] Could not notify user %s about failed video: %s", user_id, e)
 
     async def send_premium_offer_overlay(self, update, context, user_id, offer_type, gem_cost, character_line=None):
+       METRICS.inc('upsells_total', offer_type=offer_type)
        # Stop typing indicator before sending upsell messages
-       user_session = self.active_users.get(user_id)
-       if user_session and user_session.typing_manager:
-           await user_session.typing_manager.stop_typing()
+       self.typing.stop_typing(user_id)
            
        user_db_data = self.db.get_or_create_user(user_id, getattr(update.effective_user, 'username', 'Unknown'))
        gems = user_db_data.get('gems', 0) if user_db_data else 0
@@ -2223,9 +4751,10 @@ class SecretShareBot:
         Tweaked asterisk logic: Only add a closing * if the message starts with *, has exactly one *, and does not end with *. If there are already pairs of asterisks (properly closed actions), do nothing. For mixed or normal messages, just ensure normal punctuation at the end.
         """
         text = text.strip()
-        logger.info(f"[ENSURE SENTENCE] Raw: {text}")
+        logger.debug("[ENSURE SENTENCE] Raw: %s", text)
         if not text:
             logger.info("[ENSURE SENTENCE] Using fallback for empty response.")
+            METRICS.inc('fallback_responses_total', source='empty_generation')
             return "*I smile at you.* I'm happy you're here."
         # Only add a closing * if the message starts with *, has exactly one *, and does not end with *
         if text.startswith('*') and text.count('*') == 1 and not text.endswith('*'):
@@ -2334,50 +4863,44 @@ class SecretShareBot:
                 cleaned = cleaned.split(tok)[0]
         return cleaned.strip()
 
-    def _remove_job_if_exists(self, name: str) -> bool:
-       """Remove job with given name. Returns whether job was removed."""
-       if not self.application.job_queue: return False
-       current_jobs = self.application.job_queue.get_jobs_by_name(name)
-       if not current_jobs:
-           return False
-       for job in current_jobs:
-           job.schedule_removal()
-       return True
-
     async def _schedule_follow_up(self, chat_id: int):
-       """Schedules a 5-minute follow-up message if user is inactive for 5 minutes."""
-       if not self.application.job_queue:
-           return
-       job_name = f"follow_up_{chat_id}"
-       self._remove_job_if_exists(job_name)
-       # Always schedule the follow-up; the job itself will check for recent activity
-       self.application.job_queue.run_once(
-           self._send_follow_up, 
-           timedelta(minutes=5), 
-           chat_id=chat_id, 
-           name=job_name,
-           data={'user_id': chat_id}
-       )
+       """Re-arm the 5-minute follow-up for this chat; the tracker fires it if the user stays quiet."""
+       self.follow_ups.touch(chat_id)
+
+    async def _send_follow_ups(self, user_ids: List[int]):
+       """Timing wheel callback: send follow-ups to every chat that went quiet this tick."""
+       with outbound_priority('background'):
+           await asyncio.gather(*(self._send_follow_up(user_id) for user_id in user_ids))
 
-    async def _send_follow_up(self, context: ContextTypes.DEFAULT_TYPE):
-       """The callback function for the 5-minute follow-up job."""
-       job = context.job
-       user_id = job.data['user_id']
+    async def _send_follow_up(self, user_id: int):
        user_session = self.active_users.get(user_id)
        if user_session and user_session.current_character:
            # Only send if user has been inactive for 5+ minutes
-           if datetime.now(timezone.utc) - user_session.last_interaction_time >= timedelta(minutes=5):
+           if datetime.now(timezone.utc) - user_session.last_interaction_time >= timedelta(seconds=FOLLOW_UP_DELAY_SECONDS):
                character_data = CHARACTERS.get(user_session.current_character)
                if character_data and character_data.get('follow_ups'):
                    message = random.choice(character_data['follow_ups'])
                    try:
-                       await context.bot.send_message(chat_id=user_id, text=message)
+                       await self.application.bot.send_message(chat_id=user_id, text=message)
                        logger.info(f"Sent 5-minute follow-up to user {user_id}.")
                    except Exception as e:
                        logger.warning(f"Could not send 5-min follow-up to {user_id}. Error: {e}")
            else:
                logger.info(f"User {user_id} was active recently, skipping follow-up.")
 
+    async def _log_update_metrics(self, context: ContextTypes.DEFAULT_TYPE):
+        """Log per-interval update concurrency: in-flight handlers, per-chat backlog and queue wait."""
+        processor = self.application.update_processor
+        if not isinstance(processor, ChatOrderedUpdateProcessor) or not processor.recent_waits:
+            return
+        stats = processor.stats()
+        processor.recent_waits.clear()
+        logger.info(
+            f"[UPDATES] in-flight {stats['in_flight']}/{stats['limit']}, queued {stats['queued']}, "
+            f"wait p50 {stats['wait_p50']:.2f}s p95 {stats['wait_p95']:.2f}s max {stats['wait_max']:.2f}s, "
+            f"busiest chats {stats['busiest_chats']}, admission {self.admission.counts}"
+        )
+
     async def _cleanup_inactive_users(self, context: ContextTypes.DEFAULT_TYPE):
         """Clean up inactive users from memory to prevent memory leaks."""
         now = datetime.now(timezone.utc)
@@ -2394,43 +4917,72 @@ class SecretShareBot:
         if inactive_users:
             logger.info(f"[CLEANUP] Removed {len(inactive_users)} inactive users from memory")
 
+        # The Supabase table is shared by every replica; one purge per cluster is enough
+        if isinstance(self.state.backend, SupabaseStateBackend) and not self.leader.is_leader:
+            return
+        try:
+            purged = await self.state.backend.purge_expired()
+            if purged:
+                logger.info(f"[CLEANUP] Purged {purged} expired shared state entries")
+        except Exception as e:
+            logger.warning(f"[CLEANUP] Failed to purge expired shared state: {e}")
+
+    def _apply_payment_event(self, event: dict):
+        """Mirror a pushed gem/subscription change into the user's live session - FRONTEND INTEGRATION"""
+        user_session = self.active_users.get(event.get('user_id'))
+        if not user_session or event.get('gems') is None:
+            return
+        old_gems = user_session.gems
+        user_session.gems = event['gems']
+        if event.get('subscription_type'):
+            user_session.subscription_type = event['subscription_type']
+        if old_gems != user_session.gems:
+            logger.info(f"[PAYMENT EVENTS] Updated active user {event['user_id']}: gems {old_gems} → {user_session.gems} (source: {event.get('source')})")
+
     async def _sync_recent_payments(self, context: ContextTypes.DEFAULT_TYPE):
-        """Sync recent payments to update active user sessions - FRONTEND INTEGRATION"""
+        """Catch-up sync for completed payments, only scheduled when LISTEN/NOTIFY is not configured."""
+        await self._catch_up_payments(datetime.now(timezone.utc) - timedelta(minutes=5))
+
+    async def _catch_up_payments(self, since: datetime):
+        """Publish fresh balances for active users with payments completed since `since`.
+
+        Also run by the payment bus after its LISTEN connection comes back, for the outage window.
+        """
+        if not self.active_users:
+            return
         try:
-            # Get payments from last 5 minutes that are completed
-            cutoff_time = (datetime.now(timezone.utc) - timedelta(minutes=5)).isoformat()
-            
-            result = supabase.table('processed_payments')\
-                .select('user_id, payload, amount, created_at, telegram_charge_id')\
-                .eq('status', 'completed')\
-                .gte('created_at', cutoff_time)\
-                .execute()
-            
-            if result.data:
-                logger.info(f"[PAYMENT_SYNC] Found {len(result.data)} recent payments to sync")
-                
-                for payment in result.data:
-                    user_id = payment['user_id']
-                    charge_id = payment.get('telegram_charge_id', 'webapp_payment')
-                    
-                    # Update active user session if they're currently using bot
-                    if user_id in self.active_users:
-                        # Refresh user data from database
-                        updated_user = Database.get_or_create_user(user_id, "")
-                        if updated_user:
-                            old_gems = getattr(self.active_users[user_id], 'gems', 0) if hasattr(self.active_users[user_id], 'gems') else 0
-                            new_gems = updated_user.get('gems', 0)
-                            
-                            # Update session with fresh data
-                            user_session = self.active_users[user_id]
-                            user_session.gems = new_gems
-                            user_session.last_interaction_time = datetime.now(timezone.utc)
-                            
-                            if old_gems != new_gems:
-                                logger.info(f"[PAYMENT_SYNC] Updated active user {user_id}: gems {old_gems} → {new_gems} (charge: {charge_id})")
-                        else:
-                            logger.warning(f"[PAYMENT_SYNC] Could not fetch updated user data for {user_id}")
-                
+            cutoff_time = since.isoformat()
+            # Filter on time only and match active users here: a few minutes of payments is far
+            # smaller than an in.() list of every active user id
+            result = await asyncio.to_thread(
+                lambda: supabase.table('processed_payments')
+                    .select('user_id, telegram_charge_id')
+                    .eq('status', 'completed')
+                    .gte('created_at', cutoff_time)
+                    .execute()
+            )
+            new_payments = [
+                p for p in result.data or []
+                if p.get('user_id') in self.active_users and p.get('telegram_charge_id') not in self._synced_charge_ids
+            ]
+            if not new_payments:
+                return
+            for payment in new_payments:
+                self._synced_charge_ids[payment.get('telegram_charge_id')] = True
+            while len(self._synced_charge_ids) > 1000:
+                self._synced_charge_ids.popitem(last=False)
+
+            user_ids = list({p['user_id'] for p in new_payments})
+            users = await asyncio.to_thread(
+                lambda: supabase.table('users').select('telegram_id, gems, subscription_type').in_('telegram_id', user_ids).execute()
+            )
+            for row in users.data or []:
+                self.payment_events.publish({
+                    'user_id': row['telegram_id'],
+                    'gems': row.get('gems', 0),
+                    'subscription_type': row.get('subscription_type'),
+                    'source': 'sync'
+                })
         except Exception as e:
             logger.error(f"[PAYMENT_SYNC] Error syncing recent payments: {e}")
 
@@ -2499,240 +5051,188 @@ class SecretShareBot:
 
     async def _check_inactive_users(self, context: ContextTypes.DEFAULT_TYPE):
         """Send re-engagement message to users who haven't interacted in 24+ hours."""
+        if not self.leader.is_leader:
+            return
+        if not self.reengagement.start(context.bot):
+            logger.info("[RETENTION] Re-engagement broadcast already running")
+
+    async def _adopt_orphaned_calls(self, startup: bool = False):
+        """Supervise calls registered by a replica that is gone, so their gem cutoff still fires.
+
+        At startup this includes calls recorded under our own name by a previous run.
+        """
         try:
-            current_time = datetime.now(timezone.utc)
-            cutoff_time = current_time - timedelta(hours=24)
-           
-            # Query users who were last seen more than 24 hours ago
-            result = supabase.table('users').select('telegram_id, username, last_seen').lt('last_seen', cutoff_time.isoformat()).execute()
+            for call_id in await self.state.active_call_ids():
+                if call_id in self.call_supervisor.calls:
+                    continue
+                call = await self.state.get_call(call_id)
+                if not call:
+                    continue
+                owner = call.get('owner')
+                if owner == self.state.owner:
+                    if not startup:
+                        continue
+                elif await self.state.replica_alive(owner):
+                    continue
+                if not await self.state.adopt_call(call_id, call):
+                    continue
+                start_time = datetime.fromisoformat(call['start_time'])
+                self.call_supervisor.add(call_id, call['user_id'], call['max_minutes'], start_time=start_time)
+                logger.warning("[CALL MONITOR] Adopted call %s for user %s from %s", call_id, call['user_id'], owner)
+        except Exception as e:
+            logger.error("[CALL MONITOR] Could not adopt orphaned calls: %s", e)
 
-            for user in result.data:
-                user_id = user['telegram_id']
-                try:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text="💖 I miss you! Come back and continue our conversation... I've been thinking about you! 😘"
-                    )
-                    logger.info(f"[RETENTION] Sent re-engagement message to user {user_id}")
-                except Exception as e:
-                    logger.warning(f"[RETENTION] Failed to send message to user {user_id}: {e}")
+    async def _replica_heartbeat(self, context: Optional[ContextTypes.DEFAULT_TYPE], startup: bool = False):
+        try:
+            await self.state.heartbeat()
         except Exception as e:
-            logger.error(f"[RETENTION] Error in inactive user check: {e}")
-
-    async def _monitor_call_duration(self, context: ContextTypes.DEFAULT_TYPE):
-        """Monitor active call duration and terminate if it would exceed user's gem balance."""
-        job_data = context.job.data
-        call_id = job_data['call_id']
-        user_id = job_data['user_id']
-        max_minutes = job_data['max_minutes']
-        start_time = job_data['start_time']
-        
+            logger.warning("[CALL MONITOR] Heartbeat failed: %s", e)
+        await self._adopt_orphaned_calls(startup)
+
+    async def _warn_call_ending(self, call: dict):
+        """Supervisor callback: one minute of gem balance left on the call."""
         try:
-            # Calculate current call duration
-            current_time = datetime.now(timezone.utc)
-            duration_seconds = (current_time - start_time).total_seconds()
-            duration_minutes = int(duration_seconds / 60)
-            
-            logger.info(f"[CALL MONITOR] Call {call_id} - Duration: {duration_minutes}/{max_minutes} minutes")
-            
-            # Check if call is still in our active calls list (might have ended naturally)
-            if call_id not in self.active_calls:
-                logger.info(f"[CALL MONITOR] Call {call_id} no longer active. Stopping monitor.")
-                context.job.schedule_removal()
-                return
-            
-            # Check call status - different methods for ElevenLabs vs Twilio calls
-            if call_id.startswith('CA'):
-                # Twilio call - only check for stale calls if duration exceeds reasonable limits
-                # AND we can't verify the call is still active
-                if duration_minutes >= 15:  # Only check for stale calls after 15 minutes
-                    try:
-                        # Try to get call status from Twilio API to verify if call is still active
-                        from twilio.rest import Client
-                        twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-                        call_info = twilio_client.calls(call_id).fetch()
-                        call_status = call_info.status.lower()
-                        
-                        if call_status in ['completed', 'busy', 'failed', 'canceled', 'no-answer']:
-                            logger.warning(f"[CALL MONITOR] Twilio call {call_id} actually ended (status: {call_status}) but webhook missed. Processing end.")
-                            precise_duration = max(1, duration_minutes)
-                            await self._process_call_end(call_id, user_id, precise_duration, start_time, 'twilio_api_detection')
-                            context.job.schedule_removal()
-                            return
-                        else:
-                            logger.info(f"[CALL MONITOR] Twilio call {call_id} still active (status: {call_status}), continuing monitoring")
-                    except Exception as e:
-                        logger.warning(f"[CALL MONITOR] Could not check Twilio call status for {call_id}: {e}")
-                        # If we can't check status and call has been running 20+ minutes, assume stale
-                        if duration_minutes >= 20:
-                            logger.warning(f"[CALL MONITOR] Twilio call {call_id} running {duration_minutes} minutes without status verification. Assuming stale.")
-                            precise_duration = max(1, duration_minutes)
-                            await self._process_call_end(call_id, user_id, precise_duration, start_time, 'stale_detection_fallback')
-                            context.job.schedule_removal()
-                            return
-            else:
-                # ElevenLabs call - use API status check
-                call_status_data = await self.elevenlabs_manager.get_call_status(call_id)
-                call_status = call_status_data.get('status', '').lower()
-                
-                # If call has ended naturally or ElevenLabs API indicates it's ended, process it
-                if call_status in ['ended', 'completed', 'terminated', 'finished']:
-                    logger.info(f"[CALL MONITOR] ElevenLabs call {call_id} ended naturally. Status: {call_status}")
-                    precise_duration = max(1, duration_minutes)
-                    await self._process_call_end(call_id, user_id, precise_duration, start_time, 'natural')
-                    context.job.schedule_removal()
-                    return
-            
-            # For very short calls (less than 30 seconds), check more frequently for early termination
-            if duration_minutes == 0 and duration_seconds < 30:
-                # Don't send warnings for calls under 30 seconds - they might end naturally very quickly
-                logger.info(f"[CALL MONITOR] Call {call_id} very short ({duration_seconds}s), monitoring closely")
-                return
-            
-            # For debugging: Stop monitoring if call has been running too long (failsafe)
-            if duration_minutes >= 60:  # 1 hour failsafe - no call should run this long
-                logger.error(f"[CALL MONITOR] FAILSAFE: Call {call_id} has been monitoring for {duration_minutes} minutes (1 hour limit). Force ending.")
-                precise_duration = max(1, min(duration_minutes, max_minutes))  # Cap at allocated time
-                await self._process_call_end(call_id, user_id, precise_duration, start_time, 'failsafe_timeout')
-                context.job.schedule_removal()
-                return
-            
-            # Check if call is approaching or exceeding the limit
-            if duration_minutes >= max_minutes:
-                logger.warning(f"[CALL MONITOR] Call {call_id} reached gem limit ({duration_minutes}/{max_minutes} minutes). Terminating call.")
-                
-                # Terminate the call via ElevenLabs API
-                try:
-                    # Attempt to terminate the call via ElevenLabs API
-                    terminated = await self.elevenlabs_manager.terminate_call(call_id)
-                    
-                    if call_id in self.active_calls:
-                        # Send termination message to user
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=f"⚠️ Your call has reached the maximum duration ({max_minutes} minutes) based on your gem balance. The call has ended to prevent overcharges."
-                        )
-                        
-                        # Process call end
-                        await self._process_call_end(call_id, user_id, max_minutes, start_time, 'gem_limit')
-                        
-                        # Stop monitoring this call
-                        context.job.schedule_removal()
-                        
-                        if terminated:
-                            logger.info(f"[CALL MONITOR] Successfully terminated call {call_id} at gem limit")
-                        else:
-                            logger.warning(f"[CALL MONITOR] Call {call_id} marked as ended locally, but API termination may have failed")
+            await self.application.bot.send_message(
+                chat_id=call['user_id'],
+                text=f"⚠️ You have approximately 1 minute left on your call based on your gem balance. Consider buying more gems to continue longer conversations!"
+            )
+            logger.info("[CALL MONITOR] Sent 1-minute warning to user %s for call %s", call['user_id'], call['call_id'])
+        except Exception as e:
+            logger.error("[CALL MONITOR] Failed to send warning to user %s: %s", call['user_id'], e)
+
+    async def _end_call_at_limit(self, call: dict, reason: str):
+        """Supervisor callback: the call hit its gem-limit (or failsafe) deadline."""
+        call_id, user_id = call['call_id'], call['user_id']
+        if not await self.state.get_call(call_id):
+            return  # already ended, possibly on another replica
+        logger.warning("[CALL MONITOR] Call %s reached its %s minute cutoff (%s). Terminating call.", call_id, call['cutoff_minutes'], reason)
+        terminated = await self.elevenlabs_manager.terminate_call(call_id)
+        if reason == 'gem_limit':
+            try:
+                await self.application.bot.send_message(
+                    chat_id=user_id,
+                    text=f"⚠️ Your call has reached the maximum duration ({call['max_minutes']} minutes) based on your gem balance. The call has ended to prevent overcharges."
+                )
+            except Exception as e:
+                logger.error("[CALL MONITOR] Failed to notify user %s of call cutoff: %s", user_id, e)
+        await self._process_call_end(call_id, user_id, call['cutoff_minutes'], call['start_time'], reason)
+        if terminated:
+            logger.info("[CALL MONITOR] Successfully terminated call %s at cutoff", call_id)
+        else:
+            logger.warning("[CALL MONITOR] Call %s marked as ended locally, but API termination may have failed", call_id)
 
-                except Exception as e:
-                    logger.error(f"[CALL MONITOR] Failed to terminate call {call_id}: {e}")
-                    
-            elif duration_minutes >= max_minutes - 1:  # 1 minute warning
-                # Send warning to user when they have 1 minute left
-                try:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"⚠️ You have approximately 1 minute left on your call based on your gem balance. Consider buying more gems to continue longer conversations!"
-                    )
-                    logger.info(f"[CALL MONITOR] Sent 1-minute warning to user {user_id} for call {call_id}")
-                except Exception as e:
-                    logger.error(f"[CALL MONITOR] Failed to send warning to user {user_id}: {e}")
-                    
+    async def _on_call_ended_detected(self, call: dict, duration_minutes: int, reason: str):
+        """Supervisor callback: a status check found the call over without a webhook."""
+        if duration_minutes <= 0:
+            await self._release_unanswered_call(call['call_id'], reason)
+        else:
+            await self._process_call_end(call['call_id'], call['user_id'], duration_minutes, call['start_time'], reason)
+
+    async def _release_unanswered_call(self, call_id: str, reason: str):
+        """Forget a call that never connected without charging for it."""
+        self.call_supervisor.remove(call_id)
+        user_id = await self.state.call_user(call_id)
+        if not user_id or not await self.state.claim_call_end(call_id):
+            return
+        await self.state.end_call(call_id)
+        logger.info("[CALL END] Call %s for user %s never connected (%s). No gems charged.", call_id, user_id, reason)
+        try:
+            await self.application.bot.send_message(chat_id=user_id, text="📞 Looks like we couldn't connect the call. No gems were charged - try again whenever you're ready! 💕")
         except Exception as e:
-            logger.error(f"[CALL MONITOR] Error monitoring call {call_id}: {e}")
-            # Stop monitoring on error
-            context.job.schedule_removal()
+            logger.warning("[CALL END] Could not notify user %s about unanswered call: %s", user_id, e)
 
     async def stop_call_monitoring(self, call_id: str, reason: str = "manual"):
         """Manually stop call monitoring for a specific call ID."""
-        try:
-            if hasattr(self, 'application') and self.application.job_queue:
-                current_jobs = self.application.job_queue.get_jobs_by_name(f"call_monitor_{call_id}")
-                for job in current_jobs:
-                    job.schedule_removal()
-                logger.info(f"[CALL MONITOR] Manually stopped monitoring for call {call_id}. Reason: {reason}")
-                return len(current_jobs)
-            return 0
-        except Exception as e:
-            logger.error(f"[CALL MONITOR] Failed to stop monitoring for call {call_id}: {e}")
-            return 0
+        stopped = self.call_supervisor.remove(call_id)
+        if stopped:
+            logger.info("[CALL MONITOR] Manually stopped monitoring for call %s. Reason: %s", call_id, reason)
+        return int(stopped)
 
     async def _process_call_end(self, call_id: str, user_id: int, duration_minutes: int, start_time: datetime, end_reason: str):
         """Process the end of a voice call: calculate cost, deduct gems, update database, notify user."""
         
-        # Prevent duplicate processing of the same call end
-        if call_id not in self.active_calls:
-            logger.warning(f"[CALL END] Call {call_id} already processed or not found in active calls. Skipping duplicate processing.")
+        # Prevent duplicate processing of the same call end, whichever replica the webhook reached
+        if not await self.state.claim_call_end(call_id):
+            logger.warning("[CALL END] Call %s already processed. Skipping duplicate processing.", call_id)
+            self.call_supervisor.remove(call_id)
             return
             
+        billed = False
         try:
             # Ensure minimum 1 minute billing
             actual_duration = max(1, duration_minutes)
             total_cost = actual_duration * VOICE_CALL_COST_PER_MINUTE
             
-            logger.info(f"[CALL END] ==================== CALL BILLING ====================")
-            logger.info(f"[CALL END] Call ID: {call_id}")
-            logger.info(f"[CALL END] User ID: {user_id}")
-            logger.info(f"[CALL END] Raw Duration: {duration_minutes} minutes")
-            logger.info(f"[CALL END] Billing Duration: {actual_duration} minutes (minimum 1 minute)")
-            logger.info(f"[CALL END] Total Cost: {total_cost} gems ({actual_duration} × {VOICE_CALL_COST_PER_MINUTE})")
-            logger.info(f"[CALL END] End Reason: {end_reason}")
-            logger.info(f"[CALL END] Start Time: {start_time}")
+            logger.info("[CALL END] ==================== CALL BILLING ====================")
+            logger.info("[CALL END] Call ID: %s", call_id)
+            logger.info("[CALL END] User ID: %s", user_id)
+            logger.info("[CALL END] Raw Duration: %s minutes", duration_minutes)
+            logger.info("[CALL END] Billing Duration: %s minutes (minimum 1 minute)", actual_duration)
+            logger.info("[CALL END] Total Cost: %s gems (%s × %s)", total_cost, actual_duration, VOICE_CALL_COST_PER_MINUTE)
+            logger.info("[CALL END] End Reason: %s", end_reason)
+            logger.info("[CALL END] Start Time: %s", start_time)
             
             # Get user's current gem balance
             user_db_data = self.db.get_or_create_user(user_id, "Unknown")
             current_gems = user_db_data.get('gems', 0) if user_db_data else 0
-            logger.info(f"[CALL END] User's Current Gem Balance: {current_gems}")
+            logger.info("[CALL END] User's Current Gem Balance: %s", current_gems)
             
             # Calculate gems to deduct (can't exceed current balance)
             gems_to_deduct = min(current_gems, total_cost)
             new_gem_balance = current_gems - gems_to_deduct
             
-            logger.info(f"[CALL END] Gems to Deduct: {gems_to_deduct} (min of {current_gems} current vs {total_cost} cost)")
-            logger.info(f"[CALL END] New Gem Balance: {new_gem_balance}")
+            logger.info("[CALL END] Gems to Deduct: %s (min of %s current vs %s cost)", gems_to_deduct, current_gems, total_cost)
+            logger.info("[CALL END] New Gem Balance: %s", new_gem_balance)
             
             # Update user's gem balance in database
             try:
                 supabase.table('users').update({'gems': new_gem_balance}).eq('telegram_id', user_id).execute()
-                logger.info(f"[CALL END] ✅ Successfully updated user {user_id} gems: {current_gems} -> {new_gem_balance} (deducted {gems_to_deduct})")
+                logger.info("[CALL END] ✅ Successfully updated user %s gems: %s -> %s (deducted %s)", user_id, current_gems, new_gem_balance, gems_to_deduct)
             except Exception as e:
-                logger.error(f"[CALL END] ❌ Failed to update gems for user {user_id}: {e}")
+                logger.error("[CALL END] ❌ Failed to update gems for user %s: %s", user_id, e)
+                raise
+            billed = True
             
             # Update call record with actual duration and cost
             try:
                 self.db.update_call_duration(call_id, actual_duration)
                 supabase.table('voice_calls').update({'gem_cost': gems_to_deduct}).eq('call_id', call_id).execute()
-                logger.info(f"[CALL END] ✅ Successfully updated call {call_id} record: duration={actual_duration} min, cost={gems_to_deduct} gems")
+                logger.info("[CALL END] ✅ Successfully updated call %s record: duration=%s min, cost=%s gems", call_id, actual_duration, gems_to_deduct)
             except Exception as e:
-                logger.error(f"[CALL END] ❌ Failed to update call record for {call_id}: {e}")
+                logger.error("[CALL END] ❌ Failed to update call record for %s: %s", call_id, e)
             
             # Remove from active calls
-            self.active_calls.pop(call_id, None)
-            logger.info(f"[CALL END] Removed call {call_id} from active calls list")
+            await self.state.end_call(call_id)
+            self.call_supervisor.remove(call_id)
+            logger.info("[CALL END] Removed call %s from active calls list", call_id)
             
             # Update user session gems if they're active
             if user_id in self.active_users:
                 self.active_users[user_id].gems = new_gem_balance
-                logger.info(f"[CALL END] ✅ Updated session gems for user {user_id}: {new_gem_balance}")
+                logger.info("[CALL END] ✅ Updated session gems for user %s: %s", user_id, new_gem_balance)
             
             # Send completion message to user
             if gems_to_deduct < total_cost:
                 # User didn't have enough gems for full call
                 message = f"💖 Your call has ended! Duration: {actual_duration} minutes.\n💎 Charged: {gems_to_deduct} Gems (your available balance)\n💎 Remaining Gems: {new_gem_balance}\n\n✨ Consider buying more Gems for longer calls! 😘"
-                logger.info(f"[CALL END] Sending partial payment notification to user {user_id}")
+                logger.info("[CALL END] Sending partial payment notification to user %s", user_id)
             else:
                 # Normal completion
                 message = f"💖 Your call has ended! Duration: {actual_duration} minutes.\n💎 Cost: {gems_to_deduct} Gems\n💎 Remaining Gems: {new_gem_balance}\n\nThank you for calling! 😘"
-                logger.info(f"[CALL END] Sending full payment notification to user {user_id}")
+                logger.info("[CALL END] Sending full payment notification to user %s", user_id)
             
             await self.application.bot.send_message(chat_id=user_id, text=message)
-            logger.info(f"[CALL END] ✅ Successfully sent billing notification to user {user_id}")
+            logger.info("[CALL END] ✅ Successfully sent billing notification to user %s", user_id)
             
-            logger.info(f"[CALL END] ================= BILLING COMPLETE =================")
-            logger.info(f"[CALL END] ✅ Successfully processed call end for {call_id}")
+            logger.info("[CALL END] ================= BILLING COMPLETE =================")
+            logger.info("[CALL END] ✅ Successfully processed call end for %s", call_id)
             
         except Exception as e:
-            logger.error(f"[CALL END] Error processing call end for {call_id}: {e}")
+            logger.error("[CALL END] Error processing call end for %s: %s", call_id, e)
+            if not billed:
+                # Hand the claim back so a redelivered webhook or the supervisor's next check can bill the call
+                await self.state.release_call_end(call_id)
+                raise
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Handle WebApp data from frontend
@@ -2742,29 +5242,81 @@ class SecretShareBot:
             
         if not update.message or not update.message.text:
             return
-        user_tg = update.effective_user
-        user_id = user_tg.id
+        user_id = update.effective_user.id
         user_message = update.message.text
-        logger.info(f"[DEBUG] User message: '{user_message}' (user_id={user_id})")
+        logger.debug("[DEBUG] User message: %r (user_id=%s)", user_message, user_id)
 
-        # START TYPING INDICATOR: fire instantly and keep it alive concurrently
-        try:
-            # Immediate feedback (does not persist)
-            await update.message.chat.send_action("typing")
-        except Exception as e:
-            logger.warning(f"[TYPING] Could not start instant typing for user {user_id}: {e}")
+        # Admission control only guards the LLM chat path (not phone collection or onboarding)
+        user_session = self.active_users.get(user_id)
+        awaiting_phone = bool(user_session and user_session.premium_offer_state and user_session.premium_offer_state.get('status') == 'waiting_for_phone')
+        if user_session and user_session.current_character and not awaiting_phone:
+            if self.admission.is_duplicate(user_id, user_message):
+                logger.info("[ADMISSION] Dropped repeated message from user %s while the first is pending", user_id)
+                return
+            if user_session.deferred_messages or self.admission.overloaded():
+                await self._defer_message(update, user_session, user_message)
+                return
+
+        with self.admission.track(user_id, user_message), MessageTrace(user_id, update_id=update.update_id):
+            try:
+                await self._process_message(update, context, user_message)
+            finally:
+                self.typing.stop_typing(user_id)
 
-        # Ensure a session exists early so we can attach a persistent typing manager
+    async def _defer_message(self, update: Update, user_session: UserData, user_message: str):
+        """Hold a message back while the chat path is overloaded; later messages are merged into it."""
+        user_id = update.effective_user.id
+        first = not user_session.deferred_messages
+        user_session.deferred_messages.append(user_message)
+        user_session.deferred_update = update
+        self.admission.counts['deferred'] += 1
+        if not first:
+            return
+        self.admission.counts['deferred_users'] += 1
+        delay = max(3.0, min(self.admission.estimated_wait(), 60.0))
+        logger.warning("[ADMISSION] Deferring user %s for %.0fs (in-flight %s, est. wait %.1fs)", user_id, delay, self.admission.in_flight, self.admission.estimated_wait())
+        await update.message.reply_text(random.choice(ADMISSION_HOLD_TEMPLATES))
+        self.application.job_queue.run_once(
+            self._process_deferred_messages, when=delay, data={'user_id': user_id, 'attempt': 1}, name=f"deferred_{user_id}"
+        )
+
+    async def _process_deferred_messages(self, context: ContextTypes.DEFAULT_TYPE):
+        user_id = context.job.data['user_id']
+        attempt = context.job.data['attempt']
+        user_session = self.active_users.get(user_id)
+        if not user_session or not user_session.deferred_messages:
+            return
+        if self.admission.overloaded() and attempt < ADMISSION_MAX_DEFER_ATTEMPTS:
+            context.job_queue.run_once(
+                self._process_deferred_messages, when=5, data={'user_id': user_id, 'attempt': attempt + 1}, name=f"deferred_{user_id}"
+            )
+            return
+        # Run in the chat's lane so a message arriving meanwhile waits for the batch instead of racing it
+        lane_key = ChatOrderedUpdateProcessor._lane_key(user_session.deferred_update)
+        async with self.application.update_processor.lane(lane_key):
+            update = user_session.deferred_update
+            if not update:
+                return
+            user_message = "\n".join(user_session.deferred_messages)
+            user_session.deferred_messages = []
+            user_session.deferred_update = None
+            logger.info("[ADMISSION] Processing deferred message(s) for user %s after %s check(s)", user_id, attempt)
+            with self.admission.track(), MessageTrace(user_id, update_id=update.update_id, deferred_attempts=attempt):
+                try:
+                    await self._process_message(update, context, user_message)
+                finally:
+                    self.typing.stop_typing(user_id)
+
+    async def _process_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
+        user_tg = update.effective_user
+        user_id = user_tg.id
+
+        # START TYPING INDICATOR: the ticker sends it right away and keeps it alive until the reply
+        with trace_stage('typing'):
+            self.typing.start_typing(user_id)
         if user_id not in self.active_users:
             self.active_users[user_id] = UserData()
         user_session = self.active_users.get(user_id)
-        if not user_session.typing_manager:
-            user_session.typing_manager = TypingManager(context.bot, user_id)
-        # Start persistent typing refresh in the background without blocking
-        try:
-            asyncio.create_task(user_session.typing_manager.start_typing())
-        except Exception:
-            pass
 
         # Skip user data refresh during high load to improve performance
 
@@ -2782,19 +5334,20 @@ class SecretShareBot:
                     await self.handle_voice_call_phone_collection(update, context, user_id, user_message)
                     return
         
-        user_db_data = self.db.get_or_create_user(user_id, user_tg.username or "Unknown")
+        with trace_stage('user_lookup'):
+            user_db_data = self.db.get_or_create_user(user_id, user_tg.username or "Unknown")
         if not user_db_data:
             await update.message.reply_text("Sorry, there was a problem accessing your profile. Please try again later. 😟")
             return
         # Session should already be loaded by _refresh_user_data_on_return()
         if user_id not in self.active_users:
-            logger.warning(f"[SESSION ERROR] User {user_id} missing from active_users after refresh - creating emergency session")
+            logger.warning("[SESSION ERROR] User %s missing from active_users after refresh - creating emergency session", user_id)
             self.active_users[user_id] = UserData()
         user_session = self.active_users[user_id]
         user_session.last_interaction_time = datetime.now(timezone.utc)
         # Increment session message count for upsell logic
         user_session.session_message_count += 1
-        logger.info(f"[SESSION STATE] user_id={user_id}, character={user_session.current_character}, scenario={user_session.current_scenario}")
+        logger.debug("[SESSION STATE] user_id=%s, character=%s, scenario=%s", user_id, user_session.current_character, user_session.current_scenario)
         await self._schedule_follow_up(user_id)
         # Only prompt for character/scenario if missing
         if not user_session.current_character or not user_session.current_scenario:
@@ -2806,17 +5359,19 @@ class SecretShareBot:
         # --- BULLETPROOF SUBSCRIPTION & MESSAGE LIMIT ENFORCEMENT ---
         
         # First, get comprehensive subscription status
-        is_subscribed = self.db.check_subscription(user_id)
+        with trace_stage('subscription_check'):
+            is_subscribed = self.db.check_subscription(user_id)
         is_admin = str(user_id) == ADMIN_CHAT_ID
         
-        logger.info(f"[SUBSCRIPTION CHECK] User {user_id}: is_subscribed='{is_subscribed}', is_admin={is_admin}")
+        logger.debug("[SUBSCRIPTION CHECK] User %s: is_subscribed=%r, is_admin=%s", user_id, is_subscribed, is_admin)
         
         # Only enforce daily limits for FREE users (non-subscribed, non-admin)
         if not is_subscribed and not is_admin:
-            current_user_data = self.db.get_or_create_user(user_id, user_tg.username or "Unknown")
+            with trace_stage('limit_check'):
+                current_user_data = self.db.get_or_create_user(user_id, user_tg.username or "Unknown")
             messages_today = current_user_data.get('messages_today', 0) if current_user_data else 0
             
-            logger.info(f"[MESSAGE LIMIT] Free user {user_id}: {messages_today}/{DAILY_MESSAGE_LIMIT} messages today")
+            logger.debug("[MESSAGE LIMIT] Free user %s: %s/%s messages today", user_id, messages_today, DAILY_MESSAGE_LIMIT)
             
             if messages_today >= DAILY_MESSAGE_LIMIT:
                 keyboard = [[InlineKeyboardButton("✨ Upgrade Now", web_app={"url": os.getenv('FRONTEND_URL', 'https://secret-share.com')})]]
@@ -2825,13 +5380,10 @@ class SecretShareBot:
                     "You've reached your daily free message limit! ✨ To continue our conversation without interruption, you can get a subscription for unlimited access and monthly Gems. Tap below to see the options.",
                     reply_markup=reply_markup
                 )
-                logger.info(f"[MESSAGE LIMIT] ❌ Blocked free user {user_id} at {messages_today} messages")
+                logger.info("[MESSAGE LIMIT] ❌ Blocked free user %s at %s messages", user_id, messages_today)
                 return
         user_session.message_count_since_last_image += 1
         
-        # Ensure typing manager exists (already started above)
-        if not user_session.typing_manager:
-            user_session.typing_manager = TypingManager(context.bot, user_id)
         # --- EARLY UPSALE CHECKS (move all upsell logic here, before AI response) ---
         # Prevent back-to-back upsells
         now = datetime.now(timezone.utc)
@@ -2844,8 +5396,9 @@ class SecretShareBot:
             ('voice_call', is_voice_call_request, VOICE_CALL_COST_PER_MINUTE)
         ]:
             if checker(user_message) and can_upsell:
-                logger.info(f"[UPSELL] User-initiated {offer_type} request detected for user {user_id}")
-                char_ack = await self.generate_upsell_line(user_session, offer_type, user_message)
+                logger.info("[UPSELL] User-initiated %s request detected for user %s", offer_type, user_id)
+                with trace_stage('upsell'):
+                    char_ack = await self.generate_upsell_line(user_session, offer_type, user_message)
                 user_session.premium_offer_state = {'type': offer_type, 'status': 'pending'}
                 await self.send_premium_offer_overlay(update, context, user_id, offer_type, gem_cost, character_line=char_ack)
                 user_session.last_upsell_time = datetime.now(timezone.utc)  # Set cooldown immediately when upsell is sent
@@ -2854,8 +5407,9 @@ class SecretShareBot:
         # Handle video requests with LoRA detection
         is_video_request, detected_lora = is_custom_video_request(user_message)
         if is_video_request and can_upsell:
-            logger.info(f"[UPSELL] User-initiated video request detected for user {user_id} with LoRA: {detected_lora}")
-            char_ack = await self.generate_upsell_line(user_session, 'video', user_message)
+            logger.info("[UPSELL] User-initiated video request detected for user %s with LoRA: %s", user_id, detected_lora)
+            with trace_stage('upsell'):
+                char_ack = await self.generate_upsell_line(user_session, 'video', user_message)
             # Store detected_lora as None if no specific keyword was found (will trigger random selection)
             user_session.premium_offer_state = {'type': 'video', 'status': 'pending', 'detected_lora': detected_lora}
             await self.send_premium_offer_overlay(update, context, user_id, 'video', 80, character_line=char_ack)
@@ -2876,8 +5430,9 @@ class SecretShareBot:
                     offer_type = 'voice_call'
                     gem_cost = VOICE_CALL_COST_PER_MINUTE
                 
-                char_ack = await self.generate_upsell_line(user_session, offer_type)
-                logger.info(f"[UPSELL] Fallback random AI upsell triggered for user {user_id}: {offer_type}")
+                with trace_stage('upsell'):
+                    char_ack = await self.generate_upsell_line(user_session, offer_type)
+                logger.info("[UPSELL] Fallback random AI upsell triggered for user %s: %s", user_id, offer_type)
                 user_session.premium_offer_state = {'type': offer_type, 'status': 'pending'}
                 await self.send_premium_offer_overlay(update, context, user_id, offer_type, gem_cost, character_line=char_ack)
                 user_session.last_upsell_time = datetime.now(timezone.utc)  # Set cooldown immediately when upsell is sent
@@ -2892,41 +5447,35 @@ class SecretShareBot:
             any(keyword in user_message.lower() for keyword in ['my name is', 'call me', 'i am', "i'm", 'name is'])
         )
         
-        if should_extract_name:
-            # Conservative name extraction patterns
-            name_patterns = [
-                r"(?:my name is|call me|the name is|i(?:'m| am)|it's|this is|you can call me|just call me|name's)\s+([A-Za-z]{2,20})\b",
-                r"^([A-Z][a-z]{2,19})[.,!\s]*hi[.,!\s]*$",  # "Jacob, hi." or "Jacob hi" 
-                r"^([A-Z][a-z]{2,19})[.,!\s]+here\b"       # "Jacob here"
-            ]
-            
-            for pattern in name_patterns:
-                match = re.search(pattern, user_message, re.IGNORECASE)
-                if match:
-                    potential_name = match.group(1).capitalize()
-                    logger.info(f"[NAME EXTRACTION] Matched pattern: '{pattern}' → Name: '{potential_name}'")
-                    break
+        with trace_stage('name_extraction'):
+            if should_extract_name:
+                for pattern in NAME_PATTERNS:
+                    match = re.search(pattern, user_message, re.IGNORECASE)
+                    if match:
+                        potential_name = match.group(1).capitalize()
+                        logger.info("[NAME EXTRACTION] Matched pattern: '%s' → Name: '%s'", pattern, potential_name)
+                        break
             
-            # Only set name if we found one OR if no name exists yet
-            if potential_name:
-                old_name = user_session.user_name
-                user_session.user_name = potential_name
-                self.db.update_user_name(user_id, user_session.user_name)
-                logger.info(f"[NAME UPDATE] ✅ User {user_id} name updated from '{old_name}' to '{potential_name}' in session and database")
-            elif not user_session.user_name or user_session.user_name in ['handsome', 'bello', 'there']:
-                # Only use placeholder if no name was found AND no real name exists
-                user_session.user_name = random.choice(['handsome', 'bello', 'there'])
-                logger.info(f"[NAME PLACEHOLDER] ⚠️ No name detected in message '{user_message}', using placeholder '{user_session.user_name}' for user {user_id}")
+                # Only set name if we found one OR if no name exists yet
+                if potential_name:
+                    old_name = user_session.user_name
+                    user_session.user_name = potential_name
+                    self.db.update_user_name(user_id, user_session.user_name)
+                    logger.info("[NAME UPDATE] ✅ User %s name updated from '%s' to '%s' in session and database", user_id, old_name, potential_name)
+                elif not user_session.user_name or user_session.user_name in ['handsome', 'bello', 'there']:
+                    # Only use placeholder if no name was found AND no real name exists
+                    user_session.user_name = random.choice(['handsome', 'bello', 'there'])
+                    logger.info("[NAME PLACEHOLDER] ⚠️ No name detected in message '%s', using placeholder '%s' for user %s", user_message, user_session.user_name, user_id)
         
         # Only log name extraction for debug when actually extracting
         if should_extract_name:
-            logger.info(f"[NAME EXTRACTION] User message: '{user_message}' | Extracted: '{potential_name}' | Current name: '{user_session.user_name}'")
+            logger.info("[NAME EXTRACTION] User message: '%s' | Extracted: '%s' | Current name: '%s'", user_message, potential_name, user_session.user_name)
         # v68: Enhanced state machine with validation
         if user_session.clothing_state == 'clothed' and any(keyword in user_message.lower() for keyword in self.image_generator.nsfw_keywords):
             if user_session.update_clothing_state('undressing'):
-                logger.info(f"[STATE] User {user_id}: clothed -> undressing (triggered by keywords)")
+                logger.info("[STATE] User %s: clothed -> undressing (triggered by keywords)", user_id)
             else:
-                logger.warning(f"[STATE] Invalid transition attempted for user {user_id}")
+                logger.warning("[STATE] Invalid transition attempted for user %s", user_id)
 
         # --- Image Generation Trigger ---
         trigger_image_generation = False
@@ -2935,180 +5484,132 @@ class SecretShareBot:
             is_subsequent_image = user_session.message_count_since_last_image > 3 and (user_session.message_count_since_last_image - 3) % 4 == 0
             
             if is_first_image or is_subsequent_image:
-                logger.info(f"[TRIGGER] Image generation for user {user_id} at message count {user_session.message_count_since_last_image}.")
+                logger.info("[TRIGGER] Image generation for user %s at message count %s.", user_id, user_session.message_count_since_last_image)
                 trigger_image_generation = True
         
         # --- Context Loop: Generate Image First ---
         generated_image_url = None
         if trigger_image_generation:
-            generated_image_url = await self._generate_and_send_image(update, context, user_id, user_message)
+            with trace_stage('image_generation'):
+                generated_image_url = await self._generate_and_send_image(update, context, user_id, user_message)
             if generated_image_url:
                 self.active_users[user_id].last_image_url = generated_image_url
-                logger.info(f"[STATE] Saved last_image_url for user {user_id}: {generated_image_url}")
+                logger.info("[STATE] Saved last_image_url for user %s: %s", user_id, generated_image_url)
             user_session.message_count_since_last_image = 0
 
         # --- Always Generate a Text Response ---
         try:
-            character = CHARACTERS[user_session.current_character]
-            # Use the user's actual name if available, else prompt for it
-            if user_session.user_name:
-                user_name_for_prompt = user_session.user_name
-            else:
-                user_name_for_prompt = random.choice(['handsome', 'bello', 'there'])
-            base_prompt = character["system_prompt_base"].format(user_name=escape_markdown(user_name_for_prompt or "", version=2))
-            scenario_prompt = f"You are in {character['scenarios'][user_session.current_scenario]['scenario_prompt']}. You are wearing {user_session.character_current_outfit}."
-            # Add explicit instruction to keep responses simple and clear, and for first two messages, be welcoming and direct
-            if len(user_session.conversation_history) <= 1:
-                system_prompt_full = f"{base_prompt}\n**Current Scenario Context:** {scenario_prompt}\n**IMPORTANT:** For the first two messages, use simple, welcoming, and direct English. Be friendly and easy to understand. Keep responses concise (max 100 tokens). Think naturally but express yourself briefly and clearly."
-            else:
-                system_prompt_full = f"{base_prompt}\n**Current Scenario Context:** {scenario_prompt}\n**IMPORTANT:** Use simple, clear, easy-to-understand English. Keep responses concise (max 100 tokens). Avoid fancy words, complex sentences, or long paragraphs. Respond naturally and keep it friendly. Think like a real person having a casual conversation."
-            # v69: Always inject last image context if available
-            if hasattr(user_session, 'last_image_context') and user_session.last_image_context:
-                img_ctx = user_session.last_image_context
-                if img_ctx['clothing_state'] == 'nude':
-                    system_prompt_full += "\n**IMAGE CONTEXT:** You have just revealed your naked body to the user in the last image. Your dialogue MUST acknowledge this reality. You are no longer wearing clothes. Reference the image naturally in your response."
-                elif img_ctx['clothing_state'] == 'undressing':
-                    system_prompt_full += f"\n**IMAGE CONTEXT:** An image of you in a state of undress was just sent. You are partially removing your {img_ctx['outfit']}. Your dialogue must acknowledge this ongoing action."
-                else:  # clothed
-                    system_prompt_full += f"\n**IMAGE CONTEXT:** An image of you wearing {img_ctx['outfit']} was just sent. Your dialogue should naturally reference your appearance or the visual moment captured."
-            elif generated_image_url:
-                # fallback for legacy
-                if user_session.clothing_state == 'nude':
-                    system_prompt_full += "\n**IMAGE CONTEXT:** You have just revealed your naked body to the user in the image that was sent. Your dialogue MUST acknowledge this reality. You are no longer wearing clothes. Reference the image naturally in your response."
-                elif user_session.clothing_state == 'undressing':
-                    system_prompt_full += f"\n**IMAGE CONTEXT:** An image of you in a state of undress was just sent. You are partially removing your {user_session.character_current_outfit}. Your dialogue must acknowledge this ongoing action."
+            with trace_stage('prompt_build'):
+                started = perf_counter()
+                character = CHARACTERS[user_session.current_character]
+                # Use the user's actual name if available, else prompt for it
+                if user_session.user_name:
+                    user_name_for_prompt = user_session.user_name
                 else:
-                    system_prompt_full += f"\n**IMAGE CONTEXT:** An image of you wearing {user_session.character_current_outfit} was just sent. Your dialogue should naturally reference your appearance or the visual moment captured."
-            # If user name is missing, prompt for it
-            if not user_session.user_name:
-                # Stop typing before name request
-                if user_session.typing_manager:
-                    await user_session.typing_manager.stop_typing()
-                await update.message.reply_text("Before we continue, what should I call you? Please tell me your name.")
-                return
-            # FORCED CONTEXT SHIFTING - Mimic Kobold's automatic behavior
-            prompt_parts = [f"<|im_start|>system\n{system_prompt_full}<|im_end|>"]
-            
-            # Start with recent history and trim aggressively if needed
-            recent_history = user_session.conversation_history[-6:]
-            
-            # Build initial prompt
-            for turn in recent_history:
-                prompt_parts.append(f"<|im_start|>{turn['role']}\n{turn['content']}<|im_end|>")
-            
-            prompt_parts.append(f"<|im_start|>user\n{user_message}<|im_end|>")
-            prompt_parts.append(f"<|im_start|>assistant\n{character['full_name']}:")
-            initial_prompt = "".join(prompt_parts)
-            
-            # FORCE CONTEXT TRIMMING - ALWAYS trim to last 2 turns for guaranteed speed
-            # Character count based estimation (more accurate)
-            char_count = len(initial_prompt)
-            estimated_tokens = char_count // 3  # ~3 chars per token average
-            
-            logger.info(f"[CONTEXT] Initial size: {estimated_tokens} tokens ({char_count} chars)")
-            
-            # Optimized: 5 turns for better memory while keeping speed on A5000
-            prompt_parts = [f"<|im_start|>system\n{system_prompt_full}<|im_end|>"]
-            
-            # Keep last 5 turns for speed/personality balance
-            minimal_history = user_session.conversation_history[-5:] if len(user_session.conversation_history) >= 5 else user_session.conversation_history
-            for turn in minimal_history:
-                prompt_parts.append(f"<|im_start|>{turn['role']}\n{turn['content']}<|im_end|>")
-            
-            prompt_parts.append(f"<|im_start|>user\n{user_message}<|im_end|>")
-            prompt_parts.append(f"<|im_start|>assistant\n{character['full_name']}:")
-            final_prompt = "".join(prompt_parts)
-            
-            final_char_count = len(final_prompt)
-            final_tokens = final_char_count // 3
-            # Guard rail: if prompt grows too large, squeeze to last 3 turns to protect latency
-            if final_tokens > 800:
-                prompt_parts = [f"<|im_start|>system\n{system_prompt_full}<|im_end|>"]
-                squeeze_history = user_session.conversation_history[-3:] if len(user_session.conversation_history) >= 3 else user_session.conversation_history
-                for turn in squeeze_history:
-                    prompt_parts.append(f"<|im_start|>{turn['role']}\n{turn['content']}<|im_end|>")
-                prompt_parts.append(f"<|im_start|>user\n{user_message}<|im_end|>")
-                prompt_parts.append(f"<|im_start|>assistant\n{character['full_name']}:")
-                final_prompt = "".join(prompt_parts)
+                    user_name_for_prompt = random.choice(['handsome', 'bello', 'there'])
+                # v69: Always inject last image context if available
+                image_context = None
+                if getattr(user_session, 'last_image_context', None):
+                    image_context = (user_session.last_image_context['clothing_state'], user_session.last_image_context['outfit'])
+                elif generated_image_url:
+                    # fallback for legacy
+                    image_context = (user_session.clothing_state, user_session.character_current_outfit)
+                # If user name is missing, prompt for it
+                if not user_session.user_name:
+                    # Stop typing before name request
+                    self.typing.stop_typing(user_id)
+                    await update.message.reply_text("Before we continue, what should I call you? Please tell me your name.")
+                    return
+                system_prompt_full = PROMPTS.chat_system(user_session, user_name_for_prompt, image_context)
+                # FORCED CONTEXT SHIFTING - Mimic Kobold's automatic behavior
+                # Optimized: 5 turns for better memory while keeping speed on A5000
+                minimal_history = user_session.conversation_history[-5:]
+                final_prompt = PROMPTS.chat(system_prompt_full, minimal_history, user_message, user_session, started)
+                # Character count based estimation, ~3 chars per token average
                 final_char_count = len(final_prompt)
                 final_tokens = final_char_count // 3
-            logger.info(f"[CONTEXT SHIFT] ✅ Using {len(minimal_history)}-turn memory, {final_tokens} tokens ({final_char_count} chars)")
+                # Guard rail: if prompt grows too large, squeeze to last 3 turns to protect latency
+                if final_tokens > 800:
+                    minimal_history = user_session.conversation_history[-3:]
+                    final_prompt = PROMPTS.chat(system_prompt_full, minimal_history, user_message, user_session, perf_counter())
+                    final_char_count = len(final_prompt)
+                    final_tokens = final_char_count // 3
+                logger.info("[CONTEXT SHIFT] ✅ Using %s-turn memory, %s tokens (%s chars)", len(minimal_history), final_tokens, final_char_count)
 
             raw_bot_response = ""
-            if self.kobold_available:
-                raw_bot_response = await self.kobold_api.generate(final_prompt, max_tokens=120)
-            else:
-                raw_bot_response = "*I sigh softly.* My thoughts are a bit hazy right now... I can't seem to connect. Please try again in a little while."
+            with trace_stage('kobold'):
+                if self.kobold_available:
+                    raw_bot_response = await self.kobold_api.generate(final_prompt, max_tokens=120)
+                else:
+                    raw_bot_response = "*I sigh softly.* My thoughts are a bit hazy right now... I can't seem to connect. Please try again in a little while."
+                    METRICS.inc('fallback_responses_total', source='kobold_unavailable')
 
             # --- Final Processing ---
-            # Normalize underscores to asterisks, strip artifacts, enforce clean actions and sentence
-            completed_sentence_response = self._normalize_actions(raw_bot_response)
-            completed_sentence_response = self._strip_artifacts(completed_sentence_response)
-            completed_sentence_response = self._ensure_complete_sentence(completed_sentence_response)
-            completed_sentence_response = self._validate_and_fix_actions(completed_sentence_response, user_session.user_name or "you")
-            # Keep responses concise without cutting content: prefer 3–5 lines, 700 chars cap
-            completed_sentence_response = self._trim_for_length(completed_sentence_response, max_sentences=5, max_lines=5, max_chars=700)
-            if not completed_sentence_response:
-                completed_sentence_response = "*I bite my lip, a thoughtful look in my eyes...* I don't know what to say."
-
-            # v68: Enhanced state detection with validation
-            if user_session.clothing_state == 'undressing' and "naked" in completed_sentence_response.lower() and any(phrase in completed_sentence_response.lower() for phrase in ["step out of", "completely naked", "fully nude"]):
-                if user_session.update_clothing_state('nude'):
-                    self.active_users[user_id].character_current_outfit = "nothing but your bare skin"
-                    logger.info(f"[STATE] User {user_id}: undressing -> nude (detected in response)")
-                    user_session.conversation_history.append({"role": "system", "content": "SYSTEM NOTIFICATION: You are now completely naked. The user can see you. Your next response MUST acknowledge that you are naked."})
-
-            final_response = completed_sentence_response.strip()
-
-            # Stop typing indicator before sending response
-            if user_session.typing_manager:
-                await user_session.typing_manager.stop_typing()
+            with trace_stage('post_processing'):
+                # Normalize underscores to asterisks, strip artifacts, enforce clean actions and sentence
+                completed_sentence_response = self._normalize_actions(raw_bot_response)
+                completed_sentence_response = self._strip_artifacts(completed_sentence_response)
+                completed_sentence_response = self._ensure_complete_sentence(completed_sentence_response)
+                completed_sentence_response = self._validate_and_fix_actions(completed_sentence_response, user_session.user_name or "you")
+                # Keep responses concise without cutting content: prefer 3–5 lines, 700 chars cap
+                completed_sentence_response = self._trim_for_length(completed_sentence_response, max_sentences=5, max_lines=5, max_chars=700)
+                if not completed_sentence_response:
+                    completed_sentence_response = "*I bite my lip, a thoughtful look in my eyes...* I don't know what to say."
+
+                # v68: Enhanced state detection with validation
+                if user_session.clothing_state == 'undressing' and "naked" in completed_sentence_response.lower() and any(phrase in completed_sentence_response.lower() for phrase in ["step out of", "completely naked", "fully nude"]):
+                    if user_session.update_clothing_state('nude'):
+                        self.active_users[user_id].character_current_outfit = "nothing but your bare skin"
+                        logger.info("[STATE] User %s: undressing -> nude (detected in response)", user_id)
+                        user_session.conversation_history.append({"role": "system", "content": "SYSTEM NOTIFICATION: You are now completely naked. The user can see you. Your next response MUST acknowledge that you are naked."})
+
+                final_response = completed_sentence_response.strip()
+
+            with trace_stage('send'):
+                # Stop typing indicator before sending response
+                self.typing.stop_typing(user_id)
             
-            if final_response:
-                await update.message.reply_text(final_response)
+                if final_response:
+                    await update.message.reply_text(final_response)
 
-            user_session.conversation_history.append({"role": "user", "content": user_message})
-            if final_response:
-                user_session.conversation_history.append({"role": "assistant", "content": final_response})
+            with trace_stage('background_writes'):
+                user_session.conversation_history.append({"role": "user", "content": user_message})
+                if final_response:
+                    user_session.conversation_history.append({"role": "assistant", "content": final_response})
             
-            # AGGRESSIVE CONTEXT TRIMMING - Keep only last 20 turns for speed
-            if len(user_session.conversation_history) > 20:
-                # Keep first 2 turns (character intro) and last 18 turns
-                important_start = user_session.conversation_history[:2]
-                recent_turns = user_session.conversation_history[-18:]
-                user_session.conversation_history = important_start + recent_turns
-                logger.info(f"[CONTEXT] Trimmed history to 20 turns for user {user_id} - maintaining speed")
+                # AGGRESSIVE CONTEXT TRIMMING - Keep only last 20 turns for speed
+                if len(user_session.conversation_history) > 20:
+                    # Keep first 2 turns (character intro) and last 18 turns
+                    important_start = user_session.conversation_history[:2]
+                    recent_turns = user_session.conversation_history[-18:]
+                    user_session.conversation_history = important_start + recent_turns
+                    logger.info("[CONTEXT] Trimmed history to 20 turns for user %s - maintaining speed", user_id)
             
-            asyncio.create_task(self.db.update_user_on_message(user_id))
-            if final_response:
-                asyncio.create_task(self.db.create_conversation_entry(user_id, character['full_name'], user_message, final_response))
-
-            # Save session to database after successful message processing
-            session_data = {
-                'current_character': user_session.current_character,
-                'current_scenario': user_session.current_scenario,
-                'conversation_history': user_session.conversation_history,
-                'user_name': user_session.user_name,
-                'clothing_state': user_session.clothing_state,
-                'character_current_outfit': user_session.character_current_outfit,
-                'free_images_sent': user_session.free_images_sent,
-                'message_count_since_last_image': user_session.message_count_since_last_image,
-                'session_message_count': user_session.session_message_count,
-                'asked_for_name': user_session.asked_for_name,
-                'last_interaction_time': user_session.last_interaction_time.isoformat()
-            }
-            asyncio.create_task(self.db.save_user_session(user_id, session_data))
+                asyncio.create_task(self.db.update_user_on_message(user_id))
+                if final_response:
+                    asyncio.create_task(self.db.create_conversation_entry(user_id, character['full_name'], user_message, final_response))
+
+                # Save session to database after successful message processing
+                session_data = {
+                    'current_character': user_session.current_character,
+                    'current_scenario': user_session.current_scenario,
+                    'conversation_history': user_session.conversation_history,
+                    'user_name': user_session.user_name,
+                    'clothing_state': user_session.clothing_state,
+                    'character_current_outfit': user_session.character_current_outfit,
+                    'free_images_sent': user_session.free_images_sent,
+                    'message_count_since_last_image': user_session.message_count_since_last_image,
+                    'session_message_count': user_session.session_message_count,
+                    'asked_for_name': user_session.asked_for_name,
+                    'last_interaction_time': user_session.last_interaction_time.isoformat()
+                }
+                asyncio.create_task(self.db.save_user_session(user_id, session_data))
 
         except Exception as e:
-            logger.error(f"Error in handle_message for user {user_id}: {e}", exc_info=True)
+            logger.error("Error in handle_message for user %s: %s", user_id, e, exc_info=True)
             
             # Stop typing indicator on error
-            user_session = self.active_users.get(user_id)
-            if user_session and user_session.typing_manager:
-                try:
-                    await user_session.typing_manager.stop_typing()
-                except Exception:
-                    pass  # Ignore errors in cleanup
+            self.typing.stop_typing(user_id)
                     
             await update.message.reply_text("Oh, my... I seem to have gotten my thoughts all tangled up. Could you say that again? 💕")
 
@@ -3177,11 +5678,9 @@ class SecretShareBot:
        user = update.effective_user
        user_id = user.id
        
-       # Clean up any existing session state and typing manager
+       # Clean up any existing session state and typing indicator
+       self.typing.stop_typing(user_id)
        if user_id in self.active_users:
-           user_session = self.active_users[user_id]
-           if user_session.typing_manager:
-               await user_session.typing_manager.stop_typing()
            # Reset to fresh session
            self.active_users[user_id] = UserData()
        
@@ -3257,7 +5756,7 @@ class SecretShareBot:
        if query.data == "verify_age_yes":
            user_id = query.from_user.id
            # Set age verification in background for speed
-           asyncio.create_task(self.db.set_age_verified(user_id))
+           asyncio.create_task(asyncio.to_thread(self.db.set_age_verified, user_id))
            # Update in-memory cache for instant future starts
            if hasattr(self, 'age_verified_cache'):
                self.age_verified_cache.add(user_id)
@@ -3342,7 +5841,7 @@ class SecretShareBot:
         user_session.state_transition_history = ["init->clothed"]
         # Reset session message count on new scenario
         user_session.session_message_count = 0
-        logger.info(f"[STATE] User {user_id} initialized with outfit: {user_session.character_current_outfit}")
+        logger.info("[STATE] User %s initialized with outfit: %s", user_id, user_session.character_current_outfit)
 
         await query.delete_message()
 
@@ -3442,6 +5941,34 @@ class SecretShareBot:
                    )
                    user_session.premium_offer_state = {}
                    return
+               if offer_type in PREMIUM_JOB_WORKERS:
+                   # One job per offer message, so a repeated click can never debit twice
+                   idempotency_key = f"{offer_type}:{user_id}:{query.message.message_id}"
+                   try:
+                       # The job row and the gem debit are committed together
+                       job = await asyncio.to_thread(
+                           Database.enqueue_premium_job, idempotency_key, user_id, offer_type, gem_cost,
+                           self._build_premium_job_payload(user_session, offer_type, query)
+                       )
+                   except Exception as e:
+                       logger.error(f"[PREMIUM JOB] Failed to create {offer_type} job for user {user_id}: {e}")
+                       await query.edit_message_text("There was a problem processing your payment. Please try again later.")
+                       user_session.premium_offer_state = {}
+                       return
+                   if not job:
+                       await query.edit_message_text("⏳ Processing your request, please wait...")
+                       return
+                   # Fulfilment happens in the background job queue
+                   if offer_type == 'image':
+                       await query.edit_message_text("💕 Your image is being created! I'll send it to you in a moment.")
+                   elif offer_type == 'video':
+                       await query.edit_message_text("💕 Your video is being created! I'll send it to you when it's ready (usually within 2-3 minutes).")
+                   else:
+                       await query.edit_message_text("💕 Recording your voice note...")
+                   await self.premium_jobs.submit(job)
+                   user_session.premium_offer_state = {}
+                   user_session.last_upsell_time = datetime.now(timezone.utc)
+                   return
                # Deduct gems
                try:
                    # Always store pre-deduction balance BEFORE deduction for all premium features
@@ -3451,147 +5978,11 @@ class SecretShareBot:
                    await query.edit_message_text("There was a problem processing your payment. Please try again later.")
                    user_session.premium_offer_state = {}
                    return
-               # --- LoRA selection for video ---
-               lora_type = None
-               if offer_type == 'video':
-                   # Try keyword mapping from last user message, else random
-                   last_user_msg = None
-                   for turn in reversed(user_session.conversation_history):
-                       if turn['role'] == 'user':
-                           last_user_msg = turn['content']
-                           break
-               # --- Generate upsell line with LoRA and conversation context ---
-               # char_ack = await self.generate_upsell_line(user_session, offer_type)  # REMOVE this line
-               history_window = user_session.conversation_history[-4:] if len(user_session.conversation_history) >= 4 else user_session.conversation_history
-               if offer_type == 'image':
-                   # Use both upsell line and recent chat for image prompt
-                   image_prompt_context = ""  # Don't prepend char_ack again
-                   image_prompt_context += "\n".join([f"{turn['role']}: {turn['content']}" for turn in history_window])
-                   image_url = await self.image_generator.generate_final_image(user_session, user_message=image_prompt_context)
-                   if image_url:
-                       # Remove the original message with buttons
-                       await query.edit_message_text("\u2764\ufe0f Your image is ready!")
-                       await context.bot.send_photo(chat_id=user_id, photo=image_url)
-                       self.db.clear_pending_gem_refund(user_id)
-                   else:
-                       # Refund gems and notify user
-                       refunded = self.db.refund_gems(user_id, gem_cost)
-                       if refunded:
-                        await query.edit_message_text("I'm so sorry, but it seems there was an issue creating your content. The Gems have been automatically refunded to your account. Please feel free to try again in a moment.")
-               elif offer_type == 'video':
-                   # Check if a specific LoRA was detected from user's message
-                   detected_lora = user_session.premium_offer_state.get('detected_lora')
-                   if detected_lora:
-                       # Use the detected LoRA if a keyword was found
-                       logger.info(f"[VIDEO] Using detected LoRA: {detected_lora}")
-                   else:
-                       # Randomly select from the safe solo action pool
-                       detected_lora = random.choice(SOLO_ACTION_LORA_POOL)
-                       logger.info(f"[VIDEO] No specific keyword detected, randomly selected LoRA: {detected_lora}")
-                   # Step 1: Generate still image using LoRA-specific prompt
-                   lora_image_prompt = self._get_lora_image_prompt(user_session, detected_lora)
-                   image_url = await self.image_generator.generate_final_image(user_session, user_message=lora_image_prompt)
-                   if not image_url:
-                       # Refund gems and notify user
-                       refunded = self.db.refund_gems(user_id, gem_cost)
-                       if refunded:
-                           await query.edit_message_text("I'm so sorry, but it seems there was an issue creating your content. The Gems have been automatically refunded to your account. Please feel free to try again in a moment.")
-                       user_session.premium_offer_state = {}  # Clear state
-                       return
-                   
-                   # Step 2: Generate video prompt and submit video task
-                   video_prompt = await self.generate_video_prompt_with_lora(user_session, lora_image_prompt, detected_lora)
-                   
-                   # Submit video generation task
-                   task_id = await self.video_generator.submit_video_task(
-                       image_url=image_url,
-                       prompt=video_prompt,
-                       lora_url=WAVESPEED_ACTION_LORA_MAP[detected_lora]["lora_url"]
-                   )
-                   
-                   if task_id:
-                       # Update user session
-                       user_session.last_video_task = {"task_id": task_id, "status": "pending"}
-                       
-                       # Remove the original message with buttons
-                       await query.edit_message_text("💕 Your video is being created! I'll send it to you when it's ready (usually within 2-3 minutes).")
-                       
-                       # Clear pending gem refund since task was successful
-                       self.db.clear_pending_gem_refund(user_id)
-                       
-                       # Start polling for completion
-                       asyncio.create_task(self._poll_video_completion(user_id, task_id))
-                   else:
-                       # Refund gems if task submission failed
-                       refunded = self.db.refund_gems(user_id, gem_cost)
-                       if refunded:
-                           await query.edit_message_text("I'm so sorry, but it seems there was an issue creating your content. The Gems have been automatically refunded to your account. Please feel free to try again in a moment.")
-               elif offer_type == 'voice':
+               if offer_type == 'voice':
                    # Just deliver the voice note (stub)
                    await query.edit_message_text("💕 Your voice note is ready!")
                    await asyncio.sleep(2)
                    await context.bot.send_message(chat_id=user_id, text="[Voice note delivered: (stub)]")
-               elif offer_type == 'voice_note':
-                   # Generate voice note using ElevenLabs
-                   try:
-                       if not user_session.current_character:
-                           return
-                       character = CHARACTERS[user_session.current_character]
-                       voice_id = character['voice_id']
-                       # Generate a new voice note response
-                       user_name = user_session.user_name or "you"
-                       # Generate a new voice note message
-                       voice_prompt = (
-                           f"<|im_start|>system\n{character['system_prompt_base'].format(user_name=escape_markdown(user_name, version=2))}\n"
-                           f"**Current Scenario:** {character['scenarios'][user_session.current_scenario]['scenario_prompt']}\n"
-                           f"**Current Outfit:** {user_session.character_current_outfit}\n"
-                           f"Generate a short, intimate voice note message (2-3 sentences max). "
-                           f"Make it personal and seductive. Do NOT use asterisks, brackets, or sound effect tags. Just write a natural, intimate voice note. It just needs to be a normal text to voice message without any special characters or formatting. No asterisks, brackets, or sound effect tags in the voice message. "
-                           f"Keep it natural and conversational.<|im_end|>\n"
-                           f"<|im_start|>user\nCreate a voice note for me<|im_end|>\n"
-                           f"<|im_start|>assistant\n{character['full_name']}:"
-                       )
-                       if self.kobold_available:
-                           voice_message = await self.kobold_api.generate(voice_prompt, max_tokens=60)
-                           voice_message = self._ensure_complete_sentence(voice_message)
-                       else:
-                           voice_message = f"Hey {user_name}, missing you so much right now..."
-                       
-                       # Clean voice text for TTS
-                       clean_text = clean_voice_note_text(voice_message)
-                       
-                       # Generate voice note using ElevenLabs
-                       voice_bytes = await self.elevenlabs_manager.create_voice_note(clean_text, voice_id)
-                       
-                       if voice_bytes:
-                           # Remove the original message with buttons
-                           await query.edit_message_text("💕 Your voice note is ready!")
-                           
-                           # Send voice note
-                           from io import BytesIO
-                           voice_io = BytesIO(voice_bytes)
-                           voice_io.name = f"{character['name']}_voice_note.mp3"
-                           await context.bot.send_voice(
-                               chat_id=user_id,
-                               voice=voice_io,
-                               caption=f"💕 {character['name']} sent you a voice note!"
-                           )
-                           
-                           # Clear pending gem refund since voice note was successful
-                           self.db.clear_pending_gem_refund(user_id)
-                       else:
-                           # Refund gems if voice note creation failed
-                           refunded = self.db.refund_gems(user_id, gem_cost)
-                           if refunded:
-                               await query.edit_message_text("I'm so sorry, but it seems there was an issue creating your voice note. The Gems have been automatically refunded to your account.")
-                   except Exception as e:
-                       logger.error(f"[VOICE NOTE] Error generating voice note: {e}")
-                       # Refund gems on error
-                       refunded = self.db.refund_gems(user_id, gem_cost)
-                       if refunded:
-                           await query.edit_message_text("I'm so sorry, but it seems there was an issue creating your voice note. The Gems have been automatically refunded to your account.")
-                       else:
-                           await query.edit_message_text("I'm sorry, there was an issue creating your voice note.")
                elif offer_type == 'voice_call':
                    # Initiate voice call using ElevenLabs agent
                    try:
@@ -3637,6 +6028,146 @@ class SecretShareBot:
                user_session.premium_offer_state = {}
                return
 
+    def _build_premium_job_payload(self, user_session, offer_type: str, query) -> dict:
+       """Capture everything a premium job needs at purchase time."""
+       payload = {'message_id': query.message.message_id}
+       if offer_type == 'image':
+           history_window = user_session.conversation_history[-4:]
+           payload['image_prompt_context'] = "\n".join([f"{turn['role']}: {turn['content']}" for turn in history_window])
+       elif offer_type == 'video':
+           # Use the LoRA detected from the user's message, else a random safe solo action
+           detected_lora = user_session.premium_offer_state.get('detected_lora')
+           if detected_lora:
+               logger.info(f"[VIDEO] Using detected LoRA: {detected_lora}")
+           else:
+               detected_lora = random.choice(SOLO_ACTION_LORA_POOL)
+               logger.info(f"[VIDEO] No specific keyword detected, randomly selected LoRA: {detected_lora}")
+           payload['detected_lora'] = detected_lora
+       return payload
+
+    async def _get_job_session(self, user_id: int) -> UserData:
+       user_session = self.active_users.get(user_id) or await self._refresh_user_data_on_return(user_id)
+       if not user_session or not user_session.current_character:
+           raise PremiumJobError(f"user {user_id} has no active character", retryable=False)
+       return user_session
+
+    async def _edit_job_message(self, job: dict, text: str):
+       try:
+           await self.application.bot.edit_message_text(chat_id=job['user_id'], message_id=job['payload']['message_id'], text=text)
+       except Exception as e:
+           logger.info(f"[PREMIUM JOB] Could not edit offer message for job {job['id']}: {e}")
+
+    async def _run_image_job(self, job: dict):
+       user_id = job['user_id']
+       user_session = await self._get_job_session(user_id)
+       image_url = await self.image_generator.generate_final_image(user_session, user_message=job['payload'].get('image_prompt_context', ''))
+       if not image_url:
+           raise PremiumJobError("image generation returned no URL")
+       await self._edit_job_message(job, "\u2764\ufe0f Your image is ready!")
+       await self.application.bot.send_photo(chat_id=user_id, photo=image_url)
+
+    async def _run_video_job(self, job: dict):
+       user_id = job['user_id']
+       payload = job['payload']
+       user_session = await self._get_job_session(user_id)
+       task_id = payload.get('task_id')
+       if not task_id:
+           detected_lora = payload['detected_lora']
+           # Step 1: Generate still image using LoRA-specific prompt
+           lora_image_prompt = self._get_lora_image_prompt(user_session, detected_lora)
+           image_url = await self.image_generator.generate_final_image(user_session, user_message=lora_image_prompt)
+           if not image_url:
+               raise PremiumJobError("still image generation returned no URL")
+           # Step 2: Generate video prompt and submit video task
+           video_prompt = await self.generate_video_prompt_with_lora(user_session, lora_image_prompt, detected_lora)
+           task_id = await self.video_generator.submit_video_task(
+               image_url=image_url,
+               prompt=video_prompt,
+               lora_url=WAVESPEED_ACTION_LORA_MAP[detected_lora]["lora_url"]
+           )
+           if not task_id:
+               raise PremiumJobError("Wavespeed task submission failed")
+           # Remember the task so a retry never submits (and pays for) a second render
+           payload['task_id'] = task_id
+           await asyncio.to_thread(Database.update_premium_job, job['id'], payload=payload)
+       user_session.last_video_task = {"task_id": task_id, "status": "pending"}
+       # Hand the task to the shared poller (persisted across restarts)
+       await self.video_poller.add(task_id, user_id, job['gem_cost'])
+
+    async def _run_voice_note_job(self, job: dict):
+       user_id = job['user_id']
+       user_session = await self._get_job_session(user_id)
+       character = CHARACTERS[user_session.current_character]
+       voice_id = character['voice_id']
+       user_name = user_session.user_name or "you"
+       # Generate a new voice note message
+       voice_prompt = PROMPTS.voice_note(user_session, user_name)
+       fallback = f"Hey {user_name}, missing you so much right now..."
+       # Each sentence goes to TTS as soon as Kobold finishes writing it
+       sentences = self._stream_voice_script(voice_prompt, fallback)
+       voice_bytes = await self.elevenlabs_manager.create_voice_note_from_sentences(sentences, voice_id)
+       if not voice_bytes:
+           raise PremiumJobError("ElevenLabs returned no audio")
+
+       # Telegram plays OGG/Opus natively as a voice message
+       encoded = await self.voice_encoder.encode(voice_bytes)
+       await self._edit_job_message(job, "💕 Your voice note is ready!")
+       voice_io = io.BytesIO(encoded.data)
+       voice_io.name = f"{character['name']}_voice_note.{encoded.extension}"
+       await self.application.bot.send_voice(
+           chat_id=user_id,
+           voice=voice_io,
+           duration=encoded.duration,
+           caption=f"💕 {character['name']} sent you a voice note!"
+       )
+
+    async def _stream_voice_script(self, prompt: str, fallback: str):
+       """Yield cleaned voice-note sentences while Kobold is still generating the script."""
+       if not self.kobold_available:
+           yield clean_voice_note_text(fallback)
+           return
+       buffer = ""
+       emitted = False
+       try:
+           async with contextlib.aclosing(self.kobold_api.generate_stream(prompt, max_tokens=60)) as tokens:
+               async for token in tokens:
+                   buffer += token
+                   stopped = False
+                   for stop in ("<|im_end|>", "<|im_start|>", "User:"):
+                       if stop in buffer:
+                           buffer = buffer.split(stop)[0]
+                           stopped = True
+                   sentences, buffer = split_complete_sentences(buffer)
+                   for sentence in sentences:
+                       clean_sentence = clean_voice_note_text(sentence)
+                       if clean_sentence:
+                           emitted = True
+                           yield clean_sentence
+                   if stopped:
+                       break
+       except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+           logger.error("[VOICE NOTE] Kobold stream interrupted: %s", e)
+       tail = clean_voice_note_text(buffer)
+       if tail:
+           emitted = True
+           yield self._ensure_complete_sentence(tail)
+       if not emitted:
+           yield clean_voice_note_text(fallback)
+
+    async def _on_premium_job_failed(self, job: dict, error: Exception, refunded: bool):
+       """Called by the job queue once a job has run out of attempts."""
+       if refunded:
+           await self._edit_job_message(job, "I'm so sorry, but it seems there was an issue creating your content. The Gems have been automatically refunded to your account. Please feel free to try again in a moment.")
+       else:
+           await self._edit_job_message(job, "I'm sorry, there was an issue creating your content.")
+       try:
+           await self.application.bot.send_message(
+               chat_id=ADMIN_CHAT_ID,
+               text=f"🚨 PREMIUM OFFER FAILURE: User {job['user_id']} - {job['job_type']} job {job['id']} failed. {job['gem_cost']} gems {'refunded' if refunded else 'NOT refunded'}. Error: {error}"
+           )
+       except Exception as e:
+           logger.error(f"[PREMIUM JOB] Could not notify admin about job {job['id']}: {e}")
+
     async def test_upsell(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
        user_id = update.effective_user.id
        user_session = self.active_users.get(user_id)
@@ -3670,6 +6201,7 @@ class SecretShareBot:
            def __init__(self, user_id, offer_type, gem_cost):
                self.from_user = type('User', (), {'id': user_id})
                self.data = f"premium_yes|{offer_type}|{gem_cost}"
+               self.message = update.message
            async def answer(self):
                pass
            async def edit_message_text(self, text, **kwargs):
@@ -3767,11 +6299,7 @@ class SecretShareBot:
 
 
     async def generate_upsell_line(self, user_session, offer_type, user_message=None):
-       character = CHARACTERS[user_session.current_character]
        user_name = user_session.user_name or random.choice(['handsome', 'bello', 'there'])
-       scenario = character['scenarios'][user_session.current_scenario]
-       persona_prompt = character['system_prompt_base'].format(user_name=escape_markdown(user_name, version=2))
-       scenario_prompt = f"You are in {scenario['scenario_prompt']}. You are wearing {user_session.character_current_outfit}."
        offer_noun = {
            'image': 'photo',
            'video': 'video',
@@ -3779,28 +6307,12 @@ class SecretShareBot:
            'voice_note': 'voice note',
            'voice_call': 'voice call'
        }[offer_type]
-       # --- Conversation context ---
-       history_window = user_session.conversation_history[-4:] if len(user_session.conversation_history) >= 4 else user_session.conversation_history
-       history_text = "\n".join([f"{turn['role']}: {turn['content']}" for turn in history_window])
-       # --- Instruction ---
-       upsell_instruction = (
-           f"Generate a short, in-character, natural upsell line for offering a {offer_noun} to the user, based on the current conversation and your persona. "
-           "Do NOT break character. Do NOT mention gems, payment, or cost. Make it feel like a natural, playful, or enticing suggestion. "
-           "Do not use a template. Respond as you would in the ongoing roleplay."
-       )
-       prompt_parts = [
-           f"<|im_start|>system\n{persona_prompt}\n**Current Scenario Context:** {scenario_prompt}\n<|im_end|>",
-       ]
-       if history_text:
-           prompt_parts.append(f"<|im_start|>history\n{history_text}<|im_end|>")
-       if user_message:
-           prompt_parts.append(f"<|im_start|>user\n{user_message}<|im_end|>")
-       prompt_parts.append(f"<|im_start|>assistant\n{upsell_instruction}\n{character['full_name']}:")
-       final_prompt = "".join(prompt_parts)
+       final_prompt = PROMPTS.upsell(user_session, user_name, offer_noun, user_message)
        if self.kobold_available:
            raw_upsell = await self.kobold_api.generate(final_prompt, max_tokens=60)
        else:
            raw_upsell = "*I lean in, eyes sparkling.* Would you like something a little more... personal?"
+           METRICS.inc('fallback_responses_total', source='upsell_line')
        completed = self._ensure_complete_sentence(raw_upsell)
        return self._validate_and_fix_actions(completed, user_name)
 
@@ -3811,9 +6323,6 @@ class SecretShareBot:
        Part B: Explicit, non-euphemistic description of physical action
        """
        character = CHARACTERS[user_session.current_character]
-       scenario = character['scenarios'][user_session.current_scenario]
-       persona_prompt = character['system_prompt_base'].format(user_name=user_session.user_name or "you")
-       scenario_prompt = scenario['scenario_prompt']
        
        # Get the LoRA data
        lora_data = WAVESPEED_ACTION_LORA_MAP.get(detected_lora_type)
@@ -3900,24 +6409,7 @@ class SecretShareBot:
            user_session.unblur_processing = False
 
     async def generate_video_prompt(self, user_session, user_message):
-       character = CHARACTERS[user_session.current_character]
-       scenario = character['scenarios'][user_session.current_scenario]
-       persona_prompt = character['system_prompt_base'].format(user_name=user_session.user_name or "you")
-       scenario_prompt = scenario['scenario_prompt']
-       history = user_session.conversation_history[-4:]
-       history_text = "\n".join([f"{turn['role']}: {turn['content']}" for turn in history])
-       instruction = (
-           "Generate a short, visually rich, cinematic prompt for a video featuring the character. "
-           "Describe the scene, pose, and mood in a tasteful way. Do NOT include any talking, speech, text, or dialogue. "
-           "Focus on visual action, body language, and atmosphere. No words, no subtitles, no open mouth as if talking. "
-           "Keep it elegant and artistic, avoid explicit or suggestive language."
-       )
-       prompt = (
-           f"<|im_start|>system\n{persona_prompt}\nCurrent scenario: {scenario_prompt}\n<|im_end|>"
-           f"<|im_start|>history\n{history_text}<|im_end|>"
-           f"<|im_start|>user\n{user_message}<|im_end|>"
-           f"<|im_start|>assistant\n{instruction}\nPrompt:"
-       )
+       prompt = PROMPTS.video(user_session, user_message)
        if self.kobold_available:
            # Allow longer prompts for video generation (up to 120 tokens instead of 60)
            video_prompt = await self.kobold_api.generate(prompt, max_tokens=120)
@@ -3990,11 +6482,7 @@ class SecretShareBot:
                         if entry.get('role') == 'user':
                             user_msg = entry.get('content', '')
                             # Try to extract name from previous messages
-                            name_patterns = [
-                                r"(?:my name is|call me|the name is|i(?:'m| am)|it's|this is|you can call me|just call me|name's)\s+([A-Za-z]{2,20})\b",
-                                r"^([A-Za-z]{2,20})[.,!\s]*$"
-                            ]
-                            for pattern in name_patterns:
+                            for pattern in HISTORY_NAME_PATTERNS:
                                 match = re.search(pattern, user_msg, re.IGNORECASE)
                                 if match:
                                     potential_name = match.group(1).capitalize()
@@ -4030,17 +6518,12 @@ class SecretShareBot:
                 call_id = await self.elevenlabs_manager.initiate_voice_call(agent_id, phone_number, user_id, voice_call_user_name)
                 if call_id:
                     # Store call info for tracking
-                    self.active_calls[call_id] = user_id
+                    await self.state.register_call(call_id, user_id, max_call_minutes)
                     # Log the call in database (gems will be deducted after call ends)
                     self.db.log_voice_call(user_id, call_id, agent_id, phone_number, 0)  # 0 gems for now
                     
-                    # Start real-time monitoring to prevent exceeding gem balance
-                    context.job_queue.run_repeating(
-                        callback=self._monitor_call_duration,
-                        interval=30,  # Check every 30 seconds
-                        data={'call_id': call_id, 'user_id': user_id, 'max_minutes': max_call_minutes, 'start_time': datetime.now(timezone.utc)},
-                        name=f"call_monitor_{call_id}"
-                    )
+                    # Hand the call to the supervisor so it is cut off exactly at the gem limit
+                    self.call_supervisor.add(call_id, user_id, max_call_minutes)
                     
                     await update.message.reply_text(f"📞 Calling you now! Maximum call duration: {max_call_minutes} minutes based on your {gems} Gems. You'll be charged {gem_cost} Gems per minute after the call ends.\n\n⚠️ Call will automatically end when you reach your gem limit.")
                     user_session.premium_offer_state = {}
@@ -4613,6 +7096,12 @@ class SecretShareBot:
                 
                 # Mark payment as completed
                 supabase.table('processed_payments').update({'status': 'completed'}).eq('telegram_charge_id', telegram_payment_charge_id).execute()
+                self.payment_events.publish({
+                    'user_id': user_id,
+                    'gems': new_total,
+                    'source': 'telegram',
+                    'charge_id': telegram_payment_charge_id
+                })
                 
                 await update.message.reply_text(
                     f"✅ **Payment Successful!**\n\n"
@@ -4642,6 +7131,13 @@ class SecretShareBot:
                 
                 # Mark payment as completed
                 supabase.table('processed_payments').update({'status': 'completed'}).eq('telegram_charge_id', telegram_payment_charge_id).execute()
+                self.payment_events.publish({
+                    'user_id': user_id,
+                    'gems': new_total,
+                    'subscription_type': tier,
+                    'source': 'telegram',
+                    'charge_id': telegram_payment_charge_id
+                })
                 
                 await update.message.reply_text(
                     f"✅ **Subscription Activated!**\n\n"
@@ -4938,8 +7434,9 @@ def blur_image_with_replicate(image_url: str, blur_scale: int = 1000) -> Optiona
         if not REPLICATE_API_TOKEN:
             logger.error(f"[BLUR] No REPLICATE_API_TOKEN available")
             return None
-        client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-        output = client.run("kharioki/blur-faces:bdcc18be6a02a8f2efce1a3f7489f74a1d6729caea9b53061358fe75c93799d2", input={"image": image_url, "blur_scale": blur_scale})
+        client = get_replicate_client(REPLICATE_API_TOKEN)
+        with METRICS.time('replicate_run_seconds', model='blur_faces'):
+            output = client.run("kharioki/blur-faces:bdcc18be6a02a8f2efce1a3f7489f74a1d6729caea9b53061358fe75c93799d2", input={"image": image_url, "blur_scale": blur_scale})
         logger.info(f"[BLUR] Replicate output: {output} (type: {type(output)})")
         
         # Handle both string and FileOutput objects from Replicate
@@ -4962,6 +7459,19 @@ def blur_image_with_replicate(image_url: str, blur_scale: int = 1000) -> Optiona
 def can_upsell(user_session):
     return not (user_session.last_video_task and user_session.last_video_task.get("task_id"))
 
+_SENTENCE_END_RE = re.compile(r'[.!?…]+["\'*)\]]*\s+')
+
+def split_complete_sentences(buffer: str, min_chars: int = VOICE_PIPELINE_MIN_CHARS):
+    """Split finished sentences off a streaming buffer. Returns (sentences, remainder)."""
+    sentences = []
+    start = 0
+    for match in _SENTENCE_END_RE.finditer(buffer):
+        if match.end() - start < min_chars:
+            continue
+        sentences.append(buffer[start:match.end()].strip())
+        start = match.end()
+    return sentences, buffer[start:]
+
 def clean_voice_note_text(text: str) -> str:
     text = text.replace("*", "")
     text = re.sub(r"\[.*?\]", "", text)
@@ -5015,9 +7525,17 @@ def clean_voice_call_text(text: str) -> str:
     return '. '.join(clean_sentences).strip()
 
 
-def main():
-    """The main function to set up and run the bot."""
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application(token: Optional[str] = None, request: Optional[BaseRequest] = None) -> Tuple[Application, 'SecretShareBot']:
+    """Build the Application with every handler, job and lifecycle hook registered."""
+    application = (
+        Application.builder()
+        .token(token or BOT_TOKEN)
+        .request(request or MetricsHTTPXRequest(connection_pool_size=256))
+        .update_queue(asyncio.Queue(maxsize=TELEGRAM_UPDATE_QUEUE_SIZE))
+        .concurrent_updates(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(OutboundScheduler())
+        .build()
+    )
     bot = SecretShareBot(application)
     application.add_handler(CommandHandler("start", bot.start))
     application.add_handler(CommandHandler("testupsell", bot.test_upsell))
@@ -5048,57 +7566,109 @@ def main():
     if job_queue:
         job_queue.run_daily(bot._check_inactive_users, time=time(hour=12, minute=0, tzinfo=timezone.utc), name="daily_inactive_check")
         job_queue.run_repeating(bot._cleanup_inactive_users, interval=3600, first=3600, name="memory_cleanup")  # Every hour
-        job_queue.run_repeating(bot._sync_recent_payments, interval=30, first=30, name="payment_sync")  # Every 30 seconds - FRONTEND INTEGRATION
+        job_queue.run_repeating(bot._log_update_metrics, interval=60, first=60, name="update_metrics")
 
     async def post_init(app: Application) -> None:
+        instrument_supabase(supabase)
         await bot.kobold_api.start_session()
-        try:
-            bot.kobold_available = await bot.kobold_api.check_availability()
-        except Exception as e:
-            logger.warning(f"[INIT] Kobold API not available: {e}")
-            bot.kobold_available = False
-        if bot.kobold_available:
-            logger.info("✅ KoboldCPP is running and connected!")
-        else:
-            logger.warning("⚠️ KoboldCPP not available - bot will use fallback text responses.")
+        await bot.elevenlabs_manager.start_session()
+        await bot.start_web_server()
+        await bot.video_delivery.start(app.bot)
+        await bot.typing.start(app.bot)
+        # Only the leader resumes an interrupted broadcast; a replica that takes over later resumes it then
+        bot.leader.on_elected = lambda: bot.reengagement.resume(app.bot)
+        # The three resume queries are independent; don't pay their round trips one after another
+        await asyncio.gather(bot.video_poller.start(), bot.premium_jobs.start(), bot.leader.start())
+        await bot.payment_events.start()
+        await bot.follow_ups.start()
+        await bot.call_supervisor.start()
+        # Take back calls left by a previous run of this replica or by one that died
+        await bot._replica_heartbeat(None, startup=True)
+        if app.job_queue:
+            app.job_queue.run_repeating(bot._replica_heartbeat, interval=REPLICA_HEARTBEAT_SECONDS, first=REPLICA_HEARTBEAT_SECONDS, name="replica_heartbeat")
+        if not bot.payment_events.dsn and app.job_queue:
+            app.job_queue.run_repeating(bot._sync_recent_payments, interval=PAYMENT_FALLBACK_SYNC_SECONDS, first=PAYMENT_FALLBACK_SYNC_SECONDS, name="payment_sync")
+        # Kobold/ElevenLabs/schema checks only log and set flags, so updates are served while they run
+        bot.warm_up_task = asyncio.create_task(bot.warm_up())
 
     async def on_shutdown(app: Application) -> None:
+        if bot.warm_up_task:
+            bot.warm_up_task.cancel()
+            await asyncio.gather(bot.warm_up_task, return_exceptions=True)
+        await bot.stop_web_server()
+        await bot.payment_events.stop()
+        await bot.reengagement.stop()
+        await bot.leader.stop()
+        await bot.follow_ups.stop()
+        await bot.call_supervisor.stop()
+        try:
+            await bot.state.retire()
+        except Exception as e:
+            logger.warning("[CALL MONITOR] Could not drop heartbeat: %s", e)
+        await bot.premium_jobs.stop()
+        await bot.video_poller.stop()
+        await bot.video_delivery.stop()
+        await bot.typing.stop()
         await bot.kobold_api.close_session()
+        await bot.elevenlabs_manager.close_session()
+        bot.voice_encoder.shutdown()
         logger.info("Bot is shutting down. API session closed.")
 
     application.post_init = post_init
-    application.on_shutdown = on_shutdown
+    application.post_shutdown = on_shutdown
+    return application, bot
+
+def main():
+    """The main function to set up and run the bot."""
+    application, bot = build_application()
     logger.info("🚀 Starting Secret Share Bot v69 (The Launch-Ready Build)...")
     logger.info("v69 fixes implemented: String casting, image variation, SFW enforcement")
-    logger.info("🔄 Beginning Telegram polling...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if TELEGRAM_MODE == 'webhook':
+        logger.info("🌐 Receiving Telegram updates via webhook...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("🔄 Beginning Telegram polling...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+async def run_webhook(application: Application):
+    """Run the bot on webhook updates delivered to web_app.
+
+    Every replica behind the load balancer registers the same URL, so setWebhook is
+    idempotent and the webhook is deliberately left in place on shutdown.
+    """
+    if not TELEGRAM_WEBHOOK_URL or not os.getenv('TELEGRAM_WEBHOOK_SECRET'):
+        raise RuntimeError("TELEGRAM_WEBHOOK_URL and TELEGRAM_WEBHOOK_SECRET are required in webhook mode")
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await application.bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL.rstrip('/') + TELEGRAM_WEBHOOK_PATH,
+            secret_token=os.getenv('TELEGRAM_WEBHOOK_SECRET'),
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"✅ Webhook registered at {TELEGRAM_WEBHOOK_URL.rstrip('/')}{TELEGRAM_WEBHOOK_PATH}")
+        await stop_event.wait()
+    finally:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 if __name__ == "__main__":
-    import time as time_module
-    import random
     import uuid
     
     # Generate unique instance ID for debugging
     instance_id = str(uuid.uuid4())[:8]
     logger.info(f"🚀 Starting Secret Share Bot instance {instance_id}")
-    
-    delay = 10 + random.randint(0, 10)
-    logger.info(f"⏰ Instance {instance_id} waiting {delay} seconds to avoid polling conflicts...")
-    time_module.sleep(delay)
-    
-    logger.info(f"✅ Instance {instance_id} delay complete, proceeding with startup...")
 
-    logger.info("Checking for 'last_seen' column in 'users' table for retention features...")
-    try:
-        supabase.table('users').select('last_seen').limit(1).execute()
-        logger.info("✅ Database check successful: 'last_seen' column exists.")
-    except Exception as e:
-        logger.error("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        logger.error("!!! CRITICAL DATABASE ERROR: 'last_seen' column not found in 'users' table.")
-        logger.error("!!! The 24-hour retention feature WILL NOT WORK without it.")
-        logger.error("!!! Please run the provided Supabase SQL script to add the column.")
-        logger.error("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-    
     try:
         logger.info(f"🎯 Instance {instance_id} starting main bot function...")
         main()